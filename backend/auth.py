@@ -1,26 +1,184 @@
 import jwt
 import bcrypt
+import asyncio
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
-from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 
+from dependencies import get_db
+from metrics import trace_phase
+
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_HOURS = 24
+# Carry name/email in the token so read-only endpoints need no user lookup
+TOKEN_CLAIMS_ENABLED = os.getenv("TOKEN_CLAIMS_ENABLED", "true").lower() == "true"
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+# bcrypt work factor; stored hashes with a different cost are upgraded on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# "thread" (bcrypt releases the GIL) or "process"
+PASSWORD_HASH_POOL = os.getenv("PASSWORD_HASH_POOL", "thread")
+# Hash/verify jobs allowed in flight before new ones are turned away
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
 
 security = HTTPBearer()
 
-def hash_password(password: str) -> str:
+# User fields handlers read from the principal; the password hash and quota
+# bookkeeping stay in the database
+PRINCIPAL_FIELDS = {"name": 1, "email": 1, "storage_used": 1, "storage_limit": 1}
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
     """Hash a password using bcrypt"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether a stored hash was made with a different work factor"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated, size-bounded pool off the event loop.
+
+    Once ``max_pending`` jobs are queued or running, new ones are rejected
+    with 503 so a login burst degrades into fast failures instead of
+    unbounded latency for everything else on the worker.
+    """
+
+    def __init__(self, workers: int, max_pending: int, pool: str = "thread"):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool = pool
+        self.pending = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self._executor = None
+
+    def _get_executor(self):
+        # Created lazily so forked server workers each get their own pool.
+        # Hashing processes start from the forkserver rather than forking
+        # a server that already has an event loop and client threads.
+        if self._executor is None:
+            if self.pool == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("forkserver")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="bcrypt"
+                )
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, please retry",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            with trace_phase("bcrypt"):
+                return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.pending -= 1
+            self.busy_seconds += time.perf_counter() - started
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password, BCRYPT_ROUNDS)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(verify_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_POOL)
+
+class PrincipalCache:
+    """Bounded LRU of user documents with a TTL, keyed by user id and token.
+
+    Entries are grouped per user so invalidate() drops every token of a user
+    in one step when their stored counters change.
+    """
+
+    def __init__(self, max_users: int, ttl: float):
+        self.max_users = max_users
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+
+    def get(self, user_id: str, token: str):
+        tokens = self._users.get(user_id)
+        if tokens is not None:
+            entry = tokens.get(token)
+            if entry is not None and entry[0] > time.monotonic():
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, user_id: str, token: str, user: dict, lookup_seconds: float):
+        self.miss_seconds += lookup_seconds
+        now = time.monotonic()
+        # Expired tokens of an active user would otherwise pile up until
+        # the user falls out of the LRU
+        tokens = {
+            cached: entry for cached, entry in self._users.get(user_id, {}).items()
+            if entry[0] > now
+        }
+        tokens[token] = (now + self.ttl, user)
+        self._users[user_id] = tokens
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._users.pop(str(user_id), None)
+
+    def clear(self):
+        self._users.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        avg_miss = self.miss_seconds / self.misses if self.misses else 0.0
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "avg_lookup_ms": avg_miss * 1000,
+            "saved_ms": self.hits * avg_miss * 1000,
+        }
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL_SECONDS)
+
+def invalidate_principal(user_id):
+    """Forget cached copies of a user after their stored document changes"""
+    principal_cache.invalidate(user_id)
+
 def create_access_token(data: dict):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -29,12 +187,11 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db=None):
-    """Get current authenticated user"""
+def decode_access_token(token: str) -> dict:
+    """Decode a JWT and return its payload, or raise 401"""
     try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("user_id") is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid authentication credentials"
@@ -44,14 +201,42 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials"
         )
-    
-    # Get user from database
-    from server import db as database
-    user = await database.users.find_one({"_id": ObjectId(user_id)})
-    if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="User not found"
-        )
-    
-    return user
\ No newline at end of file
+    return payload
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db=Depends(get_db)):
+    """Get current authenticated user"""
+    with trace_phase("auth"):
+        token = credentials.credentials
+        user_id = decode_access_token(token)["user_id"]
+        
+        user = principal_cache.get(user_id, token)
+        if user is not None:
+            return user
+        
+        # Get user from database
+        started = time.perf_counter()
+        user = await db.users.find_one({"_id": ObjectId(user_id)}, PRINCIPAL_FIELDS)
+        if user is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="User not found"
+            )
+        principal_cache.put(user_id, token, user, time.perf_counter() - started)
+        
+        return user
+
+async def get_token_principal(credentials: HTTPAuthorizationCredentials = Depends(security), db=Depends(get_db)):
+    """Get the authenticated user's identity from the token claims alone.
+
+    For read-only endpoints that only need the user id. Falls back to
+    get_current_user for tokens issued without embedded claims.
+    """
+    with trace_phase("auth"):
+        payload = decode_access_token(credentials.credentials)
+        if "email" not in payload:
+            return await get_current_user(credentials, db)
+        return {
+            "_id": ObjectId(payload["user_id"]),
+            "name": payload.get("name"),
+            "email": payload["email"],
+        }
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import os
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+
+from fastapi import HTTPException, status
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+
+# How long to wait for a blob that is being unlinked before giving up
+DELETE_WAIT_ATTEMPTS = 50
+DELETE_WAIT_SECONDS = 0.02
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Blobs are spread over nested directories named after leading characters
+# of their name, e.g. ab/cd/abcdef... with two levels; 0 keeps a flat layout
+BLOB_FANOUT_LEVELS = int(os.environ.get("BLOB_FANOUT_LEVELS", "2"))
+FANOUT_WIDTH = 2
+
+ENCODING_SUFFIXES = {"zstd": "zst"}
+
+# Blob lifecycle: "live" blobs are referenced by files; at refcount zero they
+# become "deleting" and are queued for the reclaimer, which moves them to
+# "unlinking" while it removes the bytes. A "deleting" blob can still be
+# revived by an upload of the same content.
+
+
+def fanout_path(base_dir: Path, name: str, levels: int = BLOB_FANOUT_LEVELS) -> Path:
+    """Location of ``name`` under ``base_dir`` in the fan-out layout"""
+    if len(name) <= levels * FANOUT_WIDTH:
+        return base_dir / name
+    parts = [name[i * FANOUT_WIDTH:(i + 1) * FANOUT_WIDTH] for i in range(levels)]
+    return base_dir.joinpath(*parts, name)
+
+
+def blob_key(sha256: str, encoding: Optional[str] = None) -> str:
+    """Storage key of the blob with the given digest.
+
+    Encoded copies get their own key so a raw and a compressed upload of
+    the same content never overwrite each other.
+    """
+    name = f"{sha256}.{ENCODING_SUFFIXES[encoding]}" if encoding else sha256
+    return fanout_path(Path(), name).as_posix()
+
+
+def _hash_file(path: Path) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(HASH_BUFFER_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+async def hash_file(path: Path) -> str:
+    """SHA-256 of a file on disk, computed off the event loop"""
+    return await run_in_threadpool(_hash_file, path)
+
+
+async def _remove(path: Path):
+    try:
+        await run_in_threadpool(os.remove, path)
+    except FileNotFoundError:
+        pass
+
+
+async def acquire_blob(db, sha256: str, size: int) -> Optional[dict]:
+    """Take a reference on an existing blob, or return None if we don't have it"""
+    for _ in range(DELETE_WAIT_ATTEMPTS):
+        blob = await db.blobs.find_one_and_update(
+            {"_id": sha256, "size": size, "state": "live"},
+            {"$inc": {"refcount": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob:
+            return blob
+        # Queued for reclaim but not unlinked yet: the bytes are still there
+        blob = await db.blobs.find_one_and_update(
+            {"_id": sha256, "size": size, "state": "deleting"},
+            {"$set": {"state": "live", "refcount": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob:
+            return blob
+        pending = await db.blobs.find_one({"_id": sha256, "state": "unlinking"}, {"_id": 1})
+        if not pending:
+            return None
+        # The reclaimer is removing it right now; wait for it to go
+        await asyncio.sleep(DELETE_WAIT_SECONDS)
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="File is busy, please retry"
+    )
+
+
+async def store_blob(
+    db, storage, tmp_path: Path, sha256: str, size: int,
+    encoding: Optional[str] = None, stored_size: Optional[int] = None
+) -> dict:
+    """Move a freshly written file into storage and take a reference.
+
+    ``size`` is that of the original content; ``encoding`` and
+    ``stored_size`` describe the bytes in ``tmp_path`` if they are
+    compressed. If the content is already stored the new copy is discarded
+    and the existing blob's refcount is bumped instead.
+    """
+    blob = await acquire_blob(db, sha256, size)
+    if blob:
+        await _remove(tmp_path)
+        return blob
+
+    location = await storage.put(blob_key(sha256, encoding), tmp_path)
+    blob = {
+        "_id": sha256,
+        "size": size,
+        "stored_size": size if stored_size is None else stored_size,
+        "encoding": encoding,
+        "path": location,
+        "refcount": 1,
+        "state": "live",
+        "created_at": datetime.utcnow()
+    }
+    try:
+        await db.blobs.insert_one(blob)
+    except DuplicateKeyError:
+        # Another upload of the same content won the race, so share its
+        # blob. Our copy is dropped unless it went to the same key, where
+        # the bytes are identical.
+        blob = await acquire_blob(db, sha256, size)
+        if not blob:
+            await storage.delete(location)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="File is busy, please retry"
+            )
+        if blob["path"] != location:
+            await storage.delete(location)
+    return blob
+
+
+async def release_blobs(db, digests: Iterable[str]) -> int:
+    """Drop one reference per digest and queue blobs nothing points at.
+
+    Repeated digests drop several references with a single update. Returns
+    the number of blobs queued for the reclaimer.
+    """
+    counts = Counter(digests)
+    if not counts:
+        return 0
+    await db.blobs.bulk_write([
+        UpdateOne({"_id": sha256, "state": "live"}, {"$inc": {"refcount": -count}})
+        for sha256, count in counts.items()
+    ], ordered=False)
+
+    # Mark unreferenced blobs so concurrent uploads revive them instead of
+    # linking to a file that is about to disappear
+    unreferenced = {"_id": {"$in": list(counts)}, "state": "live", "refcount": {"$lte": 0}}
+    await db.blobs.update_many(unreferenced, {"$set": {"state": "deleting"}})
+    queued = []
+    async for blob in db.blobs.find(
+        {"_id": {"$in": list(counts)}, "state": "deleting"},
+        {"path": 1}
+    ):
+        queued.append({"sha256": blob["_id"], "path": blob["path"]})
+    await enqueue_reclaim(db, queued)
+    return len(queued)
+
+
+async def release_blob(db, sha256: str) -> int:
+    """Drop a single reference; see release_blobs"""
+    return await release_blobs(db, [sha256])
+
+
+async def enqueue_reclaim(db, entries):
+    """Durably queue files for the background reclaimer to unlink.
+
+    Entries carry the ``path`` to remove and, for blobs, the ``sha256`` whose
+    document is removed along with it.
+    """
+    if entries:
+        now = datetime.utcnow()
+        await db.reclaim_queue.insert_many([
+            {**entry, "enqueued_at": now, "lease_until": now, "attempts": 0}
+            for entry in entries
+        ])
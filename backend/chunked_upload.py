@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from quota import Reservation, release_reservation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+SESSION_TTL = timedelta(hours=int(os.environ.get("UPLOAD_SESSION_TTL_HOURS", "24")))
+GC_INTERVAL_SECONDS = 600
+# Longest a single chunk may take to arrive; a write still running after
+# this stops, so commit never waits on it for longer
+CHUNK_WRITE_TIMEOUT = timedelta(seconds=int(os.environ.get("UPLOAD_CHUNK_WRITE_TIMEOUT_SECONDS", "600")))
+# Writers stop this much before their claim runs out, to allow for clock
+# differences between workers
+CHUNK_WRITE_MARGIN_SECONDS = 30
+# A session left "committing" this long is assumed to belong to a worker
+# that died, and is collected
+COMMIT_TIMEOUT = timedelta(minutes=int(os.environ.get("UPLOAD_COMMIT_TIMEOUT_MINUTES", "60")))
+# How long a commit waits for chunk writes in flight before answering 409
+COMMIT_WAIT_ATTEMPTS = 50
+COMMIT_WAIT_INTERVAL_SECONDS = 0.2
+
+# Bytes buffered in memory before a chunk slice is written to disk
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def chunk_count(size: int, chunk_size: int) -> int:
+    """Number of chunks needed for a file of ``size`` bytes"""
+    return max(1, -(-size // chunk_size))
+
+
+def chunk_length(session: dict, index: int) -> int:
+    """Expected byte length of chunk ``index`` in a session"""
+    start = index * session["chunk_size"]
+    return max(0, min(session["chunk_size"], session["size"] - start))
+
+
+def partial_path(partial_dir: Path, session_id) -> Path:
+    """Location of the preallocated file that chunks are written into"""
+    return partial_dir / f"{session_id}.part"
+
+
+def _preallocate(path: Path, size: int):
+    with open(path, "wb") as fh:
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fh.fileno(), 0, size)
+                return
+            except OSError:
+                pass  # Filesystem without fallocate support
+        fh.truncate(size)
+
+
+async def create_partial(path: Path, size: int):
+    """Reserve the full file up front so chunks can be written in place"""
+    await run_in_threadpool(_preallocate, path, size)
+
+
+# Commit renames the partial file into the blob store, so a descriptor
+# opened before that would write into content other files may share. Each
+# chunk write therefore holds a claim in the session's "writers" array,
+# taken only while the session is open, and commit can only move the
+# session out of "open" once no unexpired claim is left.
+
+
+def no_active_writers(now: datetime) -> dict:
+    """Query clause matching sessions no chunk is being written into"""
+    return {"writers": {"$not": {"$elemMatch": {"until": {"$gt": now}}}}}
+
+
+async def claim_chunk_write(db, session_id) -> Optional[ObjectId]:
+    """Register a chunk write on an open session; None if it is not open"""
+    claim_id = ObjectId()
+    claimed = await db.upload_sessions.update_one(
+        {"_id": session_id, "status": "open"},
+        {"$push": {"writers": {"_id": claim_id, "until": datetime.utcnow() + CHUNK_WRITE_TIMEOUT}}}
+    )
+    return claim_id if claimed.modified_count else None
+
+
+async def release_chunk_write(db, session_id, claim_id: ObjectId, index: Optional[int] = None):
+    """Drop a write claim, recording chunk ``index`` as received if given"""
+    update = {"$pull": {"writers": {"_id": claim_id}}}
+    if index is not None:
+        update["$addToSet"] = {"received": index}
+        update["$set"] = {"expires_at": datetime.utcnow() + SESSION_TTL}
+    return await db.upload_sessions.update_one({"_id": session_id, "status": "open"}, update)
+
+
+async def write_chunk(request: Request, path: Path, offset: int, expected: int) -> int:
+    """Stream the raw request body into ``path`` at ``offset``.
+
+    Each chunk is written with positional writes on its own descriptor, so
+    several chunks of the same session can be received in parallel. The
+    caller holds a write claim; nothing is written once it has run out.
+    """
+    deadline = time.monotonic() + CHUNK_WRITE_TIMEOUT.total_seconds() - CHUNK_WRITE_MARGIN_SECONDS
+
+    async def pwrite(fd, data: bytes, position: int):
+        if time.monotonic() > deadline:
+            raise HTTPException(
+                status_code=status.HTTP_408_REQUEST_TIMEOUT,
+                detail="Chunk took too long to arrive, please retry"
+            )
+        await run_in_threadpool(os.pwrite, fd, data, position)
+
+    fd = await run_in_threadpool(os.open, path, os.O_WRONLY)
+    written = 0
+    buffer = bytearray()
+    try:
+        async for data in request.stream():
+            if written + len(buffer) + len(data) > expected:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Chunk is larger than the expected {expected} bytes"
+                )
+            buffer += data
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                await pwrite(fd, bytes(buffer), offset + written)
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            await pwrite(fd, bytes(buffer), offset + written)
+            written += len(buffer)
+    finally:
+        await run_in_threadpool(os.close, fd)
+
+    if written != expected:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Chunk is {written} bytes, expected {expected}"
+        )
+    return written
+
+
+async def discard_partial(path: Path):
+    """Remove a partial file, ignoring ones that are already gone"""
+    try:
+        await run_in_threadpool(os.remove, path)
+    except FileNotFoundError:
+        pass
+
+
+async def collect_expired_sessions(db, partial_dir: Path) -> int:
+    """Delete expired, uncommitted sessions and their partial chunks.
+
+    Besides open sessions nobody finished, this collects sessions stuck in
+    "committing" past COMMIT_TIMEOUT (their worker died) and sessions that
+    failed to commit, handing back whatever quota they still hold.
+    """
+    now = datetime.utcnow()
+    removed = 0
+    async for session in db.upload_sessions.find(
+        {"status": {"$in": ["open", "committing", "expired"]}, "expires_at": {"$lt": now}},
+        {"_id": 1, "status": 1, "user_id": 1, "reservation_id": 1, "size": 1}
+    ):
+        # Claim the session first so a late commit cannot race the cleanup
+        claimed = await db.upload_sessions.find_one_and_update(
+            {"_id": session["_id"], "status": session["status"], "expires_at": {"$lt": now}},
+            {"$set": {"status": "expired", "expires_at": now + SESSION_TTL}}
+        )
+        if not claimed:
+            continue
+        await discard_partial(partial_path(partial_dir, session["_id"]))
+        if "reservation_id" in session:
+            await release_reservation(db, Reservation(
+                id=session["reservation_id"], user_id=session["user_id"], size=session["size"]
+            ))
+        await db.upload_sessions.delete_one({"_id": session["_id"]})
+        removed += 1
+    return removed
+
+
+async def run_session_gc(db, partial_dir: Path):
+    """Periodically garbage-collect abandoned upload sessions"""
+    while True:
+        try:
+            removed = await collect_expired_sessions(db, partial_dir)
+            if removed:
+                logger.info("Removed %d expired upload sessions", removed)
+        except Exception:
+            logger.exception("Upload session cleanup failed")
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
@@ -0,0 +1,146 @@
+import fnmatch
+import os
+from typing import AsyncIterator, Optional
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import zstandard
+except ImportError:  # compression is off without the zstandard package
+    zstandard = None
+
+# MIME type patterns stored zstd-compressed; empty turns compression off
+COMPRESS_MIME_TYPES = [
+    pattern.strip().lower()
+    for pattern in os.environ.get(
+        "COMPRESS_MIME_TYPES",
+        "text/*,application/json,application/x-ndjson,application/xml,application/*+xml,"
+        "application/javascript,application/x-yaml,application/yaml,application/sql,"
+        "application/x-sh,application/csv,application/rtf,application/x-tex,application/x-log"
+    ).split(",")
+    if pattern.strip()
+]
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", "3"))
+# Files smaller than this aren't worth a frame header
+COMPRESS_MIN_SIZE = 4 * 1024
+# The first bytes of an upload are test-compressed to decide; content that
+# doesn't shrink by at least COMPRESS_MIN_SAVING is stored as-is
+COMPRESS_PROBE_SIZE = 1024 * 1024
+COMPRESS_MIN_SAVING = float(os.environ.get("COMPRESS_MIN_SAVING", "0.1"))
+
+ZSTD = "zstd"
+
+
+def should_compress(mime_type: str) -> bool:
+    """Whether uploads of this type are candidates for compression"""
+    if zstandard is None:
+        return False
+    mime_type = (mime_type or "").split(";", 1)[0].strip().lower()
+    return any(fnmatch.fnmatchcase(mime_type, pattern) for pattern in COMPRESS_MIME_TYPES)
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    """Whether the client lists ``encoding`` in Accept-Encoding with a non-zero q"""
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() != encoding:
+            continue
+        q = params.strip().lower()
+        return not (q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"))
+    return False
+
+
+class StreamCompressor:
+    """Compresses an upload as it is written, or leaves it alone.
+
+    Data is buffered until COMPRESS_PROBE_SIZE bytes (or the end of a smaller
+    file) have arrived; that prefix decides whether the rest is compressed.
+    Not thread-safe; the caller feeds it from one thread at a time.
+    """
+
+    def __init__(self):
+        self.encoding = None
+        self._decided = False
+        self._probe = bytearray()
+        self._compressor = None
+
+    def _decide(self) -> bytes:
+        self._decided = True
+        probe, self._probe = bytes(self._probe), None
+        if len(probe) < COMPRESS_MIN_SIZE:
+            return probe
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        out = compressor.compress(probe) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if len(out) > len(probe) * (1 - COMPRESS_MIN_SAVING):
+            return probe
+        self.encoding = ZSTD
+        self._compressor = compressor
+        return out
+
+    def compress(self, data: bytes) -> bytes:
+        """Bytes to write for ``data``; may be empty while probing"""
+        if not self._decided:
+            self._probe += data
+            if len(self._probe) < COMPRESS_PROBE_SIZE:
+                return b""
+            return self._decide()
+        if self._compressor is None:
+            return data
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Bytes to write once the upload is complete"""
+        if not self._decided:
+            # A file smaller than the probe is decided here, and its frame
+            # still has to be closed
+            out = self._decide()
+            return out + self._compressor.flush() if self._compressor is not None else out
+        if self._compressor is None:
+            return b""
+        return self._compressor.flush()
+
+
+async def decode(chunks: AsyncIterator[bytes], encoding: Optional[str]) -> AsyncIterator[bytes]:
+    """Undo the at-rest encoding of a stream of stored bytes"""
+    if not encoding:
+        async for chunk in chunks:
+            yield chunk
+        return
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    try:
+        async for chunk in chunks:
+            data = await run_in_threadpool(decompressor.decompress, chunk)
+            if data:
+                yield data
+    finally:
+        await chunks.aclose()
+
+
+async def read_content(
+    storage, location: str, encoding: Optional[str], start: int = 0, length: Optional[int] = None
+) -> AsyncIterator[bytes]:
+    """Stream the original bytes of a stored object, optionally a range of them.
+
+    Compressed objects can't be seeked into, so a range is decompressed from
+    the beginning and the bytes before ``start`` are dropped.
+    """
+    if not encoding:
+        async for chunk in storage.read(location, start, length):
+            yield chunk
+        return
+    offset = 0
+    end = None if length is None else start + length
+    chunks = decode(storage.read(location), encoding)
+    try:
+        async for chunk in chunks:
+            chunk_start, offset = offset, offset + len(chunk)
+            if offset <= start:
+                continue
+            if end is not None and chunk_start >= end:
+                break
+            yield chunk[max(0, start - chunk_start):None if end is None else end - chunk_start]
+            if end is not None and offset >= end:
+                break
+    finally:
+        await chunks.aclose()
@@ -0,0 +1,28 @@
+from fastapi import Request
+
+from settings import Settings
+
+# The database client, storage driver and background workers belong to the
+# app and are created by its lifespan in each worker process (see
+# create_app in server.py). Routes get them through these dependencies
+# rather than module globals, so an app can be built against any database.
+
+
+def get_settings(request: Request) -> Settings:
+    return request.app.state.settings
+
+
+def get_db(request: Request):
+    return request.app.state.db
+
+
+def get_storage(request: Request):
+    return request.app.state.storage
+
+
+def get_reclaimer(request: Request):
+    return request.app.state.reclaimer
+
+
+def get_thumbnailer(request: Request):
+    return request.app.state.thumbnailer
@@ -0,0 +1,320 @@
+import calendar
+import os
+import uuid
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from urllib.parse import quote
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+READ_CHUNK_SIZE = 256 * 1024
+# Requests asking for more (coalesced) ranges than this get the whole file
+MAX_RANGES = 32
+
+# Fields of db.files needed to send a file's content
+FILE_CONTENT_FIELDS = {
+    "path": 1, "size": 1, "stored_size": 1, "encoding": 1, "sha256": 1,
+    "mime_type": 1, "original_name": 1, "uploaded_at": 1,
+}
+
+
+def http_date(value: datetime) -> str:
+    """Format a naive UTC datetime as an HTTP-date"""
+    return formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+
+
+def _etag_matches(header: str, etag: str, weak: bool) -> bool:
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def _parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = datetime.utcfromtimestamp(parsed.timestamp())
+    return parsed
+
+
+def not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Whether a conditional GET can be answered with 304 (RFC 7232 section 6)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match uses weak comparison and takes precedence
+        return _etag_matches(if_none_match, etag, weak=True)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def range_applies(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Evaluate If-Range; a failed validator means the full file is sent"""
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        # If-Range requires a strong match
+        return _etag_matches(if_range, etag, weak=False)
+    since = _parse_http_date(if_range)
+    return since is not None and last_modified.replace(microsecond=0) == since
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse a Range header into sorted, coalesced inclusive byte ranges.
+
+    Returns None when the header should be ignored and an empty list when
+    none of the ranges can be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            # Suffix range: the last N bytes
+            if last == "":
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(0, size - length), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start >= size:
+            continue
+        end = int(last) if last else size - 1
+        ranges.append((start, min(end, size - 1)))
+
+    ranges.sort()
+    coalesced = []
+    for start, end in ranges:
+        if coalesced and start <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], end))
+        else:
+            coalesced.append((start, end))
+    if len(coalesced) > MAX_RANGES:
+        return None
+    return coalesced
+
+
+def content_disposition(filename: str, disposition: str = "attachment") -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+class RangeFileResponse(Response):
+    """Serve a file, or byte ranges of it, from disk or a storage driver.
+
+    Local files use the ASGI zero-copy extension (sendfile) or ``pathsend``
+    when the server offers them and fall back to positional reads otherwise.
+    Without a ``path``, bytes come from ``reader(start, length)``.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        size: int,
+        media_type: str,
+        headers: dict,
+        ranges: Optional[List[Tuple[int, int]]] = None,
+        status_code: int = 200,
+        reader: Optional[Callable[[int, int], AsyncIterator[bytes]]] = None,
+    ):
+        self.path = path
+        self.reader = reader
+        self.size = size
+        self.ranges = ranges
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.boundary = None
+        self.init_headers(headers)
+        self.headers["accept-ranges"] = "bytes"
+
+        if ranges is None:
+            self.headers["content-type"] = media_type
+            self.headers["content-length"] = str(size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.headers["content-type"] = media_type
+            self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.headers["content-length"] = str(end - start + 1)
+        else:
+            self.boundary = uuid.uuid4().hex
+            self.headers["content-type"] = f"multipart/byteranges; boundary={self.boundary}"
+            self.headers["content-length"] = str(
+                sum(len(self._part_header(start, end)) + end - start + 1 for start, end in ranges)
+                + len(self._closing())
+            )
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (
+            f"\r\n--{self.boundary}\r\n"
+            f"Content-Type: {self.media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n"
+        ).encode("latin-1")
+
+    def _closing(self) -> bytes:
+        return f"\r\n--{self.boundary}--\r\n".encode("latin-1")
+
+    async def _send_bytes(self, send: Send, body: bytes, more_body: bool = True):
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    async def _send_range(self, send: Send, fh, start: int, length: int, zerocopy: bool, more_body: bool):
+        if zerocopy:
+            await send({
+                "type": "http.response.zerocopy",
+                "file": fh,
+                "offset": start,
+                "count": length,
+                "more_body": more_body,
+            })
+            return
+        fd = fh.fileno()
+        end = start + length
+        offset = start
+        while offset < end:
+            chunk = await run_in_threadpool(os.pread, fd, min(READ_CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            await self._send_bytes(send, chunk, more_body or offset < end)
+        if not more_body and (offset < end or length == 0):
+            await self._send_bytes(send, b"", False)
+
+    async def _send_stream(self, send: Send, start: int, length: int, more_body: bool):
+        sent = 0
+        chunks = self.reader(start, length)
+        try:
+            async for chunk in chunks:
+                sent += len(chunk)
+                await self._send_bytes(send, chunk, more_body or sent < length)
+        finally:
+            await chunks.aclose()
+        if not more_body and (sent < length or length == 0):
+            await self._send_bytes(send, b"", False)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope["method"].upper() == "HEAD":
+            await self._send_bytes(send, b"", False)
+            return
+
+        if self.path is None:
+            if self.ranges is None:
+                await self._send_stream(send, 0, self.size, more_body=False)
+            elif self.boundary is None:
+                start, end = self.ranges[0]
+                await self._send_stream(send, start, end - start + 1, more_body=False)
+            else:
+                for start, end in self.ranges:
+                    await self._send_bytes(send, self._part_header(start, end))
+                    await self._send_stream(send, start, end - start + 1, more_body=True)
+                await self._send_bytes(send, self._closing(), False)
+            return
+
+        extensions = scope.get("extensions") or {}
+        if self.ranges is None and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        zerocopy = "http.response.zerocopy" in extensions
+        fh = await run_in_threadpool(open, self.path, "rb")
+        try:
+            if self.ranges is None:
+                await self._send_range(send, fh, 0, self.size, zerocopy, more_body=False)
+            elif self.boundary is None:
+                start, end = self.ranges[0]
+                await self._send_range(send, fh, start, end - start + 1, zerocopy, more_body=False)
+            else:
+                for start, end in self.ranges:
+                    await self._send_bytes(send, self._part_header(start, end))
+                    await self._send_range(send, fh, start, end - start + 1, zerocopy, more_body=True)
+                await self._send_bytes(send, self._closing(), False)
+        finally:
+            await run_in_threadpool(fh.close)
+
+
+def file_download_response(
+    request: Request,
+    path: Optional[str],
+    size: int,
+    etag: str,
+    last_modified: datetime,
+    filename: str,
+    media_type: str,
+    reader: Optional[Callable[[int, int], AsyncIterator[bytes]]] = None,
+    content_encoding: Optional[str] = None,
+    vary: Optional[str] = None,
+    cache_control: str = "private, no-cache",
+    disposition: str = "attachment",
+) -> Response:
+    """Build the response for a download, honouring conditional and range headers.
+
+    The body is read from ``path`` on local disk or, failing that, ``reader``.
+    ``size`` and ranges refer to the bytes as sent, i.e. after any
+    ``content_encoding``.
+    """
+    etag = f'"{etag}"'
+    headers = {
+        "etag": etag,
+        "last-modified": http_date(last_modified),
+        "cache-control": cache_control,
+        "content-disposition": content_disposition(filename, disposition),
+    }
+    if content_encoding:
+        headers["content-encoding"] = content_encoding
+    if vary:
+        headers["vary"] = vary
+
+    if not_modified(request, etag, last_modified):
+        del headers["content-disposition"]
+        headers.pop("content-encoding", None)
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header and range_applies(request, etag, last_modified):
+        ranges = parse_range(range_header, size)
+        if ranges == []:
+            return Response(
+                status_code=416,
+                headers={"content-range": f"bytes */{size}", "accept-ranges": "bytes"},
+            )
+        if ranges is not None:
+            return RangeFileResponse(path, size, media_type, headers, ranges=ranges, status_code=206, reader=reader)
+
+    return RangeFileResponse(path, size, media_type, headers, reader=reader)
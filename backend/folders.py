@@ -0,0 +1,251 @@
+import base64
+import json
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, status
+from pymongo import UpdateOne
+
+from search import normalize
+
+# Deepest nesting allowed, counting the folder itself
+MAX_FOLDER_DEPTH = 32
+
+# Folders live in db.folders with their parent_id and "ancestors", the ids
+# of every folder above them from the top down. A subtree is one equality
+# match on the multikey ancestors index, and a move rewrites the ancestors
+# of the whole subtree with a single pipeline update. Files only hold a
+# parent_id, so moving or renaming a folder never touches them.
+#
+# Each folder keeps running totals for its whole subtree (size, file_count,
+# folder_count). Changes are applied to the folder and all its ancestors
+# with one bulk write, so reading a folder's size never scans.
+
+
+def parse_folder_id(folder_id: Optional[str]) -> Optional[ObjectId]:
+    """ObjectId of a folder parameter; None or "root" mean the top level"""
+    if folder_id in (None, "", "root"):
+        return None
+    try:
+        return ObjectId(folder_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid folder id"
+        )
+
+
+async def get_folder(db, user_id, folder_id) -> dict:
+    """One of the user's folders, or 404"""
+    folder = await db.folders.find_one({"_id": folder_id, "user_id": user_id})
+    if not folder:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Folder not found"
+        )
+    return folder
+
+
+async def resolve_folder(db, user_id, folder_id: Optional[str]) -> Optional[dict]:
+    """The folder named by a request parameter, or None for the top level"""
+    parsed = parse_folder_id(folder_id)
+    if parsed is None:
+        return None
+    return await get_folder(db, user_id, parsed)
+
+
+def encode_folder_cursor(folder: dict) -> str:
+    """Opaque cursor pointing just past ``folder`` in a by-name listing.
+
+    name_key is unique among a parent's subfolders, so it alone marks the spot.
+    """
+    raw = json.dumps(["folders", folder["name_key"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def folder_page_query(user_id, parent: Optional[dict], cursor: Optional[str]) -> dict:
+    """Filter for one page of a folder's subfolders, in name_key order"""
+    query = {"user_id": user_id, "parent_id": parent and parent["_id"]}
+    if cursor:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            kind, name_key = json.loads(raw)
+            if kind != "folders" or not isinstance(name_key, str):
+                raise ValueError(kind)
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+        query["name_key"] = {"$gt": name_key}
+    return query
+
+
+def lineage(folder: Optional[dict]) -> List[ObjectId]:
+    """Ids of ``folder`` and everything above it; empty for the top level"""
+    if folder is None:
+        return []
+    return folder["ancestors"] + [folder["_id"]]
+
+
+def folder_document(user_id, name: str, parent: Optional[dict]) -> dict:
+    now = datetime.utcnow()
+    return {
+        "user_id": user_id,
+        "name": name,
+        "name_key": normalize(name),
+        "parent_id": parent["_id"] if parent else None,
+        "ancestors": lineage(parent),
+        "size": 0,
+        "file_count": 0,
+        "folder_count": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def check_depth(parent: Optional[dict]):
+    if len(lineage(parent)) + 1 > MAX_FOLDER_DEPTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Folders can be nested at most {MAX_FOLDER_DEPTH} deep"
+        )
+
+
+async def adjust_totals(db, folder_ids: Iterable, **deltas):
+    """Add ``deltas`` to the subtree totals of each folder"""
+    folder_ids = list(folder_ids)
+    deltas = {field: amount for field, amount in deltas.items() if amount}
+    if folder_ids and deltas:
+        await db.folders.update_many({"_id": {"$in": folder_ids}}, {"$inc": deltas})
+
+
+async def record_folder_files(db, files: List[dict], sign: int):
+    """Apply added (sign 1) or removed (sign -1) files to their folders' totals"""
+    by_parent = {}
+    for file in files:
+        if file.get("parent_id"):
+            count, size = by_parent.get(file["parent_id"], (0, 0))
+            by_parent[file["parent_id"]] = (count + 1, size + file["size"])
+    if not by_parent:
+        return
+
+    totals = {}
+    parents = await db.folders.find({"_id": {"$in": list(by_parent)}}, {"ancestors": 1}).to_list(None)
+    for parent in parents:
+        count, size = by_parent.pop(parent["_id"])
+        for folder_id in lineage(parent):
+            file_count, total_size = totals.get(folder_id, (0, 0))
+            totals[folder_id] = (file_count + count, total_size + size)
+    if totals:
+        await db.folders.bulk_write([
+            UpdateOne({"_id": folder_id}, {"$inc": {"file_count": sign * count, "size": sign * size}})
+            for folder_id, (count, size) in totals.items()
+        ], ordered=False)
+    if sign > 0 and by_parent:
+        # Uploaded into a folder deleted in the meantime; scoped by owner so
+        # the (user_id, parent_id) index serves it
+        owners = list({file["user_id"] for file in files if file.get("parent_id") in by_parent})
+        await db.files.update_many(
+            {"user_id": {"$in": owners}, "parent_id": {"$in": list(by_parent)}},
+            {"$set": {"parent_id": None}}
+        )
+
+
+async def subtree_ids(db, folder: dict) -> List[ObjectId]:
+    """Ids of a folder and every folder below it"""
+    below = await db.folders.find(
+        {"user_id": folder["user_id"], "ancestors": folder["_id"]},
+        {"_id": 1}
+    ).to_list(None)
+    return [folder["_id"]] + [doc["_id"] for doc in below]
+
+
+async def move_folder(db, folder: dict, parent: Optional[dict], **fields):
+    """Re-parent a folder and its subtree with a fixed number of writes.
+
+    ``fields`` are set on the folder in the same write, e.g. a new name.
+    """
+    if parent is not None and folder["_id"] in lineage(parent):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A folder can't be moved into itself"
+        )
+    old_ancestors = folder["ancestors"]
+    new_ancestors = lineage(parent)
+    check_depth(parent)
+    # The deepest descendant must still fit after the move
+    too_deep = MAX_FOLDER_DEPTH - 1 - len(new_ancestors) + len(old_ancestors)
+    if await db.folders.find_one(
+        {"user_id": folder["user_id"], "ancestors": folder["_id"], f"ancestors.{too_deep}": {"$exists": True}},
+        {"_id": 1}
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Folders can be nested at most {MAX_FOLDER_DEPTH} deep"
+        )
+
+    result = await db.folders.update_one(
+        {"_id": folder["_id"], "ancestors": old_ancestors},
+        {"$set": {
+            **fields,
+            "parent_id": parent["_id"] if parent else None,
+            "ancestors": new_ancestors,
+            "updated_at": datetime.utcnow(),
+        }}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Folder was moved concurrently"
+        )
+    # The lineage check above used the parent as it was read. If the parent
+    # moved since, it may now sit below this folder (two opposite moves
+    # racing), so the move is undone rather than leave a cycle behind.
+    if parent is not None and not await db.folders.find_one(
+        {"_id": parent["_id"], "ancestors": parent["ancestors"]}, {"_id": 1}
+    ):
+        await db.folders.update_one(
+            {"_id": folder["_id"], "ancestors": new_ancestors},
+            {"$set": {
+                **{field: folder.get(field) for field in fields},
+                "parent_id": folder["parent_id"],
+                "ancestors": old_ancestors,
+                "updated_at": folder["updated_at"],
+            }}
+        )
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Folder was moved concurrently"
+        )
+    # Descendants swap the old path prefix for the new one
+    await db.folders.update_many(
+        {"user_id": folder["user_id"], "ancestors": folder["_id"]},
+        [{"$set": {"ancestors": {"$concatArrays": [
+            new_ancestors,
+            {"$slice": ["$ancestors", len(old_ancestors), MAX_FOLDER_DEPTH]},
+        ]}}}]
+    )
+    moved = {
+        "size": folder["size"],
+        "file_count": folder["file_count"],
+        "folder_count": folder["folder_count"] + 1,
+    }
+    await adjust_totals(db, old_ancestors, **{field: -amount for field, amount in moved.items()})
+    await adjust_totals(db, new_ancestors, **moved)
+
+
+def folder_crumbs(folder: dict, names: dict) -> List[dict]:
+    """The path to a folder as [{id, name}] from the top down"""
+    return [
+        {"id": str(folder_id), "name": names.get(folder_id, "")}
+        for folder_id in folder["ancestors"]
+    ]
+
+
+async def ancestor_names(db, folder: dict) -> dict:
+    if not folder["ancestors"]:
+        return {}
+    above = await db.folders.find({"_id": {"$in": folder["ancestors"]}}, {"name": 1}).to_list(None)
+    return {doc["_id"]: doc["name"] for doc in above}
@@ -0,0 +1,73 @@
+import logging
+
+from pymongo import ASCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+# Every index the API relies on, per collection. Lookups by _id alone are
+# served by the default _id index and need no entry here.
+INDEXES = {
+    "users": [
+        # Register/login lookups; unique so concurrent registrations of the
+        # same email cannot both succeed
+        IndexModel([("email", ASCENDING)], unique=True),
+        # Sweeping expired quota reservations
+        IndexModel([("reservations.expires_at", ASCENDING)], sparse=True),
+    ],
+    "files": [
+        # Listing (keyset pagination per sort order), counts by user
+        IndexModel(
+            [("user_id", ASCENDING), ("uploaded_at", ASCENDING), ("_id", ASCENDING)]
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("original_name", ASCENDING), ("_id", ASCENDING)]
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("size", ASCENDING), ("_id", ASCENDING)]
+        ),
+        # Listing one folder, per sort order
+        IndexModel(
+            [("user_id", ASCENDING), ("parent_id", ASCENDING), ("uploaded_at", ASCENDING), ("_id", ASCENDING)]
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("parent_id", ASCENDING), ("original_name", ASCENDING), ("_id", ASCENDING)]
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("parent_id", ASCENDING), ("size", ASCENDING), ("_id", ASCENDING)]
+        ),
+        # Name search: one entry per word, scanned by prefix
+        IndexModel([("user_id", ASCENDING), ("name_tokens", ASCENDING)]),
+        # Storage reconciler: the files document naming a stored object
+        IndexModel([("filename", ASCENDING)]),
+    ],
+    "folders": [
+        # Listing a folder's subfolders by name; unique so a folder can't
+        # hold two subfolders of the same name
+        IndexModel([("user_id", ASCENDING), ("parent_id", ASCENDING), ("name_key", ASCENDING)], unique=True),
+        # Whole subtrees, for moves and deletes
+        IndexModel([("user_id", ASCENDING), ("ancestors", ASCENDING)]),
+    ],
+    "reclaim_queue": [
+        # Leasing due entries and reading back a leased batch
+        IndexModel([("lease_until", ASCENDING)]),
+        IndexModel([("owner", ASCENDING)], sparse=True),
+        # Storage reconciler: whether a stored object is already queued
+        IndexModel([("path", ASCENDING)]),
+    ],
+    "thumbnails": [
+        # Leasing pending thumbnail jobs
+        IndexModel([("state", ASCENDING), ("lease_until", ASCENDING)]),
+        IndexModel([("owner", ASCENDING)], sparse=True),
+    ],
+    "upload_sessions": [
+        # Expired session garbage collection
+        IndexModel([("status", ASCENDING), ("expires_at", ASCENDING)]),
+    ],
+}
+
+
+async def ensure_indexes(db):
+    """Create any missing indexes; safe to run on every startup"""
+    for collection, indexes in INDEXES.items():
+        names = await db[collection].create_indexes(indexes)
+        logger.info("Ensured indexes on %s: %s", collection, ", ".join(names))
@@ -0,0 +1,411 @@
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from compression import StreamCompressor, should_compress
+from metrics import trace_phase
+from quota import BodyQuota
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ImportError:  # older python-multipart releases
+    import multipart
+    from multipart.multipart import parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# Bytes buffered in memory before a chunk is handed to the writer thread
+WRITE_CHUNK_SIZE = 1024 * 1024
+# Completed files of a batch being finished (deduplicated, moved) at once
+BATCH_FINISH_CONCURRENCY = 16
+
+
+@dataclass
+class FilePart:
+    """Headers of a single file part in a multipart body"""
+    field_name: str
+    filename: str
+    content_type: str
+
+
+@dataclass
+class IngestedFile:
+    """A file written to disk by the streaming ingestion path"""
+    original_name: str
+    filename: str
+    content_type: str
+    path: Path
+    size: int
+    sha256: str
+    # At-rest encoding of the bytes at ``path`` and their size
+    encoding: Optional[str] = None
+    stored_size: Optional[int] = None
+
+
+@dataclass
+class FailedFile:
+    """A file of a batch upload that could not be stored"""
+    original_name: str
+    detail: str
+
+
+@dataclass
+class _PartState:
+    headers: List[Tuple[bytes, bytes]] = field(default_factory=list)
+    header_name: bytes = b""
+    header_value: bytes = b""
+    field_name: str = ""
+    file: Optional[FilePart] = None
+    data: bytearray = field(default_factory=bytearray)
+
+
+class MultipartStream:
+    """Incremental multipart/form-data parser over the raw request stream.
+
+    Unlike Starlette's form parser nothing is spooled to a temporary file:
+    file parts are surfaced as ``(event, part, data)`` tuples, where event is
+    ``"begin"``, ``"data"`` or ``"end"``, as soon as the bytes arrive.
+    Plain form fields are collected into ``fields``.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.fields = {}
+        self._charset = "utf-8"
+        self._part = _PartState()
+        self._events = []
+
+    def _decode(self, value: bytes) -> str:
+        try:
+            return value.decode(self._charset)
+        except (UnicodeDecodeError, LookupError):
+            return value.decode("latin-1")
+
+    def _flush(self):
+        if self._part.file is not None and self._part.data:
+            self._events.append(("data", self._part.file, bytes(self._part.data)))
+            self._part.data.clear()
+
+    def on_part_begin(self):
+        self._part = _PartState()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._part.header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._part.header_value += data[start:end]
+
+    def on_header_end(self):
+        self._part.headers.append((self._part.header_name.lower(), self._part.header_value))
+        self._part.header_name = b""
+        self._part.header_value = b""
+
+    def on_headers_finished(self):
+        headers = dict(self._part.headers)
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Malformed multipart body"
+            )
+        if b"filename" in options:
+            self._part.file = FilePart(
+                field_name=self._decode(options[b"name"]),
+                filename=self._decode(options[b"filename"]),
+                content_type=self._decode(headers.get(b"content-type", b"application/octet-stream")),
+            )
+            self._events.append(("begin", self._part.file, b""))
+        else:
+            self._part.file = None
+            self._part.field_name = self._decode(options[b"name"])
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self._part.data += data[start:end]
+        if self._part.file is not None and len(self._part.data) >= WRITE_CHUNK_SIZE:
+            self._flush()
+
+    def on_part_end(self):
+        if self._part.file is None:
+            self.fields[self._part.field_name] = self._decode(bytes(self._part.data))
+            return
+        self._flush()
+        self._events.append(("end", self._part.file, b""))
+
+    async def events(self) -> AsyncIterator[Tuple[str, FilePart, bytes]]:
+        """Yield file part events in the order they appear in the body"""
+        _, params = parse_options_header(self.request.headers.get("content-type", ""))
+        if b"boundary" not in params:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Expected a multipart/form-data body"
+            )
+        charset = params.get(b"charset", b"utf-8")
+        self._charset = charset.decode("latin-1") if isinstance(charset, bytes) else charset
+
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        async for chunk in self.request.stream():
+            parser.write(chunk)
+            # Callbacks are synchronous, so file data is queued and yielded
+            # here where the consumer can await the disk writes.
+            events, self._events = self._events, []
+            for event in events:
+                yield event
+        parser.finalize()
+
+
+class BlobWriter:
+    """Write a blob to disk off the event loop, hashing as it goes.
+
+    With ``compress`` the bytes on disk are zstd-compressed on the fly when
+    the content turns out to be compressible; ``size`` and ``sha256`` always
+    describe the original content.
+    """
+
+    def __init__(self, path: Path, compress: bool = False):
+        self.path = path
+        self.size = 0
+        self.stored_size = 0
+        self._hasher = hashlib.sha256()
+        self._compressor = StreamCompressor() if compress else None
+        self._fh = None
+
+    @property
+    def sha256(self) -> str:
+        return self._hasher.hexdigest()
+
+    @property
+    def encoding(self) -> Optional[str]:
+        return self._compressor.encoding if self._compressor else None
+
+    def _write(self, data: bytes):
+        # hashlib and zstd release the GIL for large buffers, so doing both
+        # here keeps the digest, compression and the write off the event loop.
+        self._hasher.update(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self.stored_size += len(data)
+        self._fh.write(data)
+
+    def _finish(self):
+        if self._compressor is not None:
+            data = self._compressor.flush()
+            self.stored_size += len(data)
+            self._fh.write(data)
+        self._fh.close()
+
+    async def open(self):
+        self._fh = await run_in_threadpool(open, self.path, "wb")
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        with trace_phase("disk"):
+            await run_in_threadpool(self._write, data)
+
+    async def close(self):
+        if self._fh is not None:
+            await run_in_threadpool(self._finish)
+            self._fh = None
+
+    async def abort(self):
+        if self._fh is not None:
+            await run_in_threadpool(self._fh.close)
+            self._fh = None
+        try:
+            await run_in_threadpool(os.remove, self.path)
+        except FileNotFoundError:
+            pass
+
+
+def unique_filename(original_name: str) -> str:
+    """Generate the on-disk name for an uploaded file"""
+    return f"{uuid.uuid4()}{Path(original_name).suffix}"
+
+
+async def receive_file(request: Request, dest_dir: Path, quota: BodyQuota) -> IngestedFile:
+    """Stream the first file part of a multipart request into ``dest_dir``.
+
+    The size is counted from the bytes actually received, and the upload is
+    aborted with 413 as soon as ``quota`` can't grow to cover it.
+    """
+    stream = MultipartStream(request)
+    part = None
+    writer = None
+    # python-multipart's finalize() doesn't check for the closing boundary,
+    # so a body cut off mid-part only shows as a missing "end" event
+    complete = False
+    try:
+        async for event, file_part, data in stream.events():
+            if event == "begin" and part is None:
+                part = file_part
+                writer = BlobWriter(
+                    dest_dir / unique_filename(part.filename), compress=should_compress(part.content_type)
+                )
+                await writer.open()
+            elif event == "data" and file_part is part:
+                if not await quota.ensure(writer.size + len(data)):
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail="Storage limit exceeded"
+                    )
+                await writer.write(data)
+            elif event == "end" and file_part is part:
+                complete = True
+        if writer is not None and not complete:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Upload was cut off before the file ended"
+            )
+        if writer is not None:
+            await writer.close()
+    except HTTPException:
+        if writer is not None:
+            await writer.abort()
+        raise
+    except multipart.exceptions.MultipartParseError:
+        if writer is not None:
+            await writer.abort()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Malformed multipart body"
+        )
+    except Exception as e:
+        if writer is not None:
+            await writer.abort()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Could not upload file: {str(e)}"
+        )
+
+    if part is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No file provided"
+        )
+
+    return IngestedFile(
+        original_name=part.filename,
+        filename=writer.path.name,
+        content_type=part.content_type,
+        path=writer.path,
+        size=writer.size,
+        sha256=writer.sha256,
+        encoding=writer.encoding,
+        stored_size=writer.stored_size,
+    )
+
+
+async def receive_files(
+    request: Request,
+    dest_dir: Path,
+    quota: BodyQuota,
+    max_files: int,
+    on_file: Callable[[IngestedFile], Awaitable[object]],
+) -> List[Union[Tuple[IngestedFile, object], FailedFile]]:
+    """Stream every file part of a multipart request into ``dest_dir``.
+
+    Each completed file is handed to ``on_file`` in a task, so finishing one
+    file overlaps with receiving the next. ``quota`` covers the total of the
+    batch: a file it can't grow to cover fails on its own and the rest of
+    the batch carries on. Results are returned in body order, either as
+    ``(file, on_file result)`` or as a FailedFile.
+    """
+    semaphore = asyncio.Semaphore(BATCH_FINISH_CONCURRENCY)
+    results = []
+    total = 0
+    part = None
+    writer = None
+    failure = None
+
+    async def finish(ingested: IngestedFile):
+        async with semaphore:
+            try:
+                return ingested, await on_file(ingested)
+            except Exception as e:
+                await BlobWriter(ingested.path).abort()
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                return FailedFile(ingested.original_name, detail)
+
+    stream = MultipartStream(request)
+    try:
+        async for event, file_part, data in stream.events():
+            if event == "begin":
+                part, failure = file_part, None
+                if len(results) >= max_files:
+                    failure = f"Too many files, at most {max_files} per batch"
+                    continue
+                writer = BlobWriter(
+                    dest_dir / unique_filename(part.filename), compress=should_compress(part.content_type)
+                )
+                try:
+                    await writer.open()
+                except OSError as e:
+                    writer, failure = None, f"Could not upload file: {str(e)}"
+            elif failure is not None:
+                if event == "end":
+                    results.append(FailedFile(part.filename, failure))
+                    part = None
+            elif event == "data":
+                try:
+                    if not await quota.ensure(total + writer.size + len(data)):
+                        await writer.abort()
+                        writer, failure = None, "Storage limit exceeded"
+                    else:
+                        await writer.write(data)
+                except OSError as e:
+                    await writer.abort()
+                    writer, failure = None, f"Could not upload file: {str(e)}"
+            elif event == "end":
+                await writer.close()
+                total += writer.size
+                results.append(asyncio.create_task(finish(IngestedFile(
+                    original_name=part.filename,
+                    filename=writer.path.name,
+                    content_type=part.content_type,
+                    path=writer.path,
+                    size=writer.size,
+                    sha256=writer.sha256,
+                    encoding=writer.encoding,
+                    stored_size=writer.stored_size,
+                ))))
+                part, writer = None, None
+    except Exception as e:
+        if writer is not None:
+            await writer.abort()
+        if not results and part is None:
+            if isinstance(e, HTTPException):
+                raise
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Malformed multipart body"
+            )
+        # A broken body only fails the file that was in flight; everything
+        # received completely before it is kept.
+        logger.warning("Batch upload stream ended early: %s", e)
+        if part is not None:
+            results.append(FailedFile(part.filename, "Upload interrupted"))
+    else:
+        # finalize() doesn't check for the closing boundary, so a body cut
+        # off mid-part ends here with that part still open
+        if part is not None:
+            if writer is not None:
+                await writer.abort()
+            results.append(FailedFile(part.filename, "Upload interrupted"))
+
+    return [await r if isinstance(r, asyncio.Task) else r for r in results]
@@ -0,0 +1,151 @@
+import base64
+import json
+import re
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from pymongo import ASCENDING, DESCENDING
+
+try:
+    import orjson
+except ImportError:  # the standard library encoder is used instead
+    orjson = None
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+# Documents fetched per round-trip while streaming a page
+STREAM_BATCH_SIZE = 500
+# Encoded bytes collected before a piece of the body is sent
+STREAM_FLUSH_SIZE = 64 * 1024
+
+# Response class for routes that return plain data
+DefaultJSONResponse = ORJSONResponse if orjson is not None else JSONResponse
+
+# Public sort names mapped to the stored field they order by
+SORT_FIELDS = {
+    "date": "uploaded_at",
+    "name": "original_name",
+    "size": "size",
+}
+
+# Fields a listing can return, mapped to the stored field they come from
+LIST_FIELDS = {
+    "id": "_id",
+    "filename": "filename",
+    "original_name": "original_name",
+    "size": "size",
+    "mime_type": "mime_type",
+    "is_shared": "is_shared",
+    "uploaded_at": "uploaded_at",
+    "has_thumbnail": "has_thumbnail",
+    "parent_id": "parent_id",
+}
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """Validate a comma separated ``fields`` parameter"""
+    if not fields:
+        return list(LIST_FIELDS)
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in LIST_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    return requested
+
+
+def mime_type_filter(mime_type: str):
+    """Match "image/png" exactly, or "image" as the whole family"""
+    if "/" in mime_type:
+        return mime_type
+    return {"$regex": f"^{re.escape(mime_type)}/"}
+
+
+def encode_cursor(sort: str, order: str, doc: dict) -> str:
+    """Opaque keyset cursor pointing just past ``doc``"""
+    value = doc[SORT_FIELDS[sort]]
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([sort, order, value, str(doc["_id"])], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, order: str):
+    """Return the (sort value, _id) a cursor points past"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, last_id = json.loads(raw)
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+        last_id = ObjectId(last_id)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor was issued for a different sort order"
+        )
+    return value, last_id
+
+
+def page_query(user_id, sort: str, order: str, cursor: Optional[str]):
+    """Build the filter and sort spec for one page of a user's files"""
+    field = SORT_FIELDS[sort]
+    direction = DESCENDING if order == "desc" else ASCENDING
+    query = {"user_id": user_id}
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort, order)
+        op = "$lt" if direction == DESCENDING else "$gt"
+        query["$or"] = [
+            {field: {op: value}},
+            {field: value, "_id": {op: last_id}},
+        ]
+    return query, [(field, direction), ("_id", direction)]
+
+
+def to_json(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def dumps(value) -> bytes:
+    """Compact JSON for documents read from the database.
+
+    Skips model validation: rows built from projected documents already
+    have the shape the API promises.
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=to_json)
+    return json.dumps(value, separators=(",", ":"), default=to_json).encode()
+
+
+def json_response(content, headers: Optional[dict] = None) -> Response:
+    return Response(dumps(content), media_type="application/json", headers=headers)
+
+
+async def stream_json_array(cursor, fields: List[str]) -> AsyncIterator[bytes]:
+    """Encode documents from a Mongo cursor as a JSON array, one row at a time"""
+    buffer = bytearray(b"[")
+    first = True
+    async for doc in cursor:
+        row = {name: doc.get(LIST_FIELDS[name]) for name in fields}
+        if not first:
+            buffer += b","
+        first = False
+        buffer += dumps(row)
+        if len(buffer) >= STREAM_FLUSH_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b"]"
+    yield bytes(buffer)
@@ -0,0 +1,433 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from pymongo import monitoring
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from storage import StorageDriver, StoredObject
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+    from prometheus_client.utils import floatToGoString
+except ImportError:  # metrics are off without prometheus_client
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# Read once at startup; with metrics off nothing below is installed
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true" and prometheus_client is not None
+# Per-request auth/db/disk/storage timings, returned in a Server-Timing
+# header and recorded per route
+METRICS_TRACING = os.environ.get("METRICS_TRACING", "false").lower() == "true"
+EVENT_LOOP_LAG_INTERVAL = 0.5
+# Smaller transfers say more about latency than about throughput
+THROUGHPUT_MIN_BYTES = 1024 * 1024
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+THROUGHPUT_BUCKETS = tuple(mib * 1024 * 1024 for mib in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+if METRICS_ENABLED:
+    THROUGHPUT = Histogram(
+        "terabox_transfer_throughput_bytes_per_second", "Throughput of uploads and downloads over 1 MiB",
+        ["direction"], buckets=THROUGHPUT_BUCKETS
+    )
+    PHASE_SECONDS = Histogram(
+        "terabox_request_phase_seconds", "Time a request spent per phase (with METRICS_TRACING)",
+        ["route", "phase"], buckets=LATENCY_BUCKETS
+    )
+    MONGO_SECONDS = Histogram(
+        "terabox_mongo_command_duration_seconds", "MongoDB command round trips",
+        ["command", "collection"], buckets=DB_BUCKETS
+    )
+    MONGO_FAILURES = Counter("terabox_mongo_command_failures", "MongoDB commands that failed", ["command"])
+    STORAGE_SECONDS = Histogram(
+        "terabox_storage_operation_duration_seconds", "Time spent in the storage driver per operation",
+        ["operation"], buckets=LATENCY_BUCKETS
+    )
+    LOOP_LAG = Gauge("terabox_event_loop_lag_seconds", "How late the last event loop probe woke up")
+    LOOP_LAG_SECONDS = Histogram(
+        "terabox_event_loop_lag_distribution_seconds", "How late event loop probes woke up",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+    )
+
+
+class Trace:
+    """Seconds spent per phase by one request"""
+
+    __slots__ = ("phases", "open")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.open = set()
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in self.phases.items())
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+class _Phase:
+    __slots__ = ("trace", "name", "started")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.trace.open.add(self.name)
+
+    def __exit__(self, *exc):
+        self.trace.open.discard(self.name)
+        self.trace.add(self.name, time.perf_counter() - self.started)
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def trace_phase(name: str):
+    """Context manager charging the time inside it to ``name`` on the current trace.
+
+    Costs one context variable lookup when tracing is off; nested uses of
+    the same phase are counted once.
+    """
+    trace = _trace.get()
+    if trace is None or name in trace.open:
+        return _NO_PHASE
+    return _Phase(trace, name)
+
+
+class HttpStats:
+    """Per-route request metrics, exported at scrape time.
+
+    prometheus_client metrics take a lock on every update, which costs more
+    than the rest of the middleware together. These series are only ever
+    updated from the event loop thread, so plain dicts do.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.requests = defaultdict(int)
+        self.latency = {}
+        self.in_flight = defaultdict(int)
+        self.request_bytes = defaultdict(int)
+        self.response_bytes = defaultdict(int)
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float):
+        series = self.latency.get((method, route))
+        if series is None:
+            series = self.latency[(method, route)] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+        self.requests[(method, route, status_code)] += 1
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        requests = CounterMetricFamily("terabox_http_requests", "Requests handled", labels=["method", "route", "status"])
+        for (method, route, status_code), count in list(self.requests.items()):
+            requests.add_metric([method, route, str(status_code)], count)
+        yield requests
+
+        latency = HistogramMetricFamily(
+            "terabox_http_request_duration_seconds", "Time until the last byte of the response was sent",
+            labels=["method", "route"]
+        )
+        for (method, route), (counts, total) in list(self.latency.items()):
+            cumulative, buckets = 0, []
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                buckets.append((floatToGoString(bound), cumulative))
+            latency.add_metric([method, route], buckets, total)
+        yield latency
+
+        in_flight = GaugeMetricFamily("terabox_http_requests_in_flight", "Requests being handled", labels=["method"])
+        for method, count in list(self.in_flight.items()):
+            in_flight.add_metric([method], count)
+        yield in_flight
+
+        for name, documentation, values in (
+            ("terabox_http_request_bytes", "Request body bytes received", self.request_bytes),
+            ("terabox_http_response_bytes", "Response body bytes sent", self.response_bytes),
+        ):
+            family = CounterMetricFamily(name, documentation, labels=["route"])
+            for route, count in list(values.items()):
+                family.add_metric([route], count)
+            yield family
+
+
+http_stats = HttpStats()
+
+
+class MetricsMiddleware:
+    """Records latency, status, bytes and in-flight requests per route.
+
+    Routes are labelled with their path template, resolved from the
+    endpoint the router picked, so ids in URLs don't create new series.
+    """
+
+    def __init__(self, app: ASGIApp, stats: HttpStats = http_stats):
+        self.app = app
+        self.stats = stats
+        self._templates = None
+
+    def _route(self, scope: Scope) -> str:
+        if self._templates is None:
+            self._templates = {
+                route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")
+            }
+        return self._templates.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        stats = self.stats
+        method = scope["method"]
+        stats.in_flight[method] += 1
+        received = sent = 0
+        status_code = 500
+        headers = ()
+        trace = None
+        token = None
+        if METRICS_TRACING:
+            trace = Trace()
+            token = _trace.set(trace)
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message):
+            nonlocal sent, status_code, headers
+            kind = message["type"]
+            if kind == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif kind == "http.response.start":
+                status_code = message["status"]
+                headers = message.get("headers", ())
+                if trace is not None and trace.phases:
+                    message["headers"] = list(headers) + [
+                        (b"server-timing", trace.server_timing().encode("latin-1"))
+                    ]
+            elif kind == "http.response.zerocopy":
+                sent += message.get("count") or 0
+            elif kind == "http.response.pathsend":
+                sent += next((int(value) for name, value in headers if name.lower() == b"content-length"), 0)
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.in_flight[method] -= 1
+            route = self._route(scope)
+            stats.observe(method, route, status_code, elapsed)
+            if received:
+                stats.request_bytes[route] += received
+                if received >= THROUGHPUT_MIN_BYTES:
+                    THROUGHPUT.labels("upload").observe(received / elapsed)
+            if sent:
+                stats.response_bytes[route] += sent
+                if sent >= THROUGHPUT_MIN_BYTES:
+                    THROUGHPUT.labels("download").observe(sent / elapsed)
+            if trace is not None:
+                _trace.reset(token)
+                for phase, phase_seconds in trace.phases.items():
+                    PHASE_SECONDS.labels(route, phase).observe(phase_seconds)
+                logger.debug("%s %s %d %.1fms %s", method, route, status_code, elapsed * 1000, trace.server_timing())
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the driver sends.
+
+    Motor runs pymongo in a context copied from the calling task, so the
+    request's trace is visible here.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        command = event.command
+        if event.command_name == "getMore":
+            collection = command.get("collection")
+        else:
+            collection = command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1_000_000
+        MONGO_SECONDS.labels(event.command_name, collection).observe(seconds)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add("db", seconds)
+
+    def failed(self, event):
+        self._collections.pop((event.connection_id, event.request_id), None)
+        MONGO_FAILURES.labels(event.command_name).inc()
+        trace = _trace.get()
+        if trace is not None:
+            trace.add("db", event.duration_micros / 1_000_000)
+
+
+def mongo_listeners() -> list:
+    """Event listeners to pass to the Mongo client"""
+    return [MongoCommandMetrics()] if METRICS_ENABLED else []
+
+
+class InstrumentedStorage(StorageDriver):
+    """Times the operations of another storage driver"""
+
+    def __init__(self, driver: StorageDriver):
+        self.driver = driver
+
+    async def put(self, key: str, source: Path) -> str:
+        started = time.perf_counter()
+        with trace_phase("storage"):
+            try:
+                return await self.driver.put(key, source)
+            finally:
+                STORAGE_SECONDS.labels("put").observe(time.perf_counter() - started)
+
+    async def stat(self, location: str) -> Optional[StoredObject]:
+        started = time.perf_counter()
+        with trace_phase("storage"):
+            try:
+                return await self.driver.stat(location)
+            finally:
+                STORAGE_SECONDS.labels("stat").observe(time.perf_counter() - started)
+
+    async def read(self, location: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        # Only the time spent waiting on the driver counts, not the time
+        # the consumer takes between chunks
+        chunks = self.driver.read(location, start, length)
+        spent = 0.0
+        try:
+            while True:
+                began = time.perf_counter()
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    spent += time.perf_counter() - began
+                yield chunk
+        finally:
+            await chunks.aclose()
+            STORAGE_SECONDS.labels("read").observe(spent)
+            trace = _trace.get()
+            if trace is not None:
+                trace.add("storage", spent)
+
+    async def delete(self, location: str):
+        started = time.perf_counter()
+        try:
+            await self.driver.delete(location)
+        finally:
+            STORAGE_SECONDS.labels("delete").observe(time.perf_counter() - started)
+
+    async def list(self, after: str = "", limit: int = 1000) -> List[StoredObject]:
+        started = time.perf_counter()
+        try:
+            return await self.driver.list(after, limit)
+        finally:
+            STORAGE_SECONDS.labels("list").observe(time.perf_counter() - started)
+
+    async def quarantine(self, location: str) -> str:
+        started = time.perf_counter()
+        try:
+            return await self.driver.quarantine(location)
+        finally:
+            STORAGE_SECONDS.labels("quarantine").observe(time.perf_counter() - started)
+
+    def local_path(self, location: str) -> Optional[str]:
+        return self.driver.local_path(location)
+
+    async def presigned_url(
+        self, location: str, filename: str, media_type: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        return await self.driver.presigned_url(location, filename, media_type, encoding)
+
+
+def instrument_storage(driver: StorageDriver) -> StorageDriver:
+    return InstrumentedStorage(driver) if METRICS_ENABLED else driver
+
+
+class StateCollector:
+    """Exposes counters the application already keeps, read at scrape time"""
+
+    def __init__(self):
+        # Keyed by name, so registering again on restart replaces the source
+        self._sources = {}
+
+    def gauge(self, name: str, documentation: str, value: Callable[[], float]):
+        self._sources[name] = (GaugeMetricFamily, documentation, value)
+
+    def counter(self, name: str, documentation: str, value: Callable[[], float]):
+        self._sources[name] = (CounterMetricFamily, documentation, value)
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        for name, (family, documentation, value) in list(self._sources.items()):
+            try:
+                yield family(name, documentation, value=value())
+            except Exception:
+                logger.exception("Could not collect %s", name)
+
+
+state_collector = StateCollector()
+if METRICS_ENABLED:
+    prometheus_client.REGISTRY.register(http_stats)
+    prometheus_client.REGISTRY.register(state_collector)
+
+
+async def monitor_event_loop(interval: float = EVENT_LOOP_LAG_INTERVAL):
+    """Measure how late a sleeping task wakes up, until cancelled"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        LOOP_LAG.set(lag)
+        LOOP_LAG_SECONDS.observe(lag)
+
+
+def metrics_response() -> Response:
+    return Response(prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
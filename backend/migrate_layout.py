@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from starlette.concurrency import run_in_threadpool
+
+from blobs import BLOB_FANOUT_LEVELS, blob_key, fanout_path
+from settings import Settings
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_ID = "upload_layout"
+
+# Works on the local storage driver. Files are moved by hard-linking them at
+# the new location, pointing the metadata there with an update conditioned
+# on the old path, and only then unlinking the old name. Readers find the
+# file at one of the two names throughout (see LocalStorage), and a file
+# deleted mid-move keeps the name its delete queued. Progress is
+# checkpointed per batch, so the tool can be stopped and rerun at any time
+# while the API keeps serving.
+
+
+def _link(old: str, new: str):
+    """Give ``old`` a second name at ``new``"""
+    Path(new).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(old, new)
+    except FileExistsError:
+        # Left behind by an interrupted run; links and copies only ever
+        # appear complete, so it already holds the content
+        pass
+    except OSError:
+        # No hard links on this filesystem; fall back to a copy
+        shutil.copyfile(old, new + ".tmp")
+        os.replace(new + ".tmp", new)
+
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _load_checkpoint(db) -> dict:
+    checkpoint = await db.migrations.find_one({"_id": CHECKPOINT_ID}) or {}
+    if checkpoint.get("levels") != BLOB_FANOUT_LEVELS:
+        # A different target layout starts over; finished files are skipped
+        checkpoint = {"levels": BLOB_FANOUT_LEVELS}
+    return checkpoint
+
+
+async def _save_checkpoint(db, **progress):
+    await db.migrations.update_one(
+        {"_id": CHECKPOINT_ID},
+        {"$set": {"levels": BLOB_FANOUT_LEVELS, **progress}},
+        upsert=True
+    )
+
+
+async def migrate_blobs(db, upload_dir: Path, batch_size: int, pause: float) -> int:
+    """Move live blobs into the configured layout; returns how many moved"""
+    checkpoint = await _load_checkpoint(db)
+    after = checkpoint.get("blobs_after", "")
+    moved = 0
+    while True:
+        batch = await db.blobs.find(
+            {"_id": {"$gt": after}, "state": "live"},
+            {"path": 1, "encoding": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        for blob in batch:
+            old, new = blob["path"], str(upload_dir / blob_key(blob["_id"], blob.get("encoding")))
+            if old == new:
+                continue
+            try:
+                await run_in_threadpool(_link, old, new)
+            except FileNotFoundError:
+                logger.warning("Blob %s is missing from %s", blob["_id"], old)
+                continue
+            # Blobs released since they were read keep their old name,
+            # which is the one the reclaimer was given
+            result = await db.blobs.update_one(
+                {"_id": blob["_id"], "path": old, "state": "live"},
+                {"$set": {"path": new}}
+            )
+            if result.modified_count == 0:
+                await run_in_threadpool(_unlink, new)
+                continue
+            await db.files.update_many({"sha256": blob["_id"], "path": old}, {"$set": {"path": new}})
+            await run_in_threadpool(_unlink, old)
+            moved += 1
+        after = batch[-1]["_id"]
+        await _save_checkpoint(db, blobs_after=after)
+        if pause:
+            await asyncio.sleep(pause)
+    return moved
+
+
+async def migrate_files(db, upload_dir: Path, batch_size: int, pause: float) -> int:
+    """Point files at their blob's new path and move pre-blob-store files.
+
+    Returns how many files documents were updated.
+    """
+    checkpoint = await _load_checkpoint(db)
+    query = {}
+    if checkpoint.get("files_after"):
+        query["_id"] = {"$gt": checkpoint["files_after"]}
+    updated = 0
+    while True:
+        batch = await db.files.find(query, {"path": 1, "sha256": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        digests = [doc["sha256"] for doc in batch if doc.get("sha256")]
+        blob_paths = {}
+        async for blob in db.blobs.find({"_id": {"$in": digests}}, {"path": 1}):
+            blob_paths[blob["_id"]] = blob["path"]
+
+        updates = []
+        for doc in batch:
+            if doc.get("sha256"):
+                # Linked to the blob while the blob was being moved
+                target = blob_paths.get(doc["sha256"])
+                if target and target != doc["path"]:
+                    updates.append(UpdateOne({"_id": doc["_id"], "path": doc["path"]}, {"$set": {"path": target}}))
+                continue
+            old = doc["path"]
+            new = str(fanout_path(upload_dir, os.path.basename(old)))
+            if old == new:
+                continue
+            try:
+                await run_in_threadpool(_link, old, new)
+            except FileNotFoundError:
+                logger.warning("File %s is missing from %s", doc["_id"], old)
+                continue
+            result = await db.files.update_one({"_id": doc["_id"], "path": old}, {"$set": {"path": new}})
+            # A file deleted since it was read keeps its old name
+            await run_in_threadpool(_unlink, old if result.modified_count else new)
+            updated += result.modified_count
+        if updates:
+            result = await db.files.bulk_write(updates, ordered=False)
+            updated += result.modified_count
+        query["_id"] = {"$gt": batch[-1]["_id"]}
+        await _save_checkpoint(db, files_after=batch[-1]["_id"])
+        if pause:
+            await asyncio.sleep(pause)
+    return updated
+
+
+async def migrate_layout(db, upload_dir: Path, batch_size: int = 500, pause: float = 0.0) -> dict:
+    """Move everything under ``upload_dir`` into the configured fan-out layout"""
+    # A finished migration is run again from the start, e.g. to pick up
+    # files linked to a blob while it was being moved
+    await db.migrations.delete_one({"_id": CHECKPOINT_ID, "completed": True})
+    blobs = await migrate_blobs(db, upload_dir, batch_size, pause)
+    files = await migrate_files(db, upload_dir, batch_size, pause)
+    await _save_checkpoint(db, completed=True)
+    return {"blobs_moved": blobs, "files_updated": files}
+
+
+async def _main(batch_size: int, pause: float, restart: bool):
+    settings = Settings.from_env()
+    client = AsyncIOMotorClient(settings.mongo_url, **settings.mongo_options())
+    db = client[settings.db_name]
+    try:
+        if restart:
+            await db.migrations.delete_one({"_id": CHECKPOINT_ID})
+        result = await migrate_layout(db, settings.upload_dir, batch_size, pause)
+    finally:
+        client.close()
+    print(f"{result['blobs_moved']} blobs moved, {result['files_updated']} files updated "
+          f"({BLOB_FANOUT_LEVELS}-level layout)")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Move uploads into the BLOB_FANOUT_LEVELS directory layout")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    args = parser.parse_args()
+    asyncio.run(_main(args.batch_size, args.pause, args.restart))
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, List
+from typing import Dict, Optional, List
 from datetime import datetime
 from bson import ObjectId
 
@@ -68,6 +68,67 @@ class FileUpload(BaseModel):
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
 
+class InstantUpload(BaseModel):
+    sha256: str = Field(..., pattern=r"^[0-9a-f]{64}$")
+    size: int = Field(..., ge=0)
+    filename: str = Field(..., min_length=1, max_length=255)
+    mime_type: str = Field(default="application/octet-stream")
+    folder_id: Optional[str] = None
+
+class BulkDelete(BaseModel):
+    # Either explicit ids or a filter over the caller's files
+    file_ids: Optional[List[str]] = Field(default=None, max_length=100000)
+    mime_type: Optional[str] = None
+    uploaded_before: Optional[datetime] = None
+
+class BulkDeleteResponse(BaseModel):
+    deleted: int
+    bytes_freed: int
+
+class ArchiveRequest(BaseModel):
+    file_ids: List[str] = Field(..., min_length=1)
+    name: str = Field(default="files", min_length=1, max_length=255)
+
+class ShareRequest(BaseModel):
+    expires_in_hours: Optional[int] = Field(default=None, ge=1, le=8760)
+    # Permanent links survive sharing the file again; they stop working
+    # while it is unshared and end when it is deleted
+    revocable: bool = True
+
+class ShareResponse(BaseModel):
+    url: str
+    token: str
+    expires_at: datetime
+    revocable: bool
+
+class FolderCreate(BaseModel):
+    name: str = Field(..., min_length=1, max_length=255)
+    parent_id: Optional[str] = None  # None or "root" for the top level
+
+class FolderUpdate(BaseModel):
+    name: Optional[str] = Field(default=None, min_length=1, max_length=255)
+    # Omit to stay put, "root" to move to the top level
+    parent_id: Optional[str] = None
+
+class FolderCrumb(BaseModel):
+    id: str
+    name: str
+
+class FolderResponse(BaseModel):
+    id: str
+    name: str
+    parent_id: Optional[str] = None
+    path: List[FolderCrumb] = Field(default_factory=list)  # ancestors from the top down
+    size: int  # bytes in the whole subtree
+    file_count: int
+    folder_count: int
+    created_at: datetime
+    updated_at: datetime
+
+class FileMove(BaseModel):
+    file_ids: List[str] = Field(..., min_length=1, max_length=10000)
+    folder_id: str  # "root" for the top level
+
 class FileResponse(BaseModel):
     id: str
     filename: str
@@ -76,6 +137,8 @@ class FileResponse(BaseModel):
     mime_type: str
     is_shared: bool
     uploaded_at: datetime
+    has_thumbnail: bool = False
+    parent_id: Optional[str] = None
 
 class DashboardStats(BaseModel):
     total_files: int
@@ -83,4 +146,24 @@ class DashboardStats(BaseModel):
     shared_files: int
     recent_uploads: int
     storage_used: int
-    storage_limit: int
\ No newline at end of file
+    storage_limit: int
+    bytes_by_family: Dict[str, int] = Field(default_factory=dict)
+
+class UploadSessionCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., ge=0)
+    mime_type: str = Field(default="application/octet-stream")
+    chunk_size: Optional[int] = Field(default=None, ge=1048576, le=67108864)  # 1MB - 64MB
+    folder_id: Optional[str] = None
+
+class UploadSessionResponse(BaseModel):
+    id: str
+    filename: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int]
+    received_bytes: int
+    status: str
+    expires_at: datetime
+    file_id: Optional[str] = None
@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+# Reservations not committed or released within this time are swept, e.g.
+# when the worker holding one dies mid-upload
+RESERVATION_TTL = timedelta(minutes=int(os.environ.get("QUOTA_RESERVATION_TTL_MINUTES", "60")))
+SWEEP_INTERVAL_SECONDS = 300
+# Bodies without a Content-Length the quota can cover start with a
+# reservation of this size, and grow by at least as much at a time
+RESERVATION_STEP = int(os.environ.get("QUOTA_RESERVATION_STEP_MB", "64")) * 1024 * 1024
+
+# Storage accounting lives on the user document: storage_used counts stored
+# files, storage_reserved the bytes promised to uploads in flight, and each
+# outstanding promise is an entry in the reservations array. Every change
+# touches that one document, so a reservation is a single conditional
+# update and concurrent uploads can never oversubscribe storage_limit.
+
+
+@dataclass
+class Reservation:
+    id: ObjectId
+    user_id: ObjectId
+    size: int
+
+
+def _fits(size: int) -> dict:
+    return {"$expr": {"$lte": [
+        {"$add": ["$storage_used", {"$ifNull": ["$storage_reserved", 0]}, size]},
+        "$storage_limit"
+    ]}}
+
+
+def _quota_exceeded() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="Storage limit exceeded"
+    )
+
+
+async def available_bytes(db, user_id) -> int:
+    """Bytes that can still be reserved, read fresh from the database"""
+    user = await db.users.find_one(
+        {"_id": user_id},
+        {"storage_used": 1, "storage_reserved": 1, "storage_limit": 1}
+    )
+    if not user:
+        return 0
+    return max(0, user["storage_limit"] - user["storage_used"] - user.get("storage_reserved", 0))
+
+
+async def reserve_quota(db, user_id, size: int, ttl: timedelta = RESERVATION_TTL) -> Reservation:
+    """Atomically set aside ``size`` bytes of the user's quota, or raise 413"""
+    reservation = Reservation(id=ObjectId(), user_id=user_id, size=size)
+    update = {
+        "$inc": {"storage_reserved": size},
+        "$push": {"reservations": {
+            "_id": reservation.id,
+            "size": size,
+            "expires_at": datetime.utcnow() + ttl
+        }}
+    }
+    result = await db.users.update_one({"_id": user_id, **_fits(size)}, update)
+    if result.modified_count == 0:
+        # Expired reservations may be holding the quota; free them and retry once
+        if not await sweep_expired_reservations(db, user_id):
+            raise _quota_exceeded()
+        result = await db.users.update_one({"_id": user_id, **_fits(size)}, update)
+        if result.modified_count == 0:
+            raise _quota_exceeded()
+    return reservation
+
+
+async def reserve_remaining_quota(
+    db, user_id, ttl: timedelta = RESERVATION_TTL, limit: Optional[int] = None
+) -> Reservation:
+    """Reserve whatever quota is left, but no more than ``limit`` bytes"""
+    for _ in range(3):
+        size = await available_bytes(db, user_id)
+        if limit is not None:
+            size = min(size, limit)
+        if size == 0:
+            raise _quota_exceeded()
+        try:
+            return await reserve_quota(db, user_id, size, ttl)
+        except HTTPException:
+            # Another upload took some of it in the meantime
+            continue
+    raise _quota_exceeded()
+
+
+async def grow_reservation(db, reservation: Reservation, size: int, ttl: timedelta = RESERVATION_TTL) -> bool:
+    """Enlarge a reservation to ``size`` bytes and push back its expiry.
+
+    Returns False, leaving the reservation as it was, if the quota can't
+    cover the difference or the reservation has already expired.
+    """
+    delta = size - reservation.size
+    result = await db.users.update_one(
+        {"_id": reservation.user_id, "reservations._id": reservation.id, **_fits(delta)},
+        {
+            "$inc": {"storage_reserved": delta, "reservations.$.size": delta},
+            "$set": {"reservations.$.expires_at": datetime.utcnow() + ttl}
+        }
+    )
+    if result.modified_count == 0:
+        return False
+    reservation.size = size
+    return True
+
+
+class BodyQuota:
+    """Keeps a reservation ahead of a request body as it streams in.
+
+    ``ensure`` is called with the bytes received so far. It only touches
+    the database when they outgrow the reservation, or to renew it once a
+    quarter of its TTL has passed, so an upload that keeps sending never
+    loses its reservation however long it takes.
+    """
+
+    def __init__(self, db, reservation: Reservation, ttl: timedelta = RESERVATION_TTL):
+        self.db = db
+        self.reservation = reservation
+        self.ttl = ttl
+        self._renewed = time.monotonic()
+
+    async def ensure(self, size: int) -> bool:
+        """Whether ``size`` bytes are covered, growing the reservation if needed"""
+        if size > self.reservation.size:
+            target = max(size, self.reservation.size + RESERVATION_STEP)
+            # Near the limit a whole step may not fit when the bytes do
+            if not await grow_reservation(self.db, self.reservation, target, self.ttl):
+                if target == size or not await grow_reservation(self.db, self.reservation, size, self.ttl):
+                    return False
+            self._renewed = time.monotonic()
+        elif time.monotonic() - self._renewed > self.ttl.total_seconds() / 4:
+            await extend_reservation(self.db, self.reservation, datetime.utcnow() + self.ttl)
+            self._renewed = time.monotonic()
+        return True
+
+
+async def reserve_for_body(db, user_id, content_length: Optional[int]) -> BodyQuota:
+    """Reserve quota for a request body that is about to be streamed in.
+
+    The Content-Length is an upper bound on the stored size, so it is
+    reserved whole when the quota covers it. Otherwise (no length, or the
+    multipart framing alone pushes it past the quota) at most one
+    RESERVATION_STEP is reserved up front and the reservation grows with
+    the body, so one upload never holds quota it hasn't received yet.
+    """
+    if content_length is not None:
+        try:
+            return BodyQuota(db, await reserve_quota(db, user_id, content_length))
+        except HTTPException:
+            pass
+    limit = RESERVATION_STEP if content_length is None else min(content_length, RESERVATION_STEP)
+    return BodyQuota(db, await reserve_remaining_quota(db, user_id, limit=limit))
+
+
+async def commit_reservation(db, reservation: Reservation, used: int):
+    """Turn a reservation into stored usage of ``used`` bytes (at most its size).
+
+    Raises 409 if the reservation already expired, in which case the caller
+    must discard what it stored.
+    """
+    result = await db.users.update_one(
+        {"_id": reservation.user_id, "reservations._id": reservation.id},
+        {
+            "$pull": {"reservations": {"_id": reservation.id}},
+            "$inc": {"storage_reserved": -reservation.size, "storage_used": min(used, reservation.size)}
+        }
+    )
+    if result.modified_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload took too long, please retry"
+        )
+
+
+async def release_reservation(db, reservation: Optional[Reservation]):
+    """Give back a reservation that will not be used; safe to call twice"""
+    if reservation is None:
+        return
+    await db.users.update_one(
+        {"_id": reservation.user_id, "reservations._id": reservation.id},
+        {
+            "$pull": {"reservations": {"_id": reservation.id}},
+            "$inc": {"storage_reserved": -reservation.size}
+        }
+    )
+
+
+async def extend_reservation(db, reservation: Reservation, expires_at: datetime):
+    """Push back the expiry of a reservation held by a long-lived upload"""
+    await db.users.update_one(
+        {"_id": reservation.user_id, "reservations._id": reservation.id},
+        {"$set": {"reservations.$.expires_at": expires_at}}
+    )
+
+
+async def refund_quota(db, user_id, size: int):
+    """Return committed bytes whose file could not be saved after all"""
+    if size:
+        await db.users.update_one({"_id": user_id}, {"$inc": {"storage_used": -size}})
+
+
+async def sweep_expired_reservations(db, user_id=None) -> int:
+    """Release every expired reservation; returns how many were released"""
+    now = datetime.utcnow()
+    query = {"reservations.expires_at": {"$lt": now}}
+    if user_id is not None:
+        query["_id"] = user_id
+    released = 0
+    async for user in db.users.find(query, {"reservations": 1}):
+        for entry in user["reservations"]:
+            if entry["expires_at"] >= now:
+                continue
+            # Matching on the entry makes this a no-op if the upload
+            # committed or released it in the meantime
+            result = await db.users.update_one(
+                {"_id": user["_id"], "reservations": {"$elemMatch": {"_id": entry["_id"], "expires_at": {"$lt": now}}}},
+                {
+                    "$pull": {"reservations": {"_id": entry["_id"]}},
+                    "$inc": {"storage_reserved": -entry["size"]}
+                }
+            )
+            released += result.modified_count
+    return released
+
+
+async def run_reservation_sweeper(db):
+    """Periodically release reservations left behind by abandoned uploads"""
+    while True:
+        try:
+            released = await sweep_expired_reservations(db)
+            if released:
+                logger.info("Released %d expired quota reservations", released)
+        except Exception:
+            logger.exception("Quota reservation sweep failed")
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
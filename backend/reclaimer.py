@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from blobs import enqueue_reclaim
+from thumbnails import drop_thumbnails
+
+logger = logging.getLogger(__name__)
+
+RECLAIM_BATCH_SIZE = int(os.environ.get("RECLAIM_BATCH_SIZE", "500"))
+RECLAIM_WORKERS = int(os.environ.get("RECLAIM_WORKERS", "4"))
+RECLAIM_INTERVAL_SECONDS = 5
+# Entries held by a reclaimer that died are retried after this long
+RECLAIM_LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 10
+
+
+class Reclaimer:
+    """Background worker that physically deletes files queued in reclaim_queue.
+
+    The queue lives in Mongo, so pending work survives restarts. Entries are
+    leased in batches, deleted from storage a few at a time and only removed
+    from the queue once done; deleting is idempotent, so an entry retried
+    after a crash is harmless.
+    """
+
+    def __init__(self, db, storage, workers: int = RECLAIM_WORKERS, batch_size: int = RECLAIM_BATCH_SIZE):
+        self.db = db
+        self.storage = storage
+        self.batch_size = batch_size
+        self.reclaimed = 0
+        self._limit = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+
+    def wake(self):
+        """Start on newly queued work without waiting for the next interval"""
+        self._wakeup.set()
+
+    async def _lease_batch(self):
+        now = datetime.utcnow()
+        candidates = await self.db.reclaim_queue.find(
+            {"lease_until": {"$lte": now}},
+            {"_id": 1}
+        ).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+        owner = uuid.uuid4().hex
+        await self.db.reclaim_queue.update_many(
+            {"_id": {"$in": [c["_id"] for c in candidates]}, "lease_until": {"$lte": now}},
+            {"$set": {"lease_until": now + RECLAIM_LEASE, "owner": owner}, "$inc": {"attempts": 1}}
+        )
+        return await self.db.reclaim_queue.find({"owner": owner}).to_list(self.batch_size)
+
+    async def _claim_blobs(self, entries) -> set:
+        """Digests of the batch's blobs that may be unlinked"""
+        digests = list({entry["sha256"] for entry in entries if entry.get("sha256")})
+        if not digests:
+            return set()
+        # Blobs revived by a new upload since they were queued are live again
+        # and are left alone
+        await self.db.blobs.update_many(
+            {"_id": {"$in": digests}, "state": "deleting"},
+            {"$set": {"state": "unlinking"}}
+        )
+        claimed = await self.db.blobs.find(
+            {"_id": {"$in": digests}, "state": "unlinking"},
+            {"_id": 1}
+        ).to_list(len(digests))
+        return {blob["_id"] for blob in claimed}
+
+    async def _delete(self, location: str):
+        async with self._limit:
+            await self.storage.delete(location)
+
+    async def process_batch(self) -> int:
+        """Reclaim one batch; returns the number of queue entries handled"""
+        entries = await self._lease_batch()
+        if not entries:
+            return 0
+
+        claimed_blobs = await self._claim_blobs(entries)
+        to_unlink = [
+            entry for entry in entries
+            if not entry.get("sha256") or entry["sha256"] in claimed_blobs
+        ]
+        results = await asyncio.gather(
+            *(self._delete(entry["path"]) for entry in to_unlink),
+            return_exceptions=True
+        )
+
+        failed = set()
+        for entry, result in zip(to_unlink, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not reclaim %s: %s", entry["path"], result)
+                if entry["attempts"] < MAX_ATTEMPTS:
+                    failed.add(entry["_id"])
+                    if entry.get("sha256"):
+                        claimed_blobs.discard(entry["sha256"])
+
+        if claimed_blobs:
+            await self.db.blobs.delete_many({"_id": {"$in": list(claimed_blobs)}, "state": "unlinking"})
+            # Their thumbnails go through the queue like any other file
+            await enqueue_reclaim(self.db, [
+                {"path": location} for location in await drop_thumbnails(self.db, claimed_blobs)
+            ])
+        # Failed blobs go back to "deleting" so they can still be revived
+        # while the entry waits for its retry
+        retry_blobs = [entry["sha256"] for entry in to_unlink if entry["_id"] in failed and entry.get("sha256")]
+        if retry_blobs:
+            await self.db.blobs.update_many(
+                {"_id": {"$in": retry_blobs}, "state": "unlinking"},
+                {"$set": {"state": "deleting"}}
+            )
+        done = [entry["_id"] for entry in entries if entry["_id"] not in failed]
+        await self.db.reclaim_queue.delete_many({"_id": {"$in": done}})
+        self.reclaimed += len(done)
+        return len(entries)
+
+    async def run(self):
+        """Process the queue until cancelled"""
+        while True:
+            # Cleared before reading the queue so a wake() during the batch
+            # isn't lost
+            self._wakeup.clear()
+            try:
+                handled = await self.process_batch()
+            except Exception:
+                logger.exception("Reclaimer batch failed")
+                handled = 0
+            if handled >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), RECLAIM_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
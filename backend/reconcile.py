@@ -0,0 +1,380 @@
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from auth import invalidate_principal
+from blobs import release_blobs
+from folders import record_folder_files
+from settings import Settings
+from stats import record_files_removed
+from storage import StorageDriver, StoredObject, create_storage
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", "500"))
+# Hours between background passes; 0 leaves reconciling to the CLI
+RECONCILE_INTERVAL_HOURS = float(os.environ.get("RECONCILE_INTERVAL_HOURS", "0"))
+# Background passes only log what they find unless this is set
+RECONCILE_APPLY = os.environ.get("RECONCILE_APPLY", "false").lower() == "true"
+RECONCILE_PAUSE_SECONDS = float(os.environ.get("RECONCILE_PAUSE_SECONDS", "0.1"))
+# Objects written more recently than this may belong to an upload whose
+# metadata isn't saved yet, so they are never treated as orphans
+ORPHAN_GRACE = timedelta(hours=float(os.environ.get("RECONCILE_GRACE_HOURS", "6")))
+STAT_CONCURRENCY = 16
+# Examples kept in a report per kind of problem
+REPORT_SAMPLES = 20
+
+CHECKPOINT_ID = "storage_reconcile"
+LEASE_ID = "storage_reconcile_lease"
+
+# A pass has three phases, each checkpointed so an interrupted pass resumes
+# where it stopped:
+#   1. walk storage in the driver's order and quarantine objects that no
+#      blob, thumbnail, files document or reclaim entry points at
+#   2. walk db.files by _id and set aside documents whose content is gone,
+#      moving them to db.quarantined_files and undoing their accounting
+#   3. recompute every user's storage_used from db.files and fix the drift
+# Nothing is deleted: quarantined objects keep their key under
+# QUARANTINE_DIR and quarantined documents keep their _id, so either can be
+# restored by hand.
+
+
+@dataclass
+class Findings:
+    """One kind of problem: how many, how many bytes, and a few examples"""
+    count: int = 0
+    bytes: int = 0
+    fixed: int = 0
+    samples: List[str] = field(default_factory=list)
+
+    def add(self, sample: str, size: int = 0):
+        self.count += 1
+        self.bytes += size
+        if len(self.samples) < REPORT_SAMPLES:
+            self.samples.append(sample)
+
+
+@dataclass
+class ReconcileReport:
+    applied: bool
+    # Whether the pass picked up from a checkpoint rather than the start
+    resumed: bool = False
+    orphans: Findings = field(default_factory=Findings)
+    dangling: Findings = field(default_factory=Findings)
+    usage: Findings = field(default_factory=Findings)
+
+    def summary(self) -> str:
+        return (
+            f"{self.orphans.count} orphaned objects ({self.orphans.bytes} bytes, {self.orphans.fixed} quarantined), "
+            f"{self.dangling.count} files without content ({self.dangling.fixed} quarantined), "
+            f"{self.usage.count} users with wrong storage_used ({self.usage.fixed} fixed)"
+        )
+
+
+async def _load_checkpoint(db, apply: bool) -> dict:
+    checkpoint = await db.migrations.find_one({"_id": CHECKPOINT_ID}) or {}
+    if checkpoint.get("apply") != apply:
+        # Dry runs and fixing runs don't resume each other
+        checkpoint = {}
+    return checkpoint
+
+
+async def _save_checkpoint(db, apply: bool, **progress):
+    await db.migrations.update_one(
+        {"_id": CHECKPOINT_ID},
+        {"$set": {"apply": apply, "updated_at": datetime.utcnow(), **progress}},
+        upsert=True
+    )
+
+
+def _object_name(location: str) -> str:
+    return location.rsplit("/", 1)[-1]
+
+
+async def unreferenced(db, objects: List[StoredObject]) -> List[StoredObject]:
+    """The objects nothing in the database points at.
+
+    Objects are matched by name, since a file can sit at either the flat or
+    the fan-out location of its name while the layout is being migrated.
+    Blobs are named after their digest (plus an encoding suffix) and
+    thumbnails after their source's digest, so both are found by _id.
+    """
+    names = {_object_name(obj.location) for obj in objects}
+    digests = list({name.split(".", 1)[0].split("-", 1)[0] for name in names})
+    referenced = set()
+    async for blob in db.blobs.find({"_id": {"$in": digests}}, {"path": 1}):
+        referenced.add(_object_name(blob["path"]))
+    async for thumb in db.thumbnails.find({"_id": {"$in": digests}, "path": {"$exists": True}}, {"path": 1}):
+        referenced.add(_object_name(thumb["path"]))
+    # Files stored before the blob store are named after their filename
+    async for doc in db.files.find({"filename": {"$in": list(names)}}, {"path": 1}):
+        referenced.add(_object_name(doc["path"]))
+    # Already on its way out
+    async for entry in db.reclaim_queue.find({"path": {"$in": [obj.location for obj in objects]}}, {"path": 1}):
+        referenced.add(_object_name(entry["path"]))
+    return [obj for obj in objects if _object_name(obj.location) not in referenced]
+
+
+async def _quarantine_object(db, storage: StorageDriver, obj: StoredObject) -> bool:
+    # Checked again right before moving, as an upload may have written
+    # the same key since the batch was listed
+    current = await storage.stat(obj.location)
+    if current is None or current.location != obj.location:
+        return False
+    if current.modified is not None and current.modified > datetime.utcnow() - ORPHAN_GRACE:
+        return False
+    if not await unreferenced(db, [current]):
+        return False
+    try:
+        target = await storage.quarantine(obj.location)
+    except FileNotFoundError:
+        return False
+    logger.info("Quarantined orphaned object %s as %s", obj.location, target)
+    return True
+
+
+async def scan_objects(db, storage: StorageDriver, report: ReconcileReport, after: str,
+                       batch_size: int, pause: float) -> str:
+    """Phase 1: find, and with ``report.applied`` quarantine, orphaned objects"""
+    while True:
+        batch = await storage.list(after, batch_size)
+        if not batch:
+            return after
+        cutoff = datetime.utcnow() - ORPHAN_GRACE
+        settled = [obj for obj in batch if obj.modified is None or obj.modified <= cutoff]
+        for obj in await unreferenced(db, settled):
+            report.orphans.add(obj.location, obj.size)
+            logger.info("Orphaned object %s (%d bytes)", obj.location, obj.size)
+            if report.applied and await _quarantine_object(db, storage, obj):
+                report.orphans.fixed += 1
+        after = batch[-1].location
+        await _save_checkpoint(db, report.applied, objects_after=after)
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def _missing(storage: StorageDriver, locations) -> set:
+    """Which of ``locations`` no longer exist in storage"""
+    limit = asyncio.Semaphore(STAT_CONCURRENCY)
+
+    async def check(location):
+        async with limit:
+            return location, await storage.stat(location)
+
+    results = await asyncio.gather(*(check(location) for location in locations))
+    return {location for location, stored in results if stored is None}
+
+
+async def quarantine_files(db, docs: List[dict]) -> int:
+    """Move files documents to db.quarantined_files and undo their accounting.
+
+    Documents deleted or re-pointed since they were read are left alone.
+    Returns how many were moved.
+    """
+    token = ObjectId()
+    for doc in docs:
+        await db.files.update_one(
+            {"_id": doc["_id"], "path": doc["path"], "deleting": {"$exists": False}},
+            {"$set": {"deleting": token}}
+        )
+    ids = [doc["_id"] for doc in docs]
+    claimed = await db.files.find({"_id": {"$in": ids}, "deleting": token}).to_list(None)
+    if not claimed:
+        return 0
+    now = datetime.utcnow()
+    await db.quarantined_files.bulk_write([
+        ReplaceOne({"_id": doc["_id"]}, {**doc, "quarantined_at": now}, upsert=True)
+        for doc in claimed
+    ], ordered=False)
+    await db.files.delete_many({"_id": {"$in": ids}, "deleting": token})
+
+    by_user = defaultdict(list)
+    for doc in claimed:
+        by_user[doc["user_id"]].append(doc)
+    for user_id, user_docs in by_user.items():
+        await record_files_removed(db, user_id, user_docs)
+        await db.users.update_one(
+            {"_id": user_id},
+            {"$inc": {"storage_used": -sum(doc["size"] for doc in user_docs)}}
+        )
+        invalidate_principal(user_id)
+    await record_folder_files(db, claimed, -1)
+    # The blobs are missing their bytes too; unreferenced ones are queued
+    # for the reclaimer, which tolerates nothing being there
+    await release_blobs(db, [doc["sha256"] for doc in claimed if doc.get("sha256")])
+    for doc in claimed:
+        logger.info("Quarantined files document %s, its content %s is missing", doc["_id"], doc["path"])
+    return len(claimed)
+
+
+async def scan_files(db, storage: StorageDriver, report: ReconcileReport, after: Optional[ObjectId],
+                     batch_size: int, pause: float) -> Optional[ObjectId]:
+    """Phase 2: find, and with ``report.applied`` quarantine, files without content"""
+    while True:
+        # Files being deleted are skipped; their content may already be gone
+        query = {"deleting": {"$exists": False}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        batch = await db.files.find(
+            query, {"user_id": 1, "path": 1, "size": 1}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return after
+        missing = await _missing(storage, {doc["path"] for doc in batch})
+        dangling = [doc for doc in batch if doc["path"] in missing]
+        for doc in dangling:
+            report.dangling.add(f"{doc['_id']} -> {doc['path']}", doc["size"])
+            logger.info("Files document %s points at missing %s", doc["_id"], doc["path"])
+        if report.applied and dangling:
+            report.dangling.fixed += await quarantine_files(db, dangling)
+        after = batch[-1]["_id"]
+        await _save_checkpoint(db, report.applied, files_after=after)
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def usage_drift(db, batch_size: int = RECONCILE_BATCH_SIZE):
+    """Yield (user_id, stored, actual) for each user whose storage_used is off"""
+    # Totals are summed in the database, so only drifting users come back
+    rows = db.files.aggregate([
+        {"$group": {"_id": "$user_id", "actual": {"$sum": "$size"}}},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "_id", "as": "user"}},
+        {"$unwind": "$user"},
+        {"$project": {"actual": 1, "stored": "$user.storage_used"}},
+        {"$match": {"$expr": {"$ne": ["$stored", "$actual"]}}},
+    ], allowDiskUse=True)
+    async for row in rows:
+        yield row["_id"], row["stored"], row["actual"]
+
+    # Users with no files left don't appear in the grouping above
+    after = None
+    while True:
+        query = {"storage_used": {"$ne": 0}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        users = await db.users.find(query, {"storage_used": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not users:
+            return
+        owners = set(await db.files.distinct("user_id", {"user_id": {"$in": [user["_id"] for user in users]}}))
+        for user in users:
+            if user["_id"] not in owners:
+                yield user["_id"], user["storage_used"], 0
+        after = users[-1]["_id"]
+
+
+async def fix_usage(db, report: ReconcileReport, batch_size: int):
+    """Phase 3: report, and with ``report.applied`` correct, storage_used drift"""
+    async for user_id, stored, actual in usage_drift(db, batch_size):
+        report.usage.add(f"{user_id}: storage_used {stored}, files total {actual}", abs(actual - (stored or 0)))
+        logger.info("User %s has storage_used %s but %d bytes of files", user_id, stored, actual)
+        if not report.applied:
+            continue
+        # Left alone if an upload or delete changed it in the meantime;
+        # the next pass looks again
+        result = await db.users.update_one(
+            {"_id": user_id, "storage_used": stored},
+            {"$set": {"storage_used": actual}}
+        )
+        if result.modified_count:
+            report.usage.fixed += 1
+            invalidate_principal(user_id)
+
+
+async def reconcile(db, storage: StorageDriver, apply: bool = False, batch_size: int = RECONCILE_BATCH_SIZE,
+                    pause: float = 0.0, restart: bool = False) -> ReconcileReport:
+    """Run one pass, continuing an interrupted one unless ``restart``.
+
+    Without ``apply`` nothing is changed and the report is the diff a
+    fixing pass would act on.
+    """
+    checkpoint = {} if restart else await _load_checkpoint(db, apply)
+    report = ReconcileReport(applied=apply, resumed=bool(checkpoint))
+    if not checkpoint.get("objects_done"):
+        await scan_objects(db, storage, report, checkpoint.get("objects_after", ""), batch_size, pause)
+        await _save_checkpoint(db, apply, objects_done=True)
+    await scan_files(db, storage, report, checkpoint.get("files_after"), batch_size, pause)
+    await fix_usage(db, report, batch_size)
+    await db.migrations.delete_one({"_id": CHECKPOINT_ID})
+    return report
+
+
+async def _acquire_lease(db, owner: str, duration: timedelta) -> bool:
+    """Whether this worker may run the background pass; one worker at a time"""
+    now = datetime.utcnow()
+    try:
+        await db.migrations.update_one(
+            {"_id": LEASE_ID, "until": {"$lte": now}},
+            {"$set": {"owner": owner, "until": now + duration}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Held by another worker
+        return False
+    return True
+
+
+async def run_reconciler(db, storage: StorageDriver, interval_hours: float = RECONCILE_INTERVAL_HOURS,
+                         apply: bool = RECONCILE_APPLY):
+    """Reconcile storage every ``interval_hours`` until cancelled"""
+    owner = uuid.uuid4().hex
+    interval = timedelta(hours=interval_hours)
+    while True:
+        await asyncio.sleep(interval.total_seconds())
+        try:
+            if not await _acquire_lease(db, owner, interval):
+                continue
+            report = await reconcile(db, storage, apply=apply, pause=RECONCILE_PAUSE_SECONDS)
+            logger.info("Storage reconciliation%s: %s", "" if apply else " (report only)", report.summary())
+        except Exception:
+            logger.exception("Storage reconciliation failed")
+
+
+def _print_findings(title: str, findings: Findings):
+    print(f"{title}: {findings.count}" + (f" ({findings.bytes} bytes)" if findings.bytes else ""))
+    for sample in findings.samples:
+        print(f"  {sample}")
+    if findings.count > len(findings.samples):
+        print(f"  ... and {findings.count - len(findings.samples)} more")
+
+
+async def _main(apply: bool, batch_size: int, pause: float, restart: bool):
+    # Same database and storage the API is configured with
+    settings = Settings.from_env()
+    client = AsyncIOMotorClient(settings.mongo_url, **settings.mongo_options())
+    db = client[settings.db_name]
+    try:
+        report = await reconcile(
+            db, create_storage(settings.upload_dir), apply, batch_size, pause, restart
+        )
+    finally:
+        client.close()
+    if report.resumed:
+        print("Continued an interrupted pass; findings before the checkpoint are not listed")
+    _print_findings("Orphaned objects", report.orphans)
+    _print_findings("Files without content", report.dangling)
+    _print_findings("Users with wrong storage_used", report.usage)
+    print(report.summary() if apply else "Nothing changed; rerun with --apply to fix")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(
+        description="Find orphaned stored objects, files whose content is missing and storage_used drift"
+    )
+    parser.add_argument("--apply", action="store_true", help="quarantine orphans and fix usage after reporting")
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    args = parser.parse_args()
+    asyncio.run(_main(args.apply, args.batch_size, args.pause, args.restart))
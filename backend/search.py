@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import re
+import unicodedata
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from settings import Settings
+
+# Matches ranked per query; results past this are not returned, and the
+# response says so
+SEARCH_MAX_CANDIDATES = int(os.environ.get("SEARCH_MAX_CANDIDATES", "2000"))
+DEFAULT_SEARCH_LIMIT = 50
+MAX_SEARCH_LIMIT = 500
+MAX_QUERY_TERMS = 8
+# Tokens kept per name; the rest of very long names isn't searchable
+MAX_NAME_TOKENS = 32
+
+_WORD = re.compile(r"[^\W_]+")
+_LETTERS_OR_DIGITS = re.compile(r"[^\W\d_]+|\d+")
+
+# Each file stores its name normalized ("name_key") and split into words
+# ("name_tokens"). A query matches files holding a token that starts with
+# each of its terms, found through the multikey (user_id, name_tokens)
+# index: an anchored regex scans only the index range for that prefix.
+# Files holding every term as a whole word are fetched first, by equality
+# on the same index, so a common prefix matching far more files than
+# SEARCH_MAX_CANDIDATES can't crowd them out; prefix-only matches fill the
+# rest of the candidates, which are ranked in process.
+
+
+def normalize(text: str) -> str:
+    """Case- and accent-insensitive form of a name or query"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+def name_tokens(name: str) -> List[str]:
+    """Words of a normalized name, plus the letter and digit runs of each.
+
+    "IMG_2024-05-Café.JPG" gives img, 2024, 05, cafe, jpg, and
+    "report2024" also gives report and 2024.
+    """
+    tokens = []
+    for word in _WORD.findall(name):
+        tokens.append(word)
+        parts = _LETTERS_OR_DIGITS.findall(word)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return list(dict.fromkeys(tokens))[:MAX_NAME_TOKENS]
+
+
+def search_fields(original_name: str) -> dict:
+    """Fields stored on db.files so the name can be searched"""
+    key = normalize(original_name)
+    return {"name_key": key, "name_tokens": name_tokens(key)}
+
+
+def parse_query(q: str) -> Tuple[str, List[str]]:
+    """(normalized phrase, terms) of a search string"""
+    phrase = normalize(q).strip()
+    terms = list(dict.fromkeys(_WORD.findall(phrase)))[:MAX_QUERY_TERMS]
+    if not terms:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Search for at least one letter or digit"
+        )
+    return phrase, terms
+
+
+def search_query(user_id, terms: List[str], mime_filter=None) -> dict:
+    # Longest term first: the planner bounds the index scan on one of
+    # them, and longer prefixes are usually the rarer ones
+    clauses = [
+        {"name_tokens": {"$regex": f"^{re.escape(term)}"}}
+        for term in sorted(terms, key=len, reverse=True)
+    ]
+    query = {"user_id": user_id, "$and": clauses}
+    if mime_filter:
+        query["mime_type"] = mime_filter
+    return query
+
+
+def exact_query(user_id, terms: List[str], mime_filter=None) -> dict:
+    """Files holding every term as a whole word"""
+    query = {"user_id": user_id, "name_tokens": {"$all": terms}}
+    if mime_filter:
+        query["mime_type"] = mime_filter
+    return query
+
+
+def score(doc: dict, phrase: str, terms: List[str]) -> float:
+    """Relevance of a matching file; higher is better"""
+    key = doc.get("name_key", "")
+    value = 0.0
+    if phrase == key or phrase == key.rsplit(".", 1)[0]:
+        value += 100
+    elif key.startswith(phrase):
+        value += 10
+    # Whole words count for more than words merely starting with a term
+    tokens = set(doc.get("name_tokens", ()))
+    for term in terms:
+        value += 20 if term in tokens else 8
+    # Among equally good matches, shorter names are more specific
+    return value - 0.5 * len(tokens)
+
+
+def rank(docs: List[dict], phrase: str, terms: List[str]) -> List[dict]:
+    """Best matches first, newest first among equals"""
+    epoch = datetime.min
+    docs.sort(key=lambda doc: doc.get("uploaded_at") or epoch, reverse=True)
+    docs.sort(key=lambda doc: score(doc, phrase, terms), reverse=True)
+    return docs
+
+
+def encode_search_cursor(phrase: str, offset: int) -> str:
+    raw = json.dumps([phrase, offset], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str, phrase: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_phrase, offset = json.loads(raw)
+        offset = int(offset)
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    if cursor_phrase != phrase:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor was issued for a different search"
+        )
+    return offset
+
+
+async def search_files(
+    db,
+    user_id,
+    q: str,
+    projection: dict,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+    cursor: Optional[str] = None,
+    mime_filter=None,
+) -> Tuple[List[dict], Optional[str], bool]:
+    """One page of the user's files matching ``q``, best first.
+
+    Returns the page, the next cursor and whether more files matched than
+    SEARCH_MAX_CANDIDATES, in which case some prefix-only matches were
+    left out of the ranking.
+    """
+    phrase, terms = parse_query(q)
+    offset = decode_search_cursor(cursor, phrase) if cursor else 0
+    fields = {**projection, "name_key": 1, "name_tokens": 1, "uploaded_at": 1}
+    # One more than needed tells whether anything was left out
+    candidates = await db.files.find(
+        exact_query(user_id, terms, mime_filter), fields
+    ).limit(SEARCH_MAX_CANDIDATES + 1).to_list(SEARCH_MAX_CANDIDATES + 1)
+    remaining = SEARCH_MAX_CANDIDATES - len(candidates)
+    if remaining > 0:
+        prefix = search_query(user_id, terms, mime_filter)
+        prefix["$and"].append({"name_tokens": {"$not": {"$all": terms}}})
+        candidates += await db.files.find(prefix, fields).limit(remaining + 1).to_list(remaining + 1)
+    truncated = len(candidates) > SEARCH_MAX_CANDIDATES
+    ranked = rank(candidates[:SEARCH_MAX_CANDIDATES], phrase, terms)
+    page = ranked[offset:offset + limit]
+    next_cursor = None
+    if offset + limit < len(ranked):
+        next_cursor = encode_search_cursor(phrase, offset + limit)
+    return page, next_cursor, truncated
+
+
+async def index_names(db, batch_size: int = 1000, pause: float = 0.0) -> int:
+    """Add the search fields to files stored before search existed.
+
+    Safe to stop and rerun; returns how many files were updated.
+    """
+    updated = 0
+    after = None
+    while True:
+        query = {"name_tokens": {"$exists": False}}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        batch = await db.files.find(query, {"original_name": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        result = await db.files.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": search_fields(doc["original_name"])})
+            for doc in batch
+        ], ordered=False)
+        updated += result.modified_count
+        after = batch[-1]["_id"]
+        if pause:
+            await asyncio.sleep(pause)
+    return updated
+
+
+async def _main(batch_size: int, pause: float):
+    # Same database the API is configured with
+    settings = Settings.from_env()
+    client = AsyncIOMotorClient(settings.mongo_url, **settings.mongo_options())
+    db = client[settings.db_name]
+    try:
+        updated = await index_names(db, batch_size, pause)
+    finally:
+        client.close()
+    print(f"{updated} files made searchable")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Make files uploaded before search existed searchable")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    asyncio.run(_main(args.batch_size, args.pause))
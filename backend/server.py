@@ -1,43 +1,78 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status
-from fastapi.responses import FileResponse as FastAPIFileResponse
-from dotenv import load_dotenv
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, status
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import asyncio
 import os
+import secrets
+import time
 import logging
-from pathlib import Path
-from typing import List
-import uuid
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
 from datetime import datetime
-import shutil
 
 # Import our models and auth
 from models import *
-from auth import hash_password, verify_password, create_access_token, get_current_user
-
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
-
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
-# Create upload directory
-UPLOAD_DIR = ROOT_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
+from auth import (
+    PRINCIPAL_FIELDS, create_access_token, get_current_user, get_token_principal, invalidate_principal,
+    needs_rehash, password_hasher, principal_cache, TOKEN_CLAIMS_ENABLED
+)
+from ingest import receive_file, receive_files, FailedFile
+from downloads import FILE_CONTENT_FIELDS, file_download_response, content_disposition
+from thumbnails import (
+    ThumbnailWorker, THUMBNAIL_MEDIA_TYPE, can_thumbnail, request_thumbnails, thumbnail_etag
+)
+from archive import ArchiveEntry, MAX_ARCHIVE_FILES, archive_names, stream_zip
+from indexes import ensure_indexes
+from stats import (
+    record_files_added, record_files_removed, record_folders_change, record_shared_change, get_user_stats
+)
+from listing import (
+    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, SORT_FIELDS, LIST_FIELDS,
+    DefaultJSONResponse, parse_fields, encode_cursor, json_response, mime_type_filter, page_query,
+    stream_json_array
+)
+from search import DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, normalize, search_fields, search_files
+from folders import (
+    adjust_totals, ancestor_names, check_depth, encode_folder_cursor, folder_crumbs, folder_document,
+    folder_page_query, get_folder, lineage, move_folder, parse_folder_id, record_folder_files, resolve_folder,
+    subtree_ids
+)
+from blobs import hash_file, acquire_blob, store_blob, release_blob, release_blobs, enqueue_reclaim
+from reclaimer import Reclaimer
+from reconcile import RECONCILE_INTERVAL_HOURS, run_reconciler
+from storage import create_storage, STORAGE_REDIRECT_DOWNLOADS
+from sharing import (
+    SHARE_CACHE_TTL_SECONDS, resolve_share, share_cache, share_expiry, sign_share, verify_share
+)
+from compression import accepts_encoding, read_content
+from metrics import (
+    METRICS_ENABLED, MetricsMiddleware, instrument_storage, metrics_response, mongo_listeners,
+    monitor_event_loop, state_collector
+)
+from quota import (
+    Reservation, reserve_quota, reserve_for_body, commit_reservation, release_reservation,
+    extend_reservation, refund_quota, run_reservation_sweeper
+)
+from chunked_upload import (
+    DEFAULT_CHUNK_SIZE, SESSION_TTL, COMMIT_TIMEOUT, COMMIT_WAIT_ATTEMPTS, COMMIT_WAIT_INTERVAL_SECONDS,
+    chunk_count, chunk_length, partial_path, create_partial, claim_chunk_write, release_chunk_write,
+    no_active_writers, write_chunk, discard_partial, run_session_gc
+)
+from settings import Settings
+from dependencies import get_db, get_reclaimer, get_settings, get_storage, get_thumbnailer
 
-# Create the main app without a prefix
-app = FastAPI()
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "10000"))
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Authentication routes
 @api_router.post("/auth/register")
-async def register(user_data: UserRegister):
+async def register(user_data: UserRegister, db=Depends(get_db)):
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_data.email})
+    existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -45,33 +80,60 @@ async def register(user_data: UserRegister):
         )
     
     # Hash password and create user
-    hashed_password = hash_password(user_data.password)
+    hashed_password = await password_hasher.hash(user_data.password)
     user_dict = {
         "name": user_data.name,
         "email": user_data.email,
         "password": hashed_password,
         "storage_used": 0,
+        "storage_reserved": 0,
         "storage_limit": 1099511627776,  # 1TB
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
-    result = await db.users.insert_one(user_dict)
+    try:
+        result = await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration of the same email
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
     
     return {"message": "User registered successfully", "user_id": str(result.inserted_id)}
 
 @api_router.post("/auth/login")
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, db=Depends(get_db)):
     # Find user by email
-    user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["password"]):
+    user = await db.users.find_one(
+        {"email": credentials.email},
+        {"password": 1, **PRINCIPAL_FIELDS}
+    )
+    if not user or not await password_hasher.verify(credentials.password, user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password"
         )
     
+    # Upgrade the stored hash when the configured work factor has changed;
+    # best effort, so a busy hashing pool doesn't fail the login
+    if needs_rehash(user["password"]):
+        try:
+            new_hash = await password_hasher.hash(credentials.password)
+        except HTTPException:
+            new_hash = None
+        if new_hash:
+            await db.users.update_one(
+                {"_id": user["_id"], "password": user["password"]},
+                {"$set": {"password": new_hash, "updated_at": datetime.utcnow()}}
+            )
+    
     # Create access token
-    access_token = create_access_token({"user_id": str(user["_id"])})
+    claims = {"user_id": str(user["_id"])}
+    if TOKEN_CLAIMS_ENABLED:
+        claims.update(name=user["name"], email=user["email"])
+    access_token = create_access_token(claims)
     
     user_response = UserResponse(
         id=str(user["_id"]),
@@ -97,117 +159,719 @@ async def get_current_user_info(current_user=Depends(get_current_user)):
         storage_limit=current_user["storage_limit"]
     )
 
+def file_document(user_id, blob: dict, original_name: str, size: int, mime_type: str, parent_id=None) -> dict:
+    """Metadata stored in db.files for a file backed by ``blob``"""
+    return {
+        "user_id": user_id,
+        "filename": blob["_id"],
+        "original_name": original_name,
+        "size": size,
+        "stored_size": blob.get("stored_size", size),
+        "encoding": blob.get("encoding"),
+        "sha256": blob["_id"],
+        "mime_type": mime_type,
+        "path": blob["path"],
+        "parent_id": parent_id,
+        "is_shared": False,
+        "share_link": None,
+        "has_thumbnail": can_thumbnail(mime_type),
+        "uploaded_at": datetime.utcnow(),
+        **search_fields(original_name)
+    }
+
+async def queue_thumbnails(db, thumbnailer: ThumbnailWorker, file_docs: List[dict]):
+    """Have previews rendered in the background for new files"""
+    if await request_thumbnails(db, file_docs):
+        thumbnailer.wake()
+
+def request_content_length(request: Request) -> Optional[int]:
+    length = request.headers.get("content-length", "")
+    return int(length) if length.isdigit() else None
+
 # File management routes
 @api_router.post("/files/upload")
 async def upload_file(
-    file: UploadFile = File(...),
-    current_user=Depends(get_current_user)
+    request: Request,
+    folder_id: Optional[str] = None,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    storage=Depends(get_storage),
+    settings: Settings = Depends(get_settings),
+    thumbnailer: ThumbnailWorker = Depends(get_thumbnailer)
 ):
-    # Check storage limit
-    if current_user["storage_used"] + file.size > current_user["storage_limit"]:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail="Storage limit exceeded"
+    parent = await resolve_folder(db, current_user["_id"], folder_id)
+    
+    # Quota is set aside before any bytes are accepted, so parallel uploads
+    # can't overshoot it; the reservation grows as the body streams in.
+    quota = await reserve_for_body(db, current_user["_id"], request_content_length(request))
+    reservation = quota.reservation
+    try:
+        # Stream the body to local staging, then into storage
+        upload = await receive_file(request, settings.partial_dir, quota)
+        
+        # Content we already have is linked instead of stored twice
+        blob = await store_blob(
+            db, storage, upload.path, upload.sha256, upload.size, upload.encoding, upload.stored_size
+        )
+    except BaseException:
+        await release_reservation(db, reservation)
+        raise
+    
+    # Charge the actual size and hand back the rest of the reservation
+    try:
+        await commit_reservation(db, reservation, upload.size)
+    except HTTPException:
+        await release_blob(db, blob["_id"])
+        raise
+    
+    # Save file metadata to database
+    file_dict = file_document(
+        current_user["_id"], blob, upload.original_name, upload.size, upload.content_type,
+        parent_id=parent and parent["_id"]
+    )
+    
+    result = await db.files.insert_one(file_dict)
+    await record_files_added(db, current_user["_id"], [file_dict])
+    await record_folder_files(db, [file_dict], 1)
+    invalidate_principal(current_user["_id"])
+    await queue_thumbnails(db, thumbnailer, [file_dict])
+    
+    return {
+        "message": "File uploaded successfully",
+        "file_id": str(result.inserted_id),
+        "filename": upload.original_name
+    }
+
+@api_router.post("/files/batch")
+async def upload_files_batch(
+    request: Request,
+    folder_id: Optional[str] = None,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    storage=Depends(get_storage),
+    settings: Settings = Depends(get_settings),
+    thumbnailer: ThumbnailWorker = Depends(get_thumbnailer)
+):
+    parent = await resolve_folder(db, current_user["_id"], folder_id)
+    
+    # Files are written as they stream in and deduplicated while the next
+    # one is still arriving; metadata is written in bulk at the end.
+    quota = await reserve_for_body(db, current_user["_id"], request_content_length(request))
+    reservation = quota.reservation
+    
+    async def store(upload):
+        return await store_blob(
+            db, storage, upload.path, upload.sha256, upload.size, upload.encoding, upload.stored_size
+        )
+    
+    try:
+        received = await receive_files(
+            request, settings.partial_dir, quota, max_files=MAX_BATCH_FILES, on_file=store
+        )
+    except BaseException:
+        await release_reservation(db, reservation)
+        raise
+    
+    results = []
+    file_docs = []
+    for item in received:
+        if isinstance(item, FailedFile):
+            results.append({"filename": item.original_name, "status": "failed", "detail": item.detail})
+            continue
+        upload, blob = item
+        file_dict = file_document(
+            current_user["_id"], blob, upload.original_name, upload.size, upload.content_type,
+            parent_id=parent and parent["_id"]
         )
+        file_dict["_id"] = ObjectId()
+        file_docs.append(file_dict)
+        results.append({"filename": upload.original_name, "status": "uploaded", "file_id": str(file_dict["_id"])})
     
-    # Generate unique filename
-    file_extension = Path(file.filename).suffix
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
+    # Charge what was stored for the whole batch at once
+    try:
+        await commit_reservation(db, reservation, sum(doc["size"] for doc in file_docs))
+    except HTTPException:
+        await release_blobs(db, [doc["sha256"] for doc in file_docs])
+        raise
+    
+    if file_docs:
+        try:
+            await db.files.insert_many(file_docs, ordered=False)
+        except BulkWriteError as e:
+            failed_ids = {file_docs[error["index"]]["_id"] for error in e.details["writeErrors"]}
+            await release_blobs(db, [doc["sha256"] for doc in file_docs if doc["_id"] in failed_ids])
+            for result in results:
+                if result.get("file_id") and ObjectId(result["file_id"]) in failed_ids:
+                    result.update(status="failed", detail="Could not save file metadata")
+                    del result["file_id"]
+            await refund_quota(db, current_user["_id"], sum(
+                doc["size"] for doc in file_docs if doc["_id"] in failed_ids
+            ))
+            file_docs = [doc for doc in file_docs if doc["_id"] not in failed_ids]
+    
+    if file_docs:
+        await record_files_added(db, current_user["_id"], file_docs)
+        await record_folder_files(db, file_docs, 1)
+        invalidate_principal(current_user["_id"])
+        await queue_thumbnails(db, thumbnailer, file_docs)
     
-    # Save file to disk
+    return {
+        "message": f"{len(file_docs)} of {len(results)} files uploaded",
+        "uploaded": len(file_docs),
+        "failed": len(results) - len(file_docs),
+        "files": results
+    }
+
+@api_router.post("/files/instant")
+async def instant_upload(
+    file_data: InstantUpload,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    thumbnailer: ThumbnailWorker = Depends(get_thumbnailer)
+):
+    parent = await resolve_folder(db, current_user["_id"], file_data.folder_id)
+    reservation = await reserve_quota(db, current_user["_id"], file_data.size)
+    
+    # Clients that already know the digest of content we store skip the transfer
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-    except Exception as e:
+        blob = await acquire_blob(db, file_data.sha256, file_data.size)
+    except BaseException:
+        await release_reservation(db, reservation)
+        raise
+    if not blob:
+        await release_reservation(db, reservation)
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Could not upload file: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Content not found, upload the file instead"
         )
+    try:
+        await commit_reservation(db, reservation, file_data.size)
+    except HTTPException:
+        await release_blob(db, blob["_id"])
+        raise
     
     # Save file metadata to database
-    file_dict = {
+    file_dict = file_document(
+        current_user["_id"], blob, file_data.filename, file_data.size, file_data.mime_type,
+        parent_id=parent and parent["_id"]
+    )
+    
+    result = await db.files.insert_one(file_dict)
+    await record_files_added(db, current_user["_id"], [file_dict])
+    await record_folder_files(db, [file_dict], 1)
+    invalidate_principal(current_user["_id"])
+    await queue_thumbnails(db, thumbnailer, [file_dict])
+    
+    return {
+        "message": "File uploaded successfully",
+        "file_id": str(result.inserted_id),
+        "filename": file_data.filename
+    }
+
+# Chunked upload routes
+def upload_session_response(session: dict) -> UploadSessionResponse:
+    received = sorted(session["received"])
+    return UploadSessionResponse(
+        id=str(session["_id"]),
+        filename=session["original_name"],
+        size=session["size"],
+        chunk_size=session["chunk_size"],
+        total_chunks=session["total_chunks"],
+        received_chunks=received,
+        received_bytes=sum(chunk_length(session, index) for index in received),
+        status=session["status"],
+        expires_at=session["expires_at"],
+        file_id=str(session["file_id"]) if session["status"] == "committed" else None
+    )
+
+def session_reservation(session: dict) -> Reservation:
+    return Reservation(id=session["reservation_id"], user_id=session["user_id"], size=session["size"])
+
+async def get_upload_session(db, session_id: str, current_user: dict) -> dict:
+    session = None
+    if ObjectId.is_valid(session_id):
+        session = await db.upload_sessions.find_one({
+            "_id": ObjectId(session_id),
+            "user_id": current_user["_id"]
+        })
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upload session not found"
+        )
+    return session
+
+@api_router.post("/uploads", response_model=UploadSessionResponse)
+async def create_upload_session(
+    session_data: UploadSessionCreate,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    settings: Settings = Depends(get_settings)
+):
+    parent = await resolve_folder(db, current_user["_id"], session_data.folder_id)
+    # The session holds its quota until it is committed, aborted or expires
+    reservation = await reserve_quota(db, current_user["_id"], session_data.size, ttl=SESSION_TTL)
+    
+    chunk_size = session_data.chunk_size or DEFAULT_CHUNK_SIZE
+    now = datetime.utcnow()
+    session = {
         "user_id": current_user["_id"],
-        "filename": unique_filename,
-        "original_name": file.filename,
-        "size": file.size,
-        "mime_type": file.content_type,
-        "path": str(file_path),
-        "is_shared": False,
-        "share_link": None,
-        "uploaded_at": datetime.utcnow()
+        "file_id": ObjectId(),  # Fixed up front so commit inserts exactly once
+        "original_name": session_data.filename,
+        "mime_type": session_data.mime_type,
+        "parent_id": parent and parent["_id"],
+        "size": session_data.size,
+        "chunk_size": chunk_size,
+        "total_chunks": chunk_count(session_data.size, chunk_size),
+        "received": [],
+        "reservation_id": reservation.id,
+        "status": "open",
+        "created_at": now,
+        "expires_at": now + SESSION_TTL
     }
+    try:
+        result = await db.upload_sessions.insert_one(session)
+    except BaseException:
+        await release_reservation(db, reservation)
+        raise
+    session["_id"] = result.inserted_id
     
-    result = await db.files.insert_one(file_dict)
+    try:
+        await create_partial(partial_path(settings.partial_dir, result.inserted_id), session_data.size)
+    except OSError as e:
+        await db.upload_sessions.delete_one({"_id": result.inserted_id})
+        await release_reservation(db, reservation)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Could not create upload session: {str(e)}"
+        )
+    
+    return upload_session_response(session)
+
+@api_router.get("/uploads/{session_id}", response_model=UploadSessionResponse)
+async def get_upload_session_status(session_id: str, current_user=Depends(get_token_principal), db=Depends(get_db)):
+    session = await get_upload_session(db, session_id, current_user)
+    return upload_session_response(session)
+
+@api_router.put("/uploads/{session_id}/chunks/{index}")
+async def upload_chunk(
+    session_id: str,
+    index: int,
+    request: Request,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db),
+    settings: Settings = Depends(get_settings)
+):
+    session = await get_upload_session(db, session_id, current_user)
+    if session["status"] != "open":
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload session is {session['status']}"
+        )
+    if session["expires_at"] < datetime.utcnow():
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Upload session expired"
+        )
+    if not 0 <= index < session["total_chunks"]:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Chunk index out of range"
+        )
+    
+    # Commit can't start while this claim is held
+    claim_id = await claim_chunk_write(db, session["_id"])
+    if claim_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is no longer open"
+        )
     
-    # Update user storage usage
-    await db.users.update_one(
-        {"_id": current_user["_id"]},
-        {"$inc": {"storage_used": file.size}}
+    # Chunks land directly at their offset in the preallocated file
+    expected = chunk_length(session, index)
+    try:
+        await write_chunk(
+            request,
+            partial_path(settings.partial_dir, session["_id"]),
+            offset=index * session["chunk_size"],
+            expected=expected
+        )
+    except BaseException:
+        await release_chunk_write(db, session["_id"], claim_id)
+        raise
+    
+    result = await release_chunk_write(db, session["_id"], claim_id, index)
+    if result.matched_count == 0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload session is no longer open"
+        )
+    # Keep the quota reservation alive as long as the session
+    if "reservation_id" in session:
+        await extend_reservation(db, session_reservation(session), datetime.utcnow() + SESSION_TTL)
+    
+    return {"message": "Chunk received", "index": index, "size": expected}
+
+@api_router.post("/uploads/{session_id}/commit")
+async def commit_upload_session(
+    session_id: str,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    storage=Depends(get_storage),
+    settings: Settings = Depends(get_settings),
+    thumbnailer: ThumbnailWorker = Depends(get_thumbnailer)
+):
+    session = await get_upload_session(db, session_id, current_user)
+    if session["status"] == "committed":
+        return {
+            "message": "File uploaded successfully",
+            "file_id": str(session["file_id"]),
+            "filename": session["original_name"]
+        }
+    
+    missing = session["total_chunks"] - len(session["received"])
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"{missing} chunks have not been received"
+        )
+    
+    # Only one request can move the session out of "open", and only once
+    # no chunk is still being written into the file about to become a blob
+    for attempt in range(COMMIT_WAIT_ATTEMPTS):
+        now = datetime.utcnow()
+        claimed = await db.upload_sessions.find_one_and_update(
+            {"_id": session["_id"], "status": "open", **no_active_writers(now)},
+            {"$set": {"status": "committing", "expires_at": now + COMMIT_TIMEOUT}}
+        )
+        if claimed:
+            break
+        current = await db.upload_sessions.find_one({"_id": session["_id"]}, {"status": 1})
+        if not current or current["status"] != "open":
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Upload session is already being committed"
+            )
+        await asyncio.sleep(COMMIT_WAIT_INTERVAL_SECONDS)
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Chunks are still being written, please retry"
+        )
+    
+    # Chunks arrive out of order, so the digest needs one read pass here;
+    # the bytes themselves are renamed into the blob store, not copied.
+    part_path = partial_path(settings.partial_dir, session["_id"])
+    try:
+        sha256 = await hash_file(part_path)
+        blob = await store_blob(db, storage, part_path, sha256, session["size"])
+    except OSError as e:
+        await db.upload_sessions.update_one(
+            {"_id": session["_id"]},
+            {"$set": {"status": "open", "expires_at": datetime.utcnow() + SESSION_TTL}}
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Could not assemble file: {str(e)}"
+        )
+    
+    # Sessions created before quota reservations are charged directly
+    if "reservation_id" in session:
+        try:
+            await commit_reservation(db, session_reservation(session), session["size"])
+        except HTTPException:
+            await release_blob(db, blob["_id"])
+            # Collected by the session GC on its next pass
+            await db.upload_sessions.update_one(
+                {"_id": session["_id"]},
+                {"$set": {"status": "expired", "expires_at": datetime.utcnow()}}
+            )
+            raise
+    else:
+        await db.users.update_one(
+            {"_id": current_user["_id"]},
+            {"$inc": {"storage_used": session["size"]}}
+        )
+    
+    # Save file metadata to database
+    file_dict = file_document(
+        current_user["_id"], blob, session["original_name"], session["size"], session["mime_type"],
+        parent_id=session.get("parent_id")
+    )
+    file_dict["_id"] = session["file_id"]
+    try:
+        await db.files.insert_one(file_dict)
+    except DuplicateKeyError:
+        # Already inserted by an earlier attempt
+        await release_blob(db, blob["_id"])
+        await refund_quota(db, current_user["_id"], session["size"])
+    else:
+        await record_files_added(db, current_user["_id"], [file_dict])
+        await record_folder_files(db, [file_dict], 1)
+        await queue_thumbnails(db, thumbnailer, [file_dict])
+    invalidate_principal(current_user["_id"])
+    
+    await db.upload_sessions.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"status": "committed", "committed_at": datetime.utcnow()}}
     )
     
     return {
         "message": "File uploaded successfully",
-        "file_id": str(result.inserted_id),
-        "filename": file.filename
+        "file_id": str(session["file_id"]),
+        "filename": session["original_name"]
     }
 
-@api_router.get("/files", response_model=List[FileResponse])
-async def get_user_files(current_user=Depends(get_current_user)):
-    files_cursor = db.files.find({"user_id": current_user["_id"]})
-    files = await files_cursor.to_list(1000)
-    
-    return [
-        FileResponse(
-            id=str(file["_id"]),
-            filename=file["filename"],
-            original_name=file["original_name"],
-            size=file["size"],
-            mime_type=file["mime_type"],
-            is_shared=file["is_shared"],
-            uploaded_at=file["uploaded_at"]
-        )
-        for file in files
-    ]
+@api_router.delete("/uploads/{session_id}")
+async def abort_upload_session(
+    session_id: str,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    settings: Settings = Depends(get_settings)
+):
+    session = await get_upload_session(db, session_id, current_user)
+    claimed = await db.upload_sessions.find_one_and_update(
+        {"_id": session["_id"], "status": "open"},
+        {"$set": {"status": "aborted"}}
+    )
+    if not claimed:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload session is {session['status']}"
+        )
+    
+    await discard_partial(partial_path(settings.partial_dir, session["_id"]))
+    await db.upload_sessions.delete_one({"_id": session["_id"]})
+    if "reservation_id" in session:
+        await release_reservation(db, session_reservation(session))
+    
+    return {"message": "Upload session aborted"}
 
-@api_router.delete("/files/{file_id}")
-async def delete_file(file_id: str, current_user=Depends(get_current_user)):
-    # Find file
-    file_doc = await db.files.find_one({
-        "_id": ObjectId(file_id),
-        "user_id": current_user["_id"]
-    })
+@api_router.get("/files")
+async def get_user_files(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    sort: Literal["date", "name", "size"] = "date",
+    order: Literal["asc", "desc"] = "desc",
+    fields: Optional[str] = None,
+    folder_id: Optional[str] = None,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db)
+):
+    selected = parse_fields(fields)
+    query, sort_spec = page_query(current_user["_id"], sort, order, cursor)
+    # Without folder_id every file is listed; "root" is the top level
+    if folder_id is not None:
+        query["parent_id"] = parse_folder_id(folder_id)
+    sort_field = SORT_FIELDS[sort]
     
-    if not file_doc:
+    # Only fetch what is returned plus the keys the cursor is built from
+    projection = {LIST_FIELDS[name]: 1 for name in selected}
+    projection[sort_field] = 1
+    
+    # Peek at the last row of this page with a covered index scan so the
+    # next cursor can go in a header before the body starts streaming
+    headers = {}
+    tail = await db.files.find(query, {sort_field: 1, "_id": 1}).sort(sort_spec).skip(limit - 1).limit(2).to_list(2)
+    if len(tail) == 2:
+        headers["X-Next-Cursor"] = encode_cursor(sort, order, tail[0])
+    
+    files_cursor = db.files.find(query, projection).sort(sort_spec).limit(limit).batch_size(STREAM_BATCH_SIZE)
+    return StreamingResponse(
+        stream_json_array(files_cursor, selected),
+        media_type="application/json",
+        headers=headers
+    )
+
+@api_router.get("/files/search")
+async def search_user_files(
+    q: str = Query(..., min_length=1, max_length=200),
+    mime_type: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    fields: Optional[str] = None,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db)
+):
+    # Name search, best matches first; pages come from the same ranked
+    # candidates so the next cursor is just an offset
+    selected = parse_fields(fields)
+    page, next_cursor, truncated = await search_files(
+        db,
+        current_user["_id"],
+        q,
+        {LIST_FIELDS[name]: 1 for name in selected},
+        limit=limit,
+        cursor=cursor,
+        mime_filter=mime_type_filter(mime_type) if mime_type else None
+    )
+    rows = [{name: doc.get(LIST_FIELDS[name]) for name in selected} for doc in page]
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if truncated:
+        # More files matched than were ranked; some prefix-only ones are missing
+        headers["X-Search-Truncated"] = "true"
+    return json_response(rows, headers)
+
+# Files deleted per round trip by bulk delete
+BULK_DELETE_BATCH_SIZE = 1000
+
+async def remove_files(db, reclaimer: Reclaimer, user_id, query: dict) -> tuple:
+    """Delete the caller's files matching query in batches.
+
+    Each batch is claimed with a marker so concurrent deletes never count
+    the same file twice, removed with one delete_many and its bytes handed
+    to the reclaimer. Returns (files deleted, bytes freed).
+    """
+    deleted = freed = 0
+    while True:
+        token = ObjectId()
+        batch = await db.files.find(
+            {**query, "user_id": user_id, "deleting": {"$exists": False}},
+            {"_id": 1}
+        ).limit(BULK_DELETE_BATCH_SIZE).to_list(BULK_DELETE_BATCH_SIZE)
+        if not batch:
+            break
+        # Every query on the batch goes through _id, so none of them scan
+        batch_ids = [doc["_id"] for doc in batch]
+        await db.files.update_many(
+            {"_id": {"$in": batch_ids}, "deleting": {"$exists": False}},
+            {"$set": {"deleting": token}}
+        )
+        claimed = await db.files.find(
+            {"_id": {"$in": batch_ids}, "deleting": token},
+            {"size": 1, "mime_type": 1, "uploaded_at": 1, "is_shared": 1, "share_link": 1, "sha256": 1, "path": 1,
+             "parent_id": 1}
+        ).to_list(None)
+        if not claimed:
+            continue
+        await db.files.delete_many({"_id": {"$in": batch_ids}, "deleting": token})
+        for doc in claimed:
+            share_cache.invalidate(doc.get("share_link"))
+            share_cache.invalidate_file(doc["_id"])
+        await record_files_removed(db, user_id, claimed)
+        await record_folder_files(db, claimed, -1)
+        
+        # Blob references are dropped; files from before the blob store
+        # are queued for unlinking directly
+        await release_blobs(db, [doc["sha256"] for doc in claimed if doc.get("sha256")])
+        await enqueue_reclaim(db, [{"path": doc["path"]} for doc in claimed if not doc.get("sha256")])
+        deleted += len(claimed)
+        freed += sum(doc["size"] for doc in claimed)
+    
+    if deleted:
+        await db.users.update_one({"_id": user_id}, {"$inc": {"storage_used": -freed}})
+        invalidate_principal(user_id)
+        reclaimer.wake()
+    return deleted, freed
+
+@api_router.post("/files/bulk-delete", response_model=BulkDeleteResponse)
+async def bulk_delete_files(
+    request: BulkDelete,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    reclaimer: Reclaimer = Depends(get_reclaimer)
+):
+    query = {}
+    if request.file_ids is not None:
+        try:
+            query["_id"] = {"$in": [ObjectId(file_id) for file_id in request.file_ids]}
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid file id"
+            )
+    if request.mime_type:
+        query["mime_type"] = mime_type_filter(request.mime_type)
+    if request.uploaded_before:
+        query["uploaded_at"] = {"$lt": request.uploaded_before}
+    if not query:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Specify file_ids or a filter"
+        )
+    
+    deleted, freed = await remove_files(db, reclaimer, current_user["_id"], query)
+    return BulkDeleteResponse(deleted=deleted, bytes_freed=freed)
+
+@api_router.delete("/files/{file_id}")
+async def delete_file(
+    file_id: str,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    reclaimer: Reclaimer = Depends(get_reclaimer)
+):
+    deleted, _ = await remove_files(db, reclaimer, current_user["_id"], {"_id": ObjectId(file_id)})
+    if not deleted:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found"
         )
     
-    # Delete file from disk
-    try:
-        os.remove(file_doc["path"])
-    except FileNotFoundError:
-        pass  # File already deleted from disk
+    return {"message": "File deleted successfully"}
+
+async def stored_file_response(
+    request: Request,
+    storage,
+    location: str,
+    stored_size: int,
+    size: int,
+    encoding: Optional[str],
+    etag: str,
+    filename: str,
+    media_type: str,
+    last_modified: datetime,
+    cache_control: str = "private, no-cache"
+):
+    """Download response for the object at ``location`` holding a file of ``size`` bytes"""
+    # Compressed files go out as stored to clients that can decode them;
+    # everyone else, and range requests, get the original bytes
+    passthrough = bool(encoding) and accepts_encoding(request, encoding) and "range" not in request.headers
     
-    # Delete from database
-    await db.files.delete_one({"_id": ObjectId(file_id)})
+    # Let the client fetch the bytes from the storage service directly
+    if STORAGE_REDIRECT_DOWNLOADS and (passthrough or not encoding):
+        url = await storage.presigned_url(location, filename, media_type, encoding)
+        if url:
+            return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
     
-    # Update user storage usage
-    await db.users.update_one(
-        {"_id": current_user["_id"]},
-        {"$inc": {"storage_used": -file_doc["size"]}}
+    download = dict(
+        last_modified=last_modified,
+        filename=filename,
+        media_type=media_type,
+        vary="Accept-Encoding" if encoding else None,
+        cache_control=cache_control
+    )
+    if encoding and not passthrough:
+        return file_download_response(
+            request,
+            path=None,
+            reader=lambda start, length: read_content(storage, location, encoding, start, length),
+            size=size,
+            etag=etag,
+            **download
+        )
+    return file_download_response(
+        request,
+        path=storage.local_path(location),
+        reader=lambda start, length: storage.read(location, start, length),
+        size=stored_size,
+        etag=f"{etag}-{encoding}" if encoding else etag,
+        content_encoding=encoding,
+        **download
     )
-    
-    return {"message": "File deleted successfully"}
 
-@api_router.get("/files/{file_id}/download")
-async def download_file(file_id: str, current_user=Depends(get_current_user)):
+@api_router.api_route("/files/{file_id}/download", methods=["GET", "HEAD"])
+async def download_file(
+    file_id: str,
+    request: Request,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db),
+    storage=Depends(get_storage)
+):
     # Find file
-    file_doc = await db.files.find_one({
-        "_id": ObjectId(file_id),
-        "user_id": current_user["_id"]
-    })
+    file_doc = await db.files.find_one(
+        {"_id": ObjectId(file_id), "user_id": current_user["_id"]},
+        FILE_CONTENT_FIELDS
+    )
     
     if not file_doc:
         raise HTTPException(
@@ -215,29 +879,371 @@ async def download_file(file_id: str, current_user=Depends(get_current_user)):
             detail="File not found"
         )
     
-    if not os.path.exists(file_doc["path"]):
+    stored = await storage.stat(file_doc["path"])
+    if stored is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found on disk"
         )
     
-    return FastAPIFileResponse(
-        path=file_doc["path"],
+    return await stored_file_response(
+        request,
+        storage,
+        location=stored.location,
+        stored_size=stored.size,
+        size=file_doc["size"],
+        encoding=file_doc.get("encoding"),
+        # Blobs are content-addressed, so the digest is a strong validator
+        etag=file_doc.get("sha256") or f"{file_doc['_id']}-{stored.size}",
         filename=file_doc["original_name"],
-        media_type=file_doc["mime_type"]
+        media_type=file_doc["mime_type"],
+        last_modified=file_doc["uploaded_at"]
+    )
+
+@api_router.api_route("/files/{file_id}/thumbnail", methods=["GET", "HEAD"])
+async def get_thumbnail(
+    file_id: str,
+    request: Request,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db),
+    storage=Depends(get_storage),
+    thumbnailer: ThumbnailWorker = Depends(get_thumbnailer)
+):
+    file_doc = await db.files.find_one(
+        {"_id": ObjectId(file_id), "user_id": current_user["_id"]},
+        {"sha256": 1, "mime_type": 1, "original_name": 1}
+    )
+    if not file_doc:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    if not file_doc.get("sha256") or not can_thumbnail(file_doc["mime_type"]):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No preview for this file type"
+        )
+    
+    thumbnail = await db.thumbnails.find_one(
+        {"_id": file_doc["sha256"]},
+        {"state": 1, "path": 1, "size": 1, "rendered_at": 1}
+    )
+    if thumbnail is None:
+        # Files uploaded before previews existed are rendered on first view
+        await queue_thumbnails(db, thumbnailer, [file_doc])
+    if thumbnail is None or thumbnail["state"] == "pending":
+        return JSONResponse(
+            {"detail": "Preview is being generated"},
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={"Retry-After": "2"}
+        )
+    if thumbnail["state"] != "ready":
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No preview could be generated"
+        )
+    
+    # Named after the content, so it can be cached for good
+    stem = file_doc["original_name"].rsplit(".", 1)[0]
+    return file_download_response(
+        request,
+        path=storage.local_path(thumbnail["path"]),
+        reader=lambda start, length: storage.read(thumbnail["path"], start, length),
+        size=thumbnail["size"],
+        etag=thumbnail_etag(file_doc["sha256"]),
+        last_modified=thumbnail["rendered_at"],
+        filename=f"{stem}.jpg",
+        media_type=THUMBNAIL_MEDIA_TYPE,
+        cache_control="private, max-age=31536000, immutable",
+        disposition="inline"
     )
 
+@api_router.put("/files/{file_id}/share", response_model=ShareResponse)
+async def share_file(
+    file_id: str,
+    request: Request,
+    share: Optional[ShareRequest] = None,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db)
+):
+    share = share or ShareRequest()
+    # Sharing again issues a new link and retires the previous one
+    share_id = secrets.token_urlsafe(12)
+    expires_at = share_expiry(share.expires_in_hours)
+    previous = await db.files.find_one_and_update(
+        {"_id": ObjectId(file_id), "user_id": current_user["_id"], "deleting": {"$exists": False}},
+        {"$set": {"is_shared": True, "share_link": share_id, "share_expires_at": expires_at}},
+        projection={**FILE_CONTENT_FIELDS, "is_shared": 1, "share_link": 1}
+    )
+    if not previous:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    share_cache.invalidate(previous.get("share_link"))
+    if not previous.get("is_shared"):
+        # Permanent links to the file work again once it is shared
+        share_cache.invalidate_file(previous["_id"])
+        await record_shared_change(db, current_user["_id"], 1)
+    
+    token = sign_share(previous, share_id, expires_at, share.revocable)
+    return ShareResponse(
+        url=str(request.url_for("download_shared_file", token=token)),
+        token=token,
+        expires_at=expires_at,
+        revocable=share.revocable
+    )
+
+@api_router.delete("/files/{file_id}/share")
+async def unshare_file(file_id: str, current_user=Depends(get_current_user), db=Depends(get_db)):
+    previous = await db.files.find_one_and_update(
+        {"_id": ObjectId(file_id), "user_id": current_user["_id"], "is_shared": True},
+        {"$set": {"is_shared": False, "share_link": None}, "$unset": {"share_expires_at": ""}},
+        projection={"share_link": 1}
+    )
+    if previous:
+        share_cache.invalidate(previous.get("share_link"))
+        share_cache.invalidate_file(previous["_id"])
+        await record_shared_change(db, current_user["_id"], -1)
+    elif not await db.files.find_one({"_id": ObjectId(file_id), "user_id": current_user["_id"]}, {"_id": 1}):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    return {"message": "File is no longer shared"}
+
+@api_router.api_route("/s/{token}", methods=["GET", "HEAD"])
+async def download_shared_file(
+    token: str,
+    request: Request,
+    db=Depends(get_db),
+    storage=Depends(get_storage)
+):
+    # Public: the signature is the credential, and lookups are cached so
+    # a popular link doesn't cost a query per hit
+    claims = verify_share(token)
+    shared = await resolve_share(db, storage, claims)
+    # Shared caches may keep serving a link as long as a worker would
+    max_age = int(SHARE_CACHE_TTL_SECONDS)
+    
+    return await stored_file_response(
+        request,
+        storage,
+        location=shared.location,
+        stored_size=shared.stored_size,
+        size=shared.size,
+        encoding=shared.encoding,
+        etag=shared.sha256 or f"{shared.file_id}-{shared.stored_size}",
+        filename=shared.name,
+        media_type=shared.mime_type,
+        last_modified=shared.uploaded_at,
+        cache_control=f"public, max-age={max_age}"
+    )
+
+@api_router.post("/files/archive")
+async def download_archive(
+    request: ArchiveRequest,
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db),
+    storage=Depends(get_storage)
+):
+    if len(request.file_ids) > MAX_ARCHIVE_FILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_ARCHIVE_FILES} files per archive"
+        )
+    ids = [ObjectId(file_id) for file_id in request.file_ids if ObjectId.is_valid(file_id)]
+    files = {}
+    async for file_doc in db.files.find(
+        {"_id": {"$in": ids}, "user_id": current_user["_id"]},
+        {"original_name": 1, "path": 1, "size": 1, "encoding": 1, "mime_type": 1, "uploaded_at": 1}
+    ):
+        files[file_doc["_id"]] = file_doc
+    if not files:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    # Entries keep the order the ids were given in
+    docs = [files[file_id] for file_id in dict.fromkeys(ids) if file_id in files]
+    entries = [
+        ArchiveEntry(
+            name=name, path=doc["path"], size=doc["size"], mime_type=doc["mime_type"],
+            modified=doc["uploaded_at"], encoding=doc.get("encoding")
+        )
+        for doc, name in zip(docs, archive_names(doc["original_name"] for doc in docs))
+    ]
+    archive_name = request.name if request.name.lower().endswith(".zip") else f"{request.name}.zip"
+    return StreamingResponse(
+        stream_zip(entries, storage),
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(archive_name)}
+    )
+
+# Folder routes
+def folder_row(folder: dict, names: dict) -> dict:
+    return {
+        "id": str(folder["_id"]),
+        "name": folder["name"],
+        "parent_id": str(folder["parent_id"]) if folder["parent_id"] else None,
+        "path": folder_crumbs(folder, names),
+        "size": max(0, folder["size"]),
+        "file_count": max(0, folder["file_count"]),
+        "folder_count": max(0, folder["folder_count"]),
+        "created_at": folder["created_at"],
+        "updated_at": folder["updated_at"]
+    }
+
+async def folder_response(db, folder: dict) -> FolderResponse:
+    return FolderResponse(**folder_row(folder, await ancestor_names(db, folder)))
+
+def folder_name_taken() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="A folder with this name already exists here"
+    )
+
+@api_router.post("/folders", response_model=FolderResponse)
+async def create_folder(request: FolderCreate, current_user=Depends(get_current_user), db=Depends(get_db)):
+    parent = await resolve_folder(db, current_user["_id"], request.parent_id)
+    check_depth(parent)
+    folder = folder_document(current_user["_id"], request.name, parent)
+    try:
+        await db.folders.insert_one(folder)
+    except DuplicateKeyError:
+        raise folder_name_taken()
+    await adjust_totals(db, lineage(parent), folder_count=1)
+    await record_folders_change(db, current_user["_id"], 1)
+    return await folder_response(db, folder)
+
+@api_router.get("/folders", response_model=List[FolderResponse])
+async def list_folders(
+    parent_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    current_user=Depends(get_token_principal),
+    db=Depends(get_db)
+):
+    # Subfolders by name, straight off the (user_id, parent_id, name_key)
+    # index; one extra row tells whether another page follows
+    parent = await resolve_folder(db, current_user["_id"], parent_id)
+    folders = await db.folders.find(
+        folder_page_query(current_user["_id"], parent, cursor),
+        {"user_id": 0}
+    ).sort("name_key", 1).to_list(limit + 1)
+    headers = {}
+    if len(folders) > limit:
+        folders = folders[:limit]
+        headers["X-Next-Cursor"] = encode_folder_cursor(folders[-1])
+    names = {}
+    if parent:
+        names = await ancestor_names(db, parent)
+        names[parent["_id"]] = parent["name"]
+    return json_response([folder_row(folder, names) for folder in folders], headers)
+
+@api_router.get("/folders/{folder_id}", response_model=FolderResponse)
+async def get_folder_info(folder_id: str, current_user=Depends(get_token_principal), db=Depends(get_db)):
+    folder = await get_folder(db, current_user["_id"], parse_folder_id(folder_id))
+    return await folder_response(db, folder)
+
+@api_router.patch("/folders/{folder_id}", response_model=FolderResponse)
+async def update_folder(
+    folder_id: str,
+    request: FolderUpdate,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db)
+):
+    # Renames touch one document and moves a fixed handful, however many
+    # files and folders are inside
+    folder = await get_folder(db, current_user["_id"], parse_folder_id(folder_id))
+    renamed = {}
+    if request.name is not None and request.name != folder["name"]:
+        renamed = {"name": request.name, "name_key": normalize(request.name)}
+    try:
+        if request.parent_id is not None:
+            parent = await resolve_folder(db, current_user["_id"], request.parent_id)
+            if (parent and parent["_id"]) != folder["parent_id"]:
+                await move_folder(db, folder, parent, **renamed)
+                renamed = {}
+        if renamed:
+            await db.folders.update_one(
+                {"_id": folder["_id"]},
+                {"$set": {**renamed, "updated_at": datetime.utcnow()}}
+            )
+    except DuplicateKeyError:
+        raise folder_name_taken()
+    return await folder_response(db, await get_folder(db, current_user["_id"], folder["_id"]))
+
+@api_router.delete("/folders/{folder_id}")
+async def delete_folder(
+    folder_id: str,
+    current_user=Depends(get_current_user),
+    db=Depends(get_db),
+    reclaimer: Reclaimer = Depends(get_reclaimer)
+):
+    folder = await get_folder(db, current_user["_id"], parse_folder_id(folder_id))
+    folder_ids = await subtree_ids(db, folder)
+    
+    # Files go first so the folder totals are kept right along the way
+    deleted, freed = await remove_files(db, reclaimer, current_user["_id"], {"parent_id": {"$in": folder_ids}})
+    result = await db.folders.delete_many({"_id": {"$in": folder_ids}, "user_id": current_user["_id"]})
+    # Files uploaded into the subtree while it was being emptied; their
+    # folders are gone, so the totals above are fixed up directly
+    late, late_freed = await remove_files(db, reclaimer, current_user["_id"], {"parent_id": {"$in": folder_ids}})
+    await adjust_totals(
+        db, folder["ancestors"], folder_count=-result.deleted_count, file_count=-late, size=-late_freed
+    )
+    await record_folders_change(db, current_user["_id"], -result.deleted_count)
+    
+    return {
+        "message": "Folder deleted successfully",
+        "deleted_folders": result.deleted_count,
+        "deleted_files": deleted + late,
+        "bytes_freed": freed + late_freed
+    }
+
+@api_router.post("/files/move")
+async def move_files(request: FileMove, current_user=Depends(get_current_user), db=Depends(get_db)):
+    parent = await resolve_folder(db, current_user["_id"], request.folder_id)
+    target = parent and parent["_id"]
+    try:
+        file_ids = [ObjectId(file_id) for file_id in request.file_ids]
+    except Exception:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid file id"
+        )
+    
+    moving = await db.files.find(
+        {"_id": {"$in": file_ids}, "user_id": current_user["_id"], "parent_id": {"$ne": target},
+         "deleting": {"$exists": False}},
+        {"size": 1, "parent_id": 1, "user_id": 1}
+    ).to_list(None)
+    if moving:
+        await db.files.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in moving]}},
+            {"$set": {"parent_id": target}}
+        )
+        await record_folder_files(db, moving, -1)
+        await record_folder_files(db, [{**doc, "parent_id": target} for doc in moving], 1)
+    
+    return {"message": f"{len(moving)} files moved", "moved": len(moving)}
+
 @api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user=Depends(get_current_user)):
-    total_files = await db.files.count_documents({"user_id": current_user["_id"]})
+async def get_dashboard_stats(current_user=Depends(get_current_user), db=Depends(get_db)):
+    # Counters are maintained on upload/delete, so this is a single point read
+    stats = await get_user_stats(db, current_user["_id"])
     
     return DashboardStats(
-        total_files=total_files,
-        total_folders=0,  # TODO: Implement folders
-        shared_files=0,   # TODO: Implement sharing
-        recent_uploads=total_files,  # Simplified for now
+        total_files=stats["total_files"],
+        total_folders=stats["total_folders"],
+        shared_files=stats["shared_files"],
+        recent_uploads=stats["recent_uploads"],
         storage_used=current_user["storage_used"],
-        storage_limit=current_user["storage_limit"]
+        storage_limit=current_user["storage_limit"],
+        bytes_by_family=stats["bytes_by_family"]
     )
 
 # Legacy endpoints (keep for compatibility)
@@ -245,16 +1251,13 @@ async def get_dashboard_stats(current_user=Depends(get_current_user)):
 async def root():
     return {"message": "TeraBox API is running"}
 
-# Include the router in the main app
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Metrics are disabled"
+        )
+    return metrics_response()
 
 # Configure logging
 logging.basicConfig(
@@ -263,6 +1266,119 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def warm_up(client, connections: int):
+    """Open ``connections`` pooled connections (at least one) before serving"""
+    # Commands in flight at the same time each need a connection
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(max(1, connections))))
+
+def start_background_tasks(app: FastAPI):
+    db, storage, settings = app.state.db, app.state.storage, app.state.settings
+    app.state.session_gc = asyncio.create_task(run_session_gc(db, settings.partial_dir))
+    app.state.reservation_sweeper = asyncio.create_task(run_reservation_sweeper(db))
+    app.state.reclaimer = Reclaimer(db, storage)
+    app.state.reclaim_task = asyncio.create_task(app.state.reclaimer.run())
+    app.state.thumbnailer = ThumbnailWorker(db, storage, settings.partial_dir / "thumbnails")
+    app.state.thumbnail_task = asyncio.create_task(app.state.thumbnailer.run())
+    app.state.reconcile_task = None
+    if RECONCILE_INTERVAL_HOURS > 0:
+        app.state.reconcile_task = asyncio.create_task(run_reconciler(db, storage))
+    if METRICS_ENABLED:
+        app.state.loop_monitor = asyncio.create_task(monitor_event_loop())
+        register_state_metrics(app)
+
+def register_state_metrics(app: FastAPI):
+    """Counters kept by the background workers and caches, read at scrape time"""
+    state_collector.gauge("terabox_password_hash_pending", "bcrypt jobs queued or running",
+                          lambda: password_hasher.pending)
+    state_collector.counter("terabox_password_hash_seconds", "Time spent hashing and verifying passwords",
+                            lambda: password_hasher.busy_seconds)
+    state_collector.counter("terabox_password_hash_rejected", "Password jobs turned away when the pool was full",
+                            lambda: password_hasher.rejected)
+    state_collector.counter("terabox_principal_cache_hits", "Authenticated requests served from the cache",
+                            lambda: principal_cache.hits)
+    state_collector.counter("terabox_principal_cache_misses", "Authenticated requests that read the user",
+                            lambda: principal_cache.misses)
+    state_collector.counter("terabox_share_cache_hits", "Share link downloads resolved from the cache",
+                            lambda: share_cache.hits)
+    state_collector.counter("terabox_share_cache_misses", "Share link downloads that looked the file up",
+                            lambda: share_cache.misses)
+    state_collector.counter("terabox_reclaimed_files", "Files deleted from storage by the reclaimer",
+                            lambda: app.state.reclaimer.reclaimed)
+    state_collector.counter("terabox_thumbnails_rendered", "Thumbnails rendered",
+                            lambda: app.state.thumbnailer.rendered)
+    state_collector.counter("terabox_thumbnail_failures", "Thumbnail attempts that failed",
+                            lambda: app.state.thumbnailer.failed)
+
+def stop_background_tasks(app: FastAPI):
+    logger.info("Principal cache: %s", principal_cache.stats())
+    password_hasher.shutdown()
+    app.state.session_gc.cancel()
+    app.state.reservation_sweeper.cancel()
+    app.state.reclaim_task.cancel()
+    app.state.thumbnail_task.cancel()
+    app.state.thumbnailer.shutdown()
+    if app.state.reconcile_task is not None:
+        app.state.reconcile_task.cancel()
+    if METRICS_ENABLED:
+        app.state.loop_monitor.cancel()
+
+def create_app(settings: Optional[Settings] = None, client=None) -> FastAPI:
+    """Build the API.
+
+    Nothing connects or touches the disk until the app starts. Its lifespan
+    then runs once per worker process: it opens that worker's Mongo pool
+    (or uses ``client``, which is left open), creates the upload
+    directories and runs the background workers. ``settings`` default to
+    Settings.from_env() at startup.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        started = time.perf_counter()
+        if app.state.settings is None:
+            app.state.settings = Settings.from_env()
+        settings = app.state.settings
+        settings.partial_dir.mkdir(parents=True, exist_ok=True)
+        
+        mongo = client or AsyncIOMotorClient(
+            settings.mongo_url, event_listeners=mongo_listeners(), **settings.mongo_options()
+        )
+        app.state.client = mongo
+        app.state.db = mongo[settings.db_name]
+        # Where stored files live; uploads are staged in partial_dir either way
+        app.state.storage = instrument_storage(create_storage(settings.upload_dir))
+        try:
+            if settings.mongo_warmup:
+                await warm_up(mongo, settings.mongo_min_pool_size)
+            await ensure_indexes(app.state.db)
+            start_background_tasks(app)
+            logger.info("Worker %d started in %.0f ms", os.getpid(), (time.perf_counter() - started) * 1000)
+            try:
+                yield
+            finally:
+                stop_background_tasks(app)
+        finally:
+            if client is None:
+                mongo.close()
+
+    app = FastAPI(default_response_class=DefaultJSONResponse, lifespan=lifespan)
+    app.state.settings = settings
+    app.include_router(api_router)
+    app.add_api_route("/metrics", metrics, include_in_schema=False)
+    
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor", "X-Search-Truncated"],
+    )
+    
+    # Outermost, so its timings include everything else
+    if METRICS_ENABLED:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+# For `uvicorn server:app`; `uvicorn --factory server:create_app` is the same
+app = create_app()
@@ -0,0 +1,73 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+@dataclass
+class Settings:
+    """What the API needs to start; each worker process opens its own pool"""
+    mongo_url: str
+    db_name: str
+    upload_dir: Path = ROOT_DIR / "uploads"
+    # Connections per worker, shared by its requests and background tasks
+    mongo_max_pool_size: int = 100
+    # Kept open while idle so a burst doesn't wait on new connections
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: Optional[int] = None
+    mongo_connect_timeout_ms: int = 10000
+    mongo_server_selection_timeout_ms: int = 30000
+    mongo_socket_timeout_ms: Optional[int] = None
+    # How long a request waits for a free connection; None waits forever
+    mongo_wait_queue_timeout_ms: Optional[int] = None
+    # Open mongo_min_pool_size connections (at least one) before serving
+    mongo_warmup: bool = True
+
+    @property
+    def partial_dir(self) -> Path:
+        """Where uploads are staged before they go into storage"""
+        return self.upload_dir / ".partial"
+
+    def mongo_options(self) -> dict:
+        """Keyword arguments for the Motor client"""
+        options = {
+            "maxPoolSize": self.mongo_max_pool_size,
+            "minPoolSize": self.mongo_min_pool_size,
+            "connectTimeoutMS": self.mongo_connect_timeout_ms,
+            "serverSelectionTimeoutMS": self.mongo_server_selection_timeout_ms,
+        }
+        optional = {
+            "maxIdleTimeMS": self.mongo_max_idle_time_ms,
+            "socketTimeoutMS": self.mongo_socket_timeout_ms,
+            "waitQueueTimeoutMS": self.mongo_wait_queue_timeout_ms,
+        }
+        options.update({name: value for name, value in optional.items() if value is not None})
+        return options
+
+    @classmethod
+    def from_env(cls, env_file: Optional[Path] = ROOT_DIR / ".env") -> "Settings":
+        """Settings from the environment, after loading ``env_file`` if it exists"""
+        if env_file is not None:
+            load_dotenv(env_file)
+        return cls(
+            mongo_url=os.environ["MONGO_URL"],
+            db_name=os.environ["DB_NAME"],
+            upload_dir=Path(os.environ.get("UPLOAD_DIR", ROOT_DIR / "uploads")),
+            mongo_max_pool_size=int(os.environ.get("MONGO_MAX_POOL_SIZE", "100")),
+            mongo_min_pool_size=int(os.environ.get("MONGO_MIN_POOL_SIZE", "0")),
+            mongo_max_idle_time_ms=_optional_int("MONGO_MAX_IDLE_TIME_MS"),
+            mongo_connect_timeout_ms=int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "10000")),
+            mongo_server_selection_timeout_ms=int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000")),
+            mongo_socket_timeout_ms=_optional_int("MONGO_SOCKET_TIMEOUT_MS"),
+            mongo_wait_queue_timeout_ms=_optional_int("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+            mongo_warmup=os.environ.get("MONGO_WARMUP", "true").lower() == "true",
+        )
@@ -0,0 +1,190 @@
+import base64
+import binascii
+import calendar
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from bson import ObjectId
+from fastapi import HTTPException, status
+
+from auth import SECRET_KEY
+from downloads import FILE_CONTENT_FIELDS
+
+# Links are signed with their own key so a leaked link secret can't mint
+# API tokens and vice versa
+SHARE_LINK_SECRET = os.environ.get("SHARE_LINK_SECRET") or hashlib.sha256(f"share:{SECRET_KEY}".encode()).hexdigest()
+SHARE_LINK_TTL = timedelta(hours=int(os.environ.get("SHARE_LINK_TTL_HOURS", "168")))
+SHARE_LINK_MAX_TTL = timedelta(days=365)
+SHARE_CACHE_SIZE = int(os.environ.get("SHARE_CACHE_SIZE", "10000"))
+# How long a worker keeps serving a link after it was revoked on another
+# worker; revocations on the same worker apply immediately
+SHARE_CACHE_TTL_SECONDS = float(os.environ.get("SHARE_CACHE_TTL_SECONDS", "30"))
+
+
+# A link is "<payload>.<signature>", both base64url, and carries only the
+# file and share ids and the expiry. Revocable links are checked against
+# the file's current share, so unsharing or sharing again ends them.
+# Permanent links only need the file to be shared: they survive sharing
+# again, stop working while it is unshared and end when it is deleted.
+
+
+@dataclass
+class SharedFile:
+    file_id: str
+    location: str
+    size: int
+    stored_size: int
+    mime_type: str
+    name: str
+    sha256: Optional[str]
+    encoding: Optional[str]
+    uploaded_at: datetime
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _epoch(dt: datetime) -> int:
+    # Stored datetimes are naive UTC
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _signature(payload: str) -> str:
+    return _b64encode(hmac.new(SHARE_LINK_SECRET.encode(), payload.encode(), hashlib.sha256).digest()[:24])
+
+
+def sign_share(file_doc: dict, share_id: str, expires_at: datetime, revocable: bool) -> str:
+    """Token for a public link to ``file_doc``"""
+    claims = {"f": str(file_doc["_id"]), "s": share_id, "e": _epoch(expires_at)}
+    if not revocable:
+        claims["k"] = 1
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{_signature(payload)}"
+
+
+def verify_share(token: str) -> dict:
+    """Claims of a validly signed, unexpired link; raises 404 or 410"""
+    payload, _, signature = token.partition(".")
+    try:
+        if not hmac.compare_digest(signature, _signature(payload)):
+            raise ValueError("bad signature")
+        claims = json.loads(_b64decode(payload))
+    except (ValueError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Share link not found"
+        )
+    if claims["e"] < time.time():
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Share link has expired"
+        )
+    return claims
+
+
+def is_permanent(claims: dict) -> bool:
+    return "k" in claims
+
+
+def cache_key(claims: dict) -> str:
+    """Permanent links are cached per file, so unsharing or deleting it drops them"""
+    return f"file:{claims['f']}" if is_permanent(claims) else claims["s"]
+
+
+def shared_file_from_doc(file_doc: dict, stored_size: int, location: str) -> SharedFile:
+    return SharedFile(
+        file_id=str(file_doc["_id"]), location=location, size=file_doc["size"], stored_size=stored_size,
+        mime_type=file_doc["mime_type"], name=file_doc["original_name"], sha256=file_doc.get("sha256"),
+        encoding=file_doc.get("encoding"), uploaded_at=file_doc["uploaded_at"],
+    )
+
+
+class ShareCache:
+    """Bounded LRU of resolved links with a TTL, keyed by cache_key().
+
+    Links found to be revoked are cached too, so a dead viral link costs
+    one query per TTL rather than one per hit.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, share_id: str):
+        """(found, shared file or None if revoked)"""
+        entry = self._entries.get(share_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(share_id)
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def put(self, share_id: str, shared: Optional[SharedFile]):
+        self._entries[share_id] = (time.monotonic() + self.ttl, shared)
+        self._entries.move_to_end(share_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, share_id: Optional[str]):
+        if share_id:
+            self._entries.pop(share_id, None)
+
+    def invalidate_file(self, file_id):
+        self._entries.pop(f"file:{file_id}", None)
+
+
+share_cache = ShareCache(SHARE_CACHE_SIZE, SHARE_CACHE_TTL_SECONDS)
+
+
+async def _lookup(db, storage, claims: dict) -> Optional[SharedFile]:
+    query = {"_id": ObjectId(claims["f"]), "is_shared": True, "deleting": {"$exists": False}}
+    if not is_permanent(claims):
+        query["share_link"] = claims["s"]
+    file_doc = await db.files.find_one(query, FILE_CONTENT_FIELDS)
+    if not file_doc:
+        return None
+    stored = await storage.stat(file_doc["path"])
+    if stored is None:
+        return None
+    return shared_file_from_doc(file_doc, stored.size, stored.location)
+
+
+async def resolve_share(db, storage, claims: dict) -> SharedFile:
+    """The file a verified link points at, or 404 if it was revoked or deleted.
+
+    Lookups are cached per share (per file for permanent links), so a
+    popular link costs one query and one storage stat per
+    SHARE_CACHE_TTL_SECONDS on each worker.
+    """
+    key = cache_key(claims)
+    found, shared = share_cache.get(key)
+    if not found:
+        shared = await _lookup(db, storage, claims)
+        share_cache.put(key, shared)
+    if shared is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Share link not found"
+        )
+    return shared
+
+
+def share_expiry(hours: Optional[int]) -> datetime:
+    ttl = timedelta(hours=hours) if hours else SHARE_LINK_TTL
+    return datetime.utcnow() + min(ttl, SHARE_LINK_MAX_TTL)
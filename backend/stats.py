@@ -0,0 +1,222 @@
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from settings import Settings
+
+# Days counted as "recent" on the dashboard; one bucket is kept per day
+RECENT_UPLOAD_DAYS = int(os.environ.get("RECENT_UPLOAD_DAYS", "7"))
+
+
+def mime_family(mime_type) -> str:
+    """Top-level MIME type used to group storage usage, e.g. "image" """
+    family = (mime_type or "application/octet-stream").split("/", 1)[0].strip().lower()
+    # Keep it usable as a field name in $inc paths
+    return family.replace(".", "_").replace("$", "_") or "application"
+
+
+def day_bucket(value: datetime) -> str:
+    return value.strftime("%Y-%m-%d")
+
+
+def recent_cutoff() -> datetime:
+    """Start of the oldest day bucket that still counts as recent"""
+    start = datetime.utcnow() - timedelta(days=RECENT_UPLOAD_DAYS - 1)
+    return start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _changes(files, sign: int) -> dict:
+    inc = {}
+
+    def add(field, amount):
+        inc[field] = inc.get(field, 0) + amount
+
+    for file in files:
+        add("total_files", sign)
+        if file.get("is_shared"):
+            add("shared_files", sign)
+        add(f"bytes_by_family.{mime_family(file.get('mime_type'))}", sign * file["size"])
+        add(f"uploads_by_day.{day_bucket(file['uploaded_at'])}", sign)
+    return inc
+
+
+async def record_files_added(db, user_id, files):
+    """Apply newly inserted files documents to the owner's stats"""
+    if files:
+        await db.user_stats.update_one(
+            {"_id": user_id},
+            {"$inc": _changes(files, 1), "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+
+async def record_files_removed(db, user_id, files):
+    """Apply deleted files documents to the owner's stats"""
+    if files:
+        await db.user_stats.update_one(
+            {"_id": user_id},
+            {"$inc": _changes(files, -1), "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+
+async def record_shared_change(db, user_id, delta: int):
+    """Adjust the shared file count when files are shared or unshared"""
+    if delta:
+        await db.user_stats.update_one(
+            {"_id": user_id},
+            {"$inc": {"shared_files": delta}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+
+async def record_folders_change(db, user_id, delta: int):
+    """Adjust the folder count when folders are created or deleted"""
+    if delta:
+        await db.user_stats.update_one(
+            {"_id": user_id},
+            {"$inc": {"total_folders": delta}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+
+async def get_user_stats(db, user_id) -> dict:
+    """Read a user's counters, pruning day buckets that have aged out"""
+    stats = await db.user_stats.find_one({"_id": user_id}) or {}
+    cutoff = day_bucket(recent_cutoff())
+    buckets = stats.get("uploads_by_day", {})
+    expired = [day for day in buckets if day < cutoff]
+    if expired:
+        await db.user_stats.update_one(
+            {"_id": user_id},
+            {"$unset": {f"uploads_by_day.{day}": "" for day in expired}}
+        )
+    return {
+        "total_files": max(0, stats.get("total_files", 0)),
+        "total_folders": max(0, stats.get("total_folders", 0)),
+        "shared_files": max(0, stats.get("shared_files", 0)),
+        "recent_uploads": max(0, sum(count for day, count in buckets.items() if day >= cutoff)),
+        "bytes_by_family": {k: v for k, v in stats.get("bytes_by_family", {}).items() if v},
+    }
+
+
+async def compute_stats(db, user_id=None) -> dict:
+    """Rebuild counters from the files collection, per user"""
+    match = {"user_id": user_id} if user_id is not None else {}
+    cutoff = recent_cutoff()
+    result = {}
+
+    def entry(uid):
+        return result.setdefault(uid, {
+            "total_files": 0, "total_folders": 0, "shared_files": 0, "bytes_by_family": {}, "uploads_by_day": {}
+        })
+
+    families = db.files.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id",
+                "family": {"$toLower": {"$arrayElemAt": [
+                    {"$split": [{"$ifNull": ["$mime_type", "application/octet-stream"]}, "/"]}, 0
+                ]}}
+            },
+            "files": {"$sum": 1},
+            "shared": {"$sum": {"$cond": ["$is_shared", 1, 0]}},
+            "bytes": {"$sum": "$size"}
+        }}
+    ], allowDiskUse=True)
+    async for row in families:
+        stats = entry(row["_id"]["user_id"])
+        stats["total_files"] += row["files"]
+        stats["shared_files"] += row["shared"]
+        family = mime_family(row["_id"]["family"])
+        stats["bytes_by_family"][family] = stats["bytes_by_family"].get(family, 0) + row["bytes"]
+
+    days = db.files.aggregate([
+        {"$match": {**match, "uploaded_at": {"$gte": cutoff}}},
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$uploaded_at"}}
+            },
+            "count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True)
+    async for row in days:
+        entry(row["_id"]["user_id"])["uploads_by_day"][row["_id"]["day"]] = row["count"]
+
+    folders = db.folders.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+    ])
+    async for row in folders:
+        entry(row["_id"])["total_folders"] = row["count"]
+
+    return result
+
+
+def _drift(stored: dict, expected: dict) -> dict:
+    drift = {}
+    for field in ("total_files", "total_folders", "shared_files"):
+        if stored.get(field, 0) != expected[field]:
+            drift[field] = {"stored": stored.get(field, 0), "actual": expected[field]}
+    cutoff = day_bucket(recent_cutoff())
+    for field in ("bytes_by_family", "uploads_by_day"):
+        stored_map = {k: v for k, v in stored.get(field, {}).items() if v}
+        if field == "uploads_by_day":
+            # Aged-out buckets are pruned lazily and don't count as drift
+            stored_map = {k: v for k, v in stored_map.items() if k >= cutoff}
+        if stored_map != expected[field]:
+            drift[field] = {"stored": stored_map, "actual": expected[field]}
+    return drift
+
+
+async def reconcile_stats(db, user_id=None, apply: bool = False) -> dict:
+    """Compare stored counters with the files collection.
+
+    Returns ``{user_id: drift}`` for every user whose counters are off and,
+    with ``apply``, overwrites their stats documents with the rebuilt values.
+    """
+    expected_by_user = await compute_stats(db, user_id)
+    query = {"_id": user_id} if user_id is not None else {}
+    stored_by_user = {}
+    async for stored in db.user_stats.find(query):
+        stored_by_user[stored["_id"]] = stored
+
+    report = {}
+    empty = {"total_files": 0, "total_folders": 0, "shared_files": 0, "bytes_by_family": {}, "uploads_by_day": {}}
+    for uid in set(expected_by_user) | set(stored_by_user):
+        expected = expected_by_user.get(uid, empty)
+        drift = _drift(stored_by_user.get(uid, {}), expected)
+        if not drift:
+            continue
+        report[uid] = drift
+        if apply:
+            await db.user_stats.replace_one(
+                {"_id": uid},
+                {**expected, "updated_at": datetime.utcnow()},
+                upsert=True
+            )
+    return report
+
+
+async def _main(apply: bool):
+    # Same database the API is configured with
+    settings = Settings.from_env()
+    client = AsyncIOMotorClient(settings.mongo_url, **settings.mongo_options())
+    try:
+        report = await reconcile_stats(client[settings.db_name], apply=apply)
+    finally:
+        client.close()
+    for uid, drift in report.items():
+        print(f"{uid}: {drift}")
+    print(f"{len(report)} users with drifting stats{' (fixed)' if apply else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild per-user dashboard stats from db.files and db.folders")
+    parser.add_argument("--apply", action="store_true", help="overwrite drifting stats")
+    asyncio.run(_main(parser.parse_args().apply))
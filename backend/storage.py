@@ -0,0 +1,352 @@
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+from urllib.parse import quote
+
+from starlette.concurrency import run_in_threadpool
+
+from blobs import fanout_path
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+# Send downloads straight to the storage service when it can sign URLs
+STORAGE_REDIRECT_DOWNLOADS = os.environ.get("STORAGE_REDIRECT_DOWNLOADS", "false").lower() == "true"
+PRESIGNED_URL_SECONDS = int(os.environ.get("PRESIGNED_URL_SECONDS", "300"))
+
+READ_CHUNK_SIZE = 256 * 1024
+# Objects set aside by the storage reconciler, kept under their original
+# key so they can be moved back
+QUARANTINE_DIR = ".quarantine"
+
+# Objects are addressed by a "location": the string kept in the path field
+# of db.blobs and db.files. Drivers turn the key of a new object into its
+# location on put and accept locations they returned earlier everywhere else.
+
+
+@dataclass
+class StoredObject:
+    location: str
+    size: int
+    # Last written, naive UTC; None if the driver can't tell
+    modified: Optional[datetime] = None
+
+
+class StorageDriver:
+    """Where uploaded bytes live. Every method is safe to await on the event loop."""
+
+    async def put(self, key: str, source: Path) -> str:
+        """Store a fully received local file under ``key``, consuming it.
+
+        Returns the location to record for the new object.
+        """
+        raise NotImplementedError
+
+    async def stat(self, location: str) -> Optional[StoredObject]:
+        """Size of a stored object, or None if it doesn't exist"""
+        raise NotImplementedError
+
+    def read(self, location: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        """Stream ``length`` bytes (default: to the end) from ``start``.
+
+        Raises FileNotFoundError if the object doesn't exist.
+        """
+        raise NotImplementedError
+
+    async def delete(self, location: str):
+        """Remove an object; removing a missing object is not an error"""
+        raise NotImplementedError
+
+    async def list(self, after: str = "", limit: int = 1000) -> List[StoredObject]:
+        """Up to ``limit`` stored objects listed after location ``after``.
+
+        Objects come in a fixed order, so passing the last location of one
+        call to the next walks the whole store. Staging and quarantined
+        objects are not listed.
+        """
+        raise NotImplementedError
+
+    async def quarantine(self, location: str) -> str:
+        """Move an object aside without deleting it; returns where it went.
+
+        Raises FileNotFoundError if the object doesn't exist.
+        """
+        raise NotImplementedError
+
+    def local_path(self, location: str) -> Optional[str]:
+        """Filesystem path of the object if it is on local disk"""
+        return None
+
+    async def presigned_url(
+        self, location: str, filename: str, media_type: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        """A time-limited URL clients can download the object from, if supported.
+
+        ``encoding`` is sent as the Content-Encoding of the response.
+        """
+        return None
+
+
+class LocalStorage(StorageDriver):
+    """Objects are files under ``base_dir``; locations are absolute paths"""
+
+    def __init__(self, base_dir: Path):
+        self.base_dir = base_dir
+
+    def _move_into_place(self, source: Path, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, path)
+
+    async def put(self, key: str, source: Path) -> str:
+        path = self.base_dir / key
+        await run_in_threadpool(self._move_into_place, source, path)
+        return str(path)
+
+    def _locate(self, location: str) -> Optional[StoredObject]:
+        # A file can move between directory layouts while its metadata is
+        # being read, so a missing path is retried at the fan-out and flat
+        # locations of the same name
+        name = os.path.basename(location)
+        for candidate in (location, str(fanout_path(self.base_dir, name)), str(self.base_dir / name)):
+            try:
+                st = os.stat(candidate)
+            except FileNotFoundError:
+                continue
+            return StoredObject(location=candidate, size=st.st_size, modified=datetime.utcfromtimestamp(st.st_mtime))
+        return None
+
+    async def stat(self, location: str) -> Optional[StoredObject]:
+        return await run_in_threadpool(self._locate, location)
+
+    async def read(self, location: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        found = await run_in_threadpool(self._locate, location)
+        if found is None:
+            raise FileNotFoundError(location)
+        end = found.size if length is None else min(found.size, start + length)
+        fh = await run_in_threadpool(open, found.location, "rb")
+        try:
+            offset = start
+            while offset < end:
+                chunk = await run_in_threadpool(os.pread, fh.fileno(), min(READ_CHUNK_SIZE, end - offset), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                yield chunk
+        finally:
+            await run_in_threadpool(fh.close)
+
+    def _remove(self, location: str):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, location: str):
+        await run_in_threadpool(self._remove, location)
+
+    def _list(self, after: str, limit: int) -> List[StoredObject]:
+        # Depth first with each directory in name order; directories that
+        # sort wholly before ``after`` are not entered
+        start = Path(after).relative_to(self.base_dir).parts if after else ()
+        found = []
+
+        def walk(directory: str, parts: tuple) -> bool:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                if not parts and entry.name.startswith("."):
+                    # Staged uploads and the quarantine
+                    continue
+                here = parts + (entry.name,)
+                if entry.is_dir(follow_symlinks=False):
+                    if here >= start[:len(here)] and walk(entry.path, here):
+                        return True
+                elif entry.is_file(follow_symlinks=False) and here > start:
+                    st = entry.stat(follow_symlinks=False)
+                    found.append(StoredObject(
+                        location=entry.path, size=st.st_size, modified=datetime.utcfromtimestamp(st.st_mtime)
+                    ))
+                    if len(found) >= limit:
+                        return True
+            return False
+
+        walk(str(self.base_dir), ())
+        return found
+
+    async def list(self, after: str = "", limit: int = 1000) -> List[StoredObject]:
+        return await run_in_threadpool(self._list, after, limit)
+
+    def _quarantine(self, location: str) -> str:
+        target = self.base_dir / QUARANTINE_DIR / Path(location).relative_to(self.base_dir)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(location, target)
+        return str(target)
+
+    async def quarantine(self, location: str) -> str:
+        return await run_in_threadpool(self._quarantine, location)
+
+    def local_path(self, location: str) -> Optional[str]:
+        return location
+
+
+class S3Storage(StorageDriver):
+    """Objects in an S3-compatible bucket; locations are object keys.
+
+    Large files go up as multipart uploads; the boto3 client is shared and
+    keeps a pool of connections. Works with AWS and stand-ins such as MinIO
+    or moto via S3_ENDPOINT_URL.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        max_connections: int = 32,
+        part_size: int = 16 * 1024 * 1024,
+    ):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=Config(max_pool_connections=max_connections, retries={"max_attempts": 5, "mode": "adaptive"}),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=4,
+        )
+
+    def _is_missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def _upload(self, source: Path, location: str):
+        self.client.upload_file(str(source), self.bucket, location, Config=self.transfer_config)
+        os.remove(source)
+
+    async def put(self, key: str, source: Path) -> str:
+        location = self.prefix + key
+        await run_in_threadpool(self._upload, source, location)
+        return location
+
+    def _head(self, location: str) -> Optional[StoredObject]:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=location)
+        except ClientError as e:
+            if self._is_missing(e):
+                return None
+            raise
+        return StoredObject(
+            location=location, size=head["ContentLength"], modified=head["LastModified"].replace(tzinfo=None)
+        )
+
+    async def stat(self, location: str) -> Optional[StoredObject]:
+        return await run_in_threadpool(self._head, location)
+
+    def _get(self, location: str, start: int, length: Optional[int]):
+        from botocore.exceptions import ClientError
+
+        if length == 0:
+            return None
+        byte_range = f"bytes={start}-" if length is None else f"bytes={start}-{start + length - 1}"
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=location, Range=byte_range)["Body"]
+        except ClientError as e:
+            if self._is_missing(e):
+                raise FileNotFoundError(location)
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                return None
+            raise
+
+    async def read(self, location: str, start: int = 0, length: Optional[int] = None) -> AsyncIterator[bytes]:
+        body = await run_in_threadpool(self._get, location, start, length)
+        if body is None:
+            return
+        try:
+            while True:
+                chunk = await run_in_threadpool(body.read, READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await run_in_threadpool(body.close)
+
+    async def delete(self, location: str):
+        await run_in_threadpool(self.client.delete_object, Bucket=self.bucket, Key=location)
+
+    def _list(self, after: str, limit: int) -> List[StoredObject]:
+        quarantined = self.prefix + QUARANTINE_DIR + "/"
+        while True:
+            # Keys come back in byte order
+            page = {"StartAfter": after} if after else {}
+            response = self.client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix, MaxKeys=limit, **page)
+            contents = response.get("Contents", [])
+            found = [
+                StoredObject(location=obj["Key"], size=obj["Size"], modified=obj["LastModified"].replace(tzinfo=None))
+                for obj in contents if not obj["Key"].startswith(quarantined)
+            ]
+            if found or not response.get("IsTruncated"):
+                return found
+            # A page of quarantined keys only; carry on past it
+            after = contents[-1]["Key"]
+
+    async def list(self, after: str = "", limit: int = 1000) -> List[StoredObject]:
+        return await run_in_threadpool(self._list, after, limit)
+
+    def _move(self, location: str, target: str):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.copy(
+                {"Bucket": self.bucket, "Key": location}, self.bucket, target, Config=self.transfer_config
+            )
+        except ClientError as e:
+            if self._is_missing(e):
+                raise FileNotFoundError(location)
+            raise
+        self.client.delete_object(Bucket=self.bucket, Key=location)
+
+    async def quarantine(self, location: str) -> str:
+        target = self.prefix + QUARANTINE_DIR + "/" + location[len(self.prefix):]
+        await run_in_threadpool(self._move, location, target)
+        return target
+
+    async def presigned_url(
+        self, location: str, filename: str, media_type: str, encoding: Optional[str] = None
+    ) -> Optional[str]:
+        params = {
+            "Bucket": self.bucket,
+            "Key": location,
+            "ResponseContentType": media_type,
+            "ResponseContentDisposition": f"attachment; filename*=utf-8''{quote(filename)}",
+        }
+        if encoding:
+            params["ResponseContentEncoding"] = encoding
+        return await run_in_threadpool(
+            self.client.generate_presigned_url, "get_object", Params=params, ExpiresIn=PRESIGNED_URL_SECONDS
+        )
+
+
+def create_storage(upload_dir: Path) -> StorageDriver:
+    """The driver selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(upload_dir)
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(
+            bucket=os.environ["S3_BUCKET"],
+            prefix=os.environ.get("S3_PREFIX", ""),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+            region=os.environ.get("S3_REGION") or None,
+            max_connections=int(os.environ.get("S3_MAX_CONNECTIONS", "32")),
+            part_size=int(os.environ.get("S3_PART_SIZE_MB", "16")) * 1024 * 1024,
+        )
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from starlette.concurrency import run_in_threadpool
+
+from blobs import fanout_path
+from compression import read_content
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are off without Pillow
+    Image = None
+
+try:
+    import pypdfium2
+except ImportError:  # PDFs get no preview without pypdfium2
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+# Longest edge of a thumbnail, in pixels
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "256"))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Added to the niceness of the pool processes so rendering yields the CPU
+# to the API under load
+THUMBNAIL_NICE = int(os.environ.get("THUMBNAIL_NICE", "10"))
+THUMBNAIL_BATCH_SIZE = 100
+THUMBNAIL_INTERVAL_SECONDS = 5
+# Jobs held by a worker that died are retried after this long
+THUMBNAIL_LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 3
+# Sources larger than this are not rendered
+MAX_SOURCE_SIZE = int(os.environ.get("THUMBNAIL_MAX_SOURCE_MB", "100")) * 1024 * 1024
+# Decompression bomb guard for Pillow
+MAX_PIXELS = 100_000_000
+
+THUMBNAIL_MEDIA_TYPE = "image/jpeg"
+IMAGE_TYPES = {
+    "image/jpeg", "image/png", "image/gif", "image/webp", "image/bmp", "image/tiff", "image/x-icon",
+}
+PDF_TYPE = "application/pdf"
+
+# Thumbnails are keyed by the blob digest, so identical content shares one
+# thumbnail and requesting it twice is a no-op. Jobs live in db.thumbnails
+# as "pending" until a worker renders them into "ready" (or gives up with
+# "failed"); they are dropped with their blob by the reclaimer.
+
+
+def can_thumbnail(mime_type: str) -> bool:
+    """Whether a preview can be rendered for this type"""
+    mime_type = (mime_type or "").split(";", 1)[0].strip().lower()
+    if Image is None:
+        return False
+    if mime_type == PDF_TYPE:
+        return pypdfium2 is not None
+    return mime_type in IMAGE_TYPES
+
+
+def thumbnail_key(sha256: str) -> str:
+    return str(fanout_path(Path("thumbnails"), f"{sha256}-{THUMBNAIL_SIZE}.jpg"))
+
+
+def thumbnail_etag(sha256: str) -> str:
+    return f"{sha256}-{THUMBNAIL_SIZE}"
+
+
+async def request_thumbnails(db, files: Iterable[dict]) -> int:
+    """Queue thumbnails for uploaded files (dicts with sha256 and mime_type).
+
+    Content that already has a job is skipped; returns how many were queued.
+    """
+    now = datetime.utcnow()
+    jobs = {}
+    for doc in files:
+        if doc.get("sha256") and can_thumbnail(doc.get("mime_type")):
+            jobs.setdefault(doc["sha256"], doc["mime_type"])
+    if not jobs:
+        return 0
+    try:
+        result = await db.thumbnails.bulk_write([
+            UpdateOne(
+                {"_id": sha256},
+                {"$setOnInsert": {
+                    "mime_type": mime_type,
+                    "state": "pending",
+                    "lease_until": now,
+                    "attempts": 0,
+                    "created_at": now,
+                }},
+                upsert=True
+            )
+            for sha256, mime_type in jobs.items()
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Two uploads of the same content racing to create the job
+        if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+            raise
+        return e.details["nUpserted"]
+    return result.upserted_count
+
+
+def _lower_priority():
+    try:
+        os.nice(THUMBNAIL_NICE)
+    except OSError:
+        pass
+
+
+def render_thumbnail(source: str, dest: str, mime_type: str, size: int = THUMBNAIL_SIZE) -> Tuple[int, int]:
+    """Write a JPEG of at most size x size pixels; returns its dimensions.
+
+    Runs in a pool process.
+    """
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    if mime_type == PDF_TYPE:
+        pdf = pypdfium2.PdfDocument(source)
+        try:
+            page = pdf[0]
+            width, height = page.get_size()
+            image = page.render(scale=size / max(width, height, 1)).to_pil()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(source)
+        # JPEG can decode straight at a fraction of full size
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+    image.thumbnail((size, size))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(dest, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return image.size
+
+
+class ThumbnailWorker:
+    """Background worker that renders queued thumbnails in a process pool.
+
+    The event loop only leases jobs and moves bytes; decoding and resizing
+    happen in at most ``workers`` low-priority processes, so a burst of
+    uploads queues up in Mongo instead of competing with requests.
+    """
+
+    def __init__(self, db, storage, staging_dir: Path, workers: int = THUMBNAIL_WORKERS,
+                 batch_size: int = THUMBNAIL_BATCH_SIZE):
+        self.db = db
+        self.storage = storage
+        self.staging_dir = staging_dir
+        self.workers = workers
+        self.batch_size = batch_size
+        self.rendered = 0
+        self.failed = 0
+        self._limit = asyncio.Semaphore(workers)
+        self._wakeup = asyncio.Event()
+        self._executor = None
+
+    def _get_executor(self):
+        # Created lazily so forked server workers each get their own pool.
+        # Renderers start from the forkserver, not by forking a process
+        # that already runs an event loop, Mongo client threads and locks.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=_lower_priority
+            )
+        return self._executor
+
+    def wake(self):
+        """Start on newly queued work without waiting for the next interval"""
+        self._wakeup.set()
+
+    async def _lease_batch(self):
+        now = datetime.utcnow()
+        candidates = await self.db.thumbnails.find(
+            {"state": "pending", "lease_until": {"$lte": now}},
+            {"_id": 1}
+        ).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+        owner = uuid.uuid4().hex
+        await self.db.thumbnails.update_many(
+            {"_id": {"$in": [c["_id"] for c in candidates]}, "state": "pending", "lease_until": {"$lte": now}},
+            {"$set": {"lease_until": now + THUMBNAIL_LEASE, "owner": owner}, "$inc": {"attempts": 1}}
+        )
+        return await self.db.thumbnails.find({"owner": owner, "state": "pending"}).to_list(self.batch_size)
+
+    async def _stage_source(self, blob: dict) -> Tuple[str, Optional[str]]:
+        """Local path of the blob's content and a temporary file to remove, if any"""
+        stored = await self.storage.stat(blob["path"])
+        if stored is None:
+            raise FileNotFoundError(blob["path"])
+        path = self.storage.local_path(stored.location)
+        if path and not blob.get("encoding"):
+            return path, None
+        fd, tmp = tempfile.mkstemp(dir=self.staging_dir, suffix=".src")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                async for chunk in read_content(self.storage, stored.location, blob.get("encoding")):
+                    await run_in_threadpool(fh.write, chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, tmp
+
+    async def _render(self, job: dict, blob: dict) -> dict:
+        """Render and store one thumbnail; returns the fields to record"""
+        async with self._limit:
+            source, staged = await self._stage_source(blob)
+            fd, dest = tempfile.mkstemp(dir=self.staging_dir, suffix=".jpg")
+            os.close(fd)
+            try:
+                loop = asyncio.get_running_loop()
+                width, height = await loop.run_in_executor(
+                    self._get_executor(), render_thumbnail, source, dest, job["mime_type"], THUMBNAIL_SIZE
+                )
+                size = os.path.getsize(dest)
+                location = await self.storage.put(thumbnail_key(job["_id"]), Path(dest))
+            finally:
+                for path in (staged, dest):
+                    if path and os.path.exists(path):
+                        os.remove(path)
+        return {"path": location, "size": size, "width": width, "height": height}
+
+    async def _fail(self, job: dict, error: str):
+        await self.db.thumbnails.update_one(
+            {"_id": job["_id"], "owner": job["owner"]},
+            {"$set": {"state": "failed", "error": error[:200]}, "$unset": {"owner": ""}}
+        )
+
+    async def _process(self, job: dict):
+        blob = await self.db.blobs.find_one({"_id": job["_id"], "state": "live"}, {"path": 1, "size": 1, "encoding": 1})
+        if not blob:
+            # The content was deleted before its turn; a later upload queues it again
+            await self.db.thumbnails.delete_one({"_id": job["_id"], "owner": job["owner"]})
+            return
+        if blob["size"] > MAX_SOURCE_SIZE:
+            await self._fail(job, "source too large")
+            return
+        try:
+            rendered = await self._render(job, blob)
+        except Exception as e:
+            logger.warning("Could not render thumbnail for %s: %s", job["_id"], e)
+            self.failed += 1
+            # Content Pillow can't read won't get better on a retry
+            if job["attempts"] >= MAX_ATTEMPTS or isinstance(
+                e, (Image.UnidentifiedImageError, Image.DecompressionBombError)
+            ):
+                await self._fail(job, str(e))
+                return
+            # Back off, then let the job be leased again
+            await self.db.thumbnails.update_one(
+                {"_id": job["_id"], "owner": job["owner"]},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(minutes=job["attempts"])}}
+            )
+            return
+        result = await self.db.thumbnails.update_one(
+            {"_id": job["_id"], "owner": job["owner"]},
+            {"$set": {"state": "ready", "rendered_at": datetime.utcnow(), **rendered}, "$unset": {"owner": ""}}
+        )
+        if result.modified_count == 0:
+            # Dropped along with its blob while rendering
+            await self.storage.delete(rendered["path"])
+            return
+        self.rendered += 1
+
+    async def process_batch(self) -> int:
+        """Render one batch; returns the number of jobs handled"""
+        jobs = await self._lease_batch()
+        await asyncio.gather(*(self._process(job) for job in jobs))
+        return len(jobs)
+
+    async def run(self):
+        """Process the queue until cancelled"""
+        self.staging_dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            self._wakeup.clear()
+            try:
+                handled = await self.process_batch()
+            except Exception:
+                logger.exception("Thumbnail batch failed")
+                handled = 0
+            if handled >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), THUMBNAIL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+async def drop_thumbnails(db, digests) -> list:
+    """Forget the thumbnails of reclaimed blobs; returns locations to delete"""
+    if not digests:
+        return []
+    ready = await db.thumbnails.find(
+        {"_id": {"$in": list(digests)}, "path": {"$exists": True}},
+        {"path": 1}
+    ).to_list(None)
+    await db.thumbnails.delete_many({"_id": {"$in": list(digests)}})
+    return [doc["path"] for doc in ready]
@@ -0,0 +1,856 @@
+#!/usr/bin/env python3
+"""
+TeraBox Backend Benchmarks
+Measures latency and throughput of the API under concurrent load.
+
+Run against the same backend before and after a change and compare the
+printed numbers, e.g.:
+
+    python backend_bench.py upload-latency --uploads 8 --size-mb 512
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+# Get backend URL from frontend .env file
+def get_backend_url():
+    if os.environ.get("BACKEND_URL"):
+        return os.environ["BACKEND_URL"]
+    frontend_env_path = Path(__file__).parent / "frontend" / ".env"
+    if frontend_env_path.exists():
+        with open(frontend_env_path, 'r') as f:
+            for line in f:
+                if line.startswith('REACT_APP_BACKEND_URL='):
+                    return line.split('=', 1)[1].strip()
+    return "http://localhost:8001"
+
+BASE_URL = get_backend_url()
+API_BASE = f"{BASE_URL}/api"
+
+CHUNK = 1024 * 1024
+# Read size of the storage drivers, used when replaying downloads
+READ = 256 * 1024
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def report(name, samples_ms, elapsed=None, nbytes=None):
+    """Print a one-line latency summary"""
+    line = (
+        f"{name:<28} n={len(samples_ms):<6} "
+        f"p50={percentile(samples_ms, 50):8.2f}ms "
+        f"p99={percentile(samples_ms, 99):8.2f}ms "
+        f"max={max(samples_ms, default=0):8.2f}ms"
+    )
+    if elapsed and nbytes:
+        line += f" throughput={nbytes / elapsed / CHUNK:8.1f}MiB/s"
+    elif elapsed:
+        line += f" rate={len(samples_ms) / elapsed:8.1f}req/s"
+    print(line)
+
+
+def multipart_stream(boundary, filename, size):
+    """Generate a multipart body of ``size`` bytes without holding it in memory"""
+    yield (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    block = os.urandom(CHUNK)
+    remaining = size
+    while remaining > 0:
+        n = min(CHUNK, remaining)
+        yield block[:n]
+        remaining -= n
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+class TeraBoxBenchmark:
+    def __init__(self):
+        self.session = requests.Session()
+        self.access_token = None
+
+    def login(self):
+        """Register a throwaway user and keep its token"""
+        self.user = user = {
+            "name": "Bench User",
+            "email": f"bench.{uuid.uuid4().hex[:12]}@example.com",
+            "password": "BenchPass123!"
+        }
+        self.session.post(f"{API_BASE}/auth/register", json=user).raise_for_status()
+        response = self.session.post(
+            f"{API_BASE}/auth/login",
+            json={"email": user["email"], "password": user["password"]}
+        )
+        response.raise_for_status()
+        self.access_token = response.json()["access_token"]
+        self.session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+
+    def upload_stream(self, size, filename="bench.bin"):
+        """Upload ``size`` random bytes using a streamed multipart body"""
+        boundary = uuid.uuid4().hex
+        response = requests.post(
+            f"{API_BASE}/files/upload",
+            data=multipart_stream(boundary, filename, size),
+            headers={
+                "Authorization": f"Bearer {self.access_token}",
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+            },
+        )
+        response.raise_for_status()
+        return response.json()["file_id"]
+
+    def bench_upload_latency(self, uploads, size_mb, duration):
+        """p99 of /api/auth/me while ``uploads`` large uploads are in flight"""
+        print(f"Baseline /auth/me for {duration}s with no uploads")
+        report("auth/me idle", self._poll_me(duration, threading.Event()))
+
+        print(f"/auth/me while {uploads} x {size_mb} MiB uploads are in flight")
+        done = threading.Event()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=uploads + 1) as pool:
+            poller = pool.submit(self._poll_me, None, done)
+            futures = [pool.submit(self.upload_stream, size_mb * CHUNK) for _ in range(uploads)]
+            file_ids = [f.result() for f in futures]
+            elapsed = time.perf_counter() - started
+            done.set()
+            report("auth/me under upload load", poller.result())
+        print(
+            f"{'uploads':<28} n={uploads:<6} total={elapsed:8.2f}s "
+            f"throughput={uploads * size_mb / elapsed:8.1f}MiB/s"
+        )
+        for file_id in file_ids:
+            self.session.delete(f"{API_BASE}/files/{file_id}")
+
+    def bench_range_throughput(self, size_mb, clients, requests_per_client, range_kb):
+        """Many concurrent partial reads of one large file"""
+        size = size_mb * CHUNK
+        print(f"Uploading a {size_mb} MiB file")
+        file_id = self.upload_stream(size)
+        url = f"{API_BASE}/files/{file_id}/download"
+        length = range_kb * 1024
+
+        def worker(seed):
+            rng = random.Random(seed)
+            session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+            samples = []
+            for _ in range(requests_per_client):
+                start = rng.randrange(0, max(1, size - length))
+                began = time.perf_counter()
+                response = session.get(url, headers={"Range": f"bytes={start}-{start + length - 1}"})
+                assert response.status_code == 206, response.status_code
+                assert len(response.content) == length
+                samples.append((time.perf_counter() - began) * 1000)
+            return samples
+
+        print(f"{clients} clients x {requests_per_client} ranges of {range_kb} KiB")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            samples = [s for result in pool.map(worker, range(clients)) for s in result]
+        elapsed = time.perf_counter() - started
+        report("range downloads", samples, elapsed, nbytes=len(samples) * length)
+        self.session.delete(f"{API_BASE}/files/{file_id}")
+
+    def bench_login_storm(self, clients, logins_per_client):
+        """Concurrent logins, with /auth/me latency measured alongside"""
+        credentials = {"email": self.user["email"], "password": self.user["password"]}
+        rejected = []
+
+        def worker(_):
+            session = requests.Session()
+            samples = []
+            for _ in range(logins_per_client):
+                began = time.perf_counter()
+                response = session.post(f"{API_BASE}/auth/login", json=credentials)
+                if response.status_code == 503:
+                    rejected.append(1)
+                    continue
+                response.raise_for_status()
+                samples.append((time.perf_counter() - began) * 1000)
+            return samples
+
+        print(f"{clients} clients x {logins_per_client} logins")
+        done = threading.Event()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients + 1) as pool:
+            poller = pool.submit(self._poll_me, None, done)
+            samples = [s for result in pool.map(worker, range(clients)) for s in result]
+            elapsed = time.perf_counter() - started
+            done.set()
+            me_samples = poller.result()
+        report("login", samples, elapsed)
+        report("auth/me during storm", me_samples)
+        print(f"{'rejected (503)':<28} n={len(rejected)}")
+
+    def bench_small_files(self, count, size_kb, batch_size, clients):
+        """Small-file upload throughput, one request per file vs batched"""
+        payload = os.urandom(size_kb * 1024)
+
+        def single(i):
+            session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+            # Vary the content so the blob store can't deduplicate it
+            body = i.to_bytes(8, "big") + payload
+            response = session.post(f"{API_BASE}/files/upload", files={"file": (f"photo{i}.jpg", body, "image/jpeg")})
+            response.raise_for_status()
+            return response.json()["file_id"]
+
+        def batch(start):
+            session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+            files = [
+                ("files", (f"photo{i}.jpg", (count + i).to_bytes(8, "big") + payload, "image/jpeg"))
+                for i in range(start, min(start + batch_size, count))
+            ]
+            response = session.post(f"{API_BASE}/files/batch", files=files)
+            response.raise_for_status()
+            return [f["file_id"] for f in response.json()["files"] if f["status"] == "uploaded"]
+
+        print(f"{count} files of {size_kb} KiB, {clients} clients")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            single_ids = list(pool.map(single, range(count)))
+        elapsed = time.perf_counter() - started
+        print(f"{'one request per file':<28} {count / elapsed:8.1f} files/s")
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            batch_ids = [i for ids in pool.map(batch, range(0, count, batch_size)) for i in ids]
+        elapsed = time.perf_counter() - started
+        print(f"{f'batches of {batch_size}':<28} {len(batch_ids) / elapsed:8.1f} files/s")
+
+        for file_id in single_ids + batch_ids:
+            self.session.delete(f"{API_BASE}/files/{file_id}")
+
+    def bench_photo_burst(self, count, batch_size, clients, megapixels):
+        """/auth/me latency while a burst of photos is uploaded and thumbnailed"""
+        import io
+
+        from PIL import Image
+
+        width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+        base = Image.effect_noise((width, width * 3 // 4), 64).convert("RGB")
+
+        def photo(i):
+            # A distinct pixel per photo keeps the blob store from deduplicating
+            image = base.copy()
+            image.putpixel((i % image.width, i // image.width % image.height), (i % 256, 0, 0))
+            out = io.BytesIO()
+            image.save(out, "JPEG", quality=85)
+            return out.getvalue()
+
+        def batch(start):
+            session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {self.access_token}"})
+            files = [
+                ("files", (f"IMG_{i:05d}.jpg", photo(i), "image/jpeg"))
+                for i in range(start, min(start + batch_size, count))
+            ]
+            response = session.post(f"{API_BASE}/files/batch", files=files)
+            response.raise_for_status()
+            return [f["file_id"] for f in response.json()["files"] if f["status"] == "uploaded"]
+
+        print("Baseline /auth/me for 5s")
+        report("auth/me idle", self._poll_me(5, threading.Event()))
+
+        print(f"{count} photos of {megapixels} MP in batches of {batch_size}, {clients} clients")
+        done = threading.Event()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients + 1) as pool:
+            poller = pool.submit(self._poll_me, None, done)
+            file_ids = [i for ids in pool.map(batch, range(0, count, batch_size)) for i in ids]
+            uploaded = time.perf_counter() - started
+            # Wait for the previews, sampling from the end of the burst
+            pending = list(file_ids)
+            while pending:
+                response = self.session.get(f"{API_BASE}/files/{pending[-1]}/thumbnail")
+                if response.status_code == 202:
+                    time.sleep(0.5)
+                    continue
+                pending.pop()
+            rendered = time.perf_counter() - started
+            done.set()
+            report("auth/me during burst", poller.result())
+        print(f"{'uploads':<28} {len(file_ids) / uploaded:8.1f} files/s")
+        print(f"{'all thumbnails ready':<28} {rendered:8.2f}s ({len(file_ids) / rendered:.1f} thumbnails/s)")
+
+        self.session.post(f"{API_BASE}/files/bulk-delete", json={"file_ids": file_ids})
+
+    def _poll_me(self, duration, stop):
+        samples = []
+        deadline = time.perf_counter() + duration if duration else None
+        while not stop.is_set() and (deadline is None or time.perf_counter() < deadline):
+            start = time.perf_counter()
+            self.session.get(f"{API_BASE}/auth/me").raise_for_status()
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+
+def synthetic_corpus(size):
+    """(name, mime type, bytes) samples of typical compressible uploads"""
+    rng = random.Random(42)
+    levels = ["INFO", "INFO", "INFO", "WARN", "ERROR", "DEBUG"]
+    paths = ["/api/files", "/api/auth/me", "/api/files/upload", "/api/dashboard/stats"]
+
+    def build(line):
+        out, n = [], 0
+        while n < size:
+            text = line(n)
+            out.append(text)
+            n += len(text)
+        return "".join(out).encode()[:size]
+
+    yield "app.log", "text/plain", build(lambda i: (
+        f"2024-05-{rng.randint(1, 28):02d} 12:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+        f"{rng.choice(levels)} {rng.choice(paths)} {rng.choice([200, 200, 201, 404, 500])} "
+        f"{rng.random() * 300:.1f}ms user={uuid.UUID(int=rng.getrandbits(128))}\n"
+    ))
+    yield "export.csv", "text/csv", build(lambda i: (
+        f"{i},{rng.choice(['alice', 'bob', 'carol'])}@example.com,{rng.randint(0, 10 ** 9)},"
+        f"{rng.random():.6f},{rng.choice(['true', 'false'])}\n"
+    ))
+    yield "events.json", "application/json", build(lambda i: (
+        f'{{"id": {i}, "type": "{rng.choice(["upload", "download", "share"])}", '
+        f'"bytes": {rng.randint(0, 10 ** 9)}, "ok": {rng.choice(["true", "false"])}}},\n'
+    ))
+    yield "random.bin", "text/plain", os.urandom(size)
+
+
+def bench_compression(corpus, size_mb):
+    """Space saved and CPU cost of at-rest compression, measured in-process"""
+    import mimetypes
+    import sys
+
+    sys.path.insert(0, str(Path(__file__).parent / "backend"))
+    import compression
+
+    if compression.zstandard is None:
+        print("zstandard is not installed; compression is disabled")
+        return
+    if corpus:
+        samples = (
+            (path.name, mimetypes.guess_type(path.name)[0] or "application/octet-stream", path.read_bytes())
+            for path in sorted(Path(corpus).rglob("*")) if path.is_file()
+        )
+    else:
+        samples = synthetic_corpus(size_mb * CHUNK)
+
+    totals = {"logical": 0, "stored": 0, "compress": 0.0, "decompress": 0.0, "compressed": 0}
+    print(f"{'file':<28} {'type':<20} {'size':>10} {'stored':>10} {'saved':>7} {'comp s/GB':>10} {'decomp s/GB':>11}")
+    for name, mime_type, data in samples:
+        stored, compress_cpu, decompress_cpu, encoding = len(data), 0.0, 0.0, None
+        if compression.should_compress(mime_type):
+            compressor = compression.StreamCompressor()
+            began = time.process_time()
+            out = [compressor.compress(data[i:i + CHUNK]) for i in range(0, len(data), CHUNK)]
+            out.append(compressor.flush())
+            compress_cpu = time.process_time() - began
+            encoding = compressor.encoding
+            if encoding:
+                blob = b"".join(out)
+                stored = len(blob)
+                began = time.process_time()
+                decompressor = compression.zstandard.ZstdDecompressor().decompressobj()
+                restored = b"".join(decompressor.decompress(blob[i:i + READ]) for i in range(0, len(blob), READ))
+                decompress_cpu = time.process_time() - began
+                assert restored == data
+        gb = max(len(data), 1) / 1024 ** 3
+        saved = 1 - stored / max(len(data), 1)
+        status = f"{saved:6.1%}" if encoding else ("   raw" if compression.should_compress(mime_type) else "   n/a")
+        print(
+            f"{name[:28]:<28} {mime_type[:20]:<20} {len(data):>10} {stored:>10} {status:>7} "
+            f"{compress_cpu / gb:>10.2f} {decompress_cpu / gb if encoding else 0:>11.2f}"
+        )
+        totals["logical"] += len(data)
+        totals["stored"] += stored
+        totals["compress"] += compress_cpu
+        totals["decompress"] += decompress_cpu
+        totals["compressed"] += len(data) if encoding else 0
+
+    gb = max(totals["logical"], 1) / 1024 ** 3
+    print(
+        f"\nTotal: {totals['logical'] / CHUNK:.1f} MiB stored as {totals['stored'] / CHUNK:.1f} MiB "
+        f"({1 - totals['stored'] / max(totals['logical'], 1):.1%} saved), "
+        f"compression {totals['compress'] / gb:.2f} CPU s/GB, "
+        f"decompression {totals['decompress'] / max(totals['compressed'], 1) * 1024 ** 3:.2f} CPU s/GB"
+    )
+
+
+def synthetic_names(count, seed=7):
+    """File names shaped like a camera roll, office documents and downloads"""
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ren", "tor", "vel", "sa", "dun", "pri", "ox", "bel", "nar", "quo", "zim"]
+    words = ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(3000)]
+    extensions = [("jpg", "image/jpeg"), ("png", "image/png"), ("pdf", "application/pdf"),
+                  ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+                  ("mp4", "video/mp4"), ("txt", "text/plain"), ("zip", "application/zip")]
+    for i in range(count):
+        kind = rng.random()
+        year, month, day = rng.randint(2015, 2024), rng.randint(1, 12), rng.randint(1, 28)
+        if kind < 0.4:
+            yield f"IMG_{year}{month:02d}{day:02d}_{rng.randint(0, 235959):06d}.jpg", "image/jpeg"
+        elif kind < 0.5:
+            yield f"Screenshot {year}-{month:02d}-{day:02d} at {rng.randint(0, 23)}.{rng.randint(0, 59):02d}.png", "image/png"
+        else:
+            ext, mime_type = rng.choice(extensions)
+            parts = rng.sample(words, rng.randint(1, 4))
+            if rng.random() < 0.3:
+                parts.append(str(year))
+            yield f"{rng.choice(['_', '-', ' ']).join(parts)}.{ext}", mime_type
+
+
+def bench_search(mongo_url, files, queries, db_name=None):
+    """Latency of filename search on one large account, against a real mongod"""
+    import asyncio
+    import sys
+    from datetime import datetime, timedelta
+
+    from bson import ObjectId
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    sys.path.insert(0, str(Path(__file__).parent / "backend"))
+    import search
+    from indexes import ensure_indexes
+
+    names = list(synthetic_names(files))
+    rng = random.Random(11)
+    samples = [search.normalize(name) for name, _ in rng.sample(names, 50)]
+
+    def two_terms():
+        tokens = search.name_tokens(rng.choice(samples))
+        return " ".join(rng.sample(tokens, 2)) if len(tokens) > 1 else "img 2023"
+
+    mix = [
+        ("common prefix", lambda: rng.choice(["img", "2024", "screenshot", "ka", "pdf"])),
+        ("word from a name", lambda: rng.choice(search.name_tokens(rng.choice(samples)))),
+        ("two terms", two_terms),
+        ("exact name", lambda: rng.choice(samples)),
+        ("no match", lambda: "zzqx" + str(rng.randint(0, 999))),
+    ]
+
+    async def run():
+        client = AsyncIOMotorClient(mongo_url)
+        db = client[db_name or f"terabox_bench_search_{uuid.uuid4().hex[:8]}"]
+        try:
+            await ensure_indexes(db)
+            user = await db.users.find_one({"email": "search-bench@example.com"})
+            if user is None or await db.files.count_documents({"user_id": user["_id"]}) != files:
+                await db.files.delete_many({})
+                user_id = ObjectId()
+                await db.users.replace_one({"email": "search-bench@example.com"},
+                                           {"_id": user_id, "email": "search-bench@example.com"}, upsert=True)
+                started = time.perf_counter()
+                base = datetime(2024, 1, 1)
+                for offset in range(0, files, 10000):
+                    await db.files.insert_many([
+                        {"user_id": user_id, "original_name": name, "mime_type": mime_type,
+                         "size": 1000 + i, "is_shared": False, "has_thumbnail": False,
+                         "uploaded_at": base + timedelta(seconds=i), **search.search_fields(name)}
+                        for i, (name, mime_type) in enumerate(names[offset:offset + 10000], offset)
+                    ], ordered=False)
+                print(f"Seeded {files} files in {time.perf_counter() - started:.1f}s")
+                user = {"_id": user_id}
+            projection = {"original_name": 1, "size": 1, "mime_type": 1, "uploaded_at": 1}
+            for label, make in mix:
+                timings = []
+                for _ in range(queries):
+                    q = make()
+                    started = time.perf_counter()
+                    await search.search_files(db, user["_id"], q, projection)
+                    timings.append((time.perf_counter() - started) * 1000)
+                report(f"search: {label}", timings)
+            timings = []
+            for _ in range(queries):
+                started = time.perf_counter()
+                await search.search_files(db, user["_id"], rng.choice(["img", "ka", "2024"]), projection,
+                                          mime_filter={"$regex": "^image/"})
+                timings.append((time.perf_counter() - started) * 1000)
+            report("search: prefix + type", timings)
+        finally:
+            if not db_name:
+                await client.drop_database(db.name)
+            client.close()
+
+    asyncio.run(run())
+
+
+def bench_listing_serialization(rows, rounds=5):
+    """CPU cost of encoding a get_user_files page, measured in-process.
+
+    Compares building a FileResponse per row (what a response_model
+    endpoint does) with the streamed encoder, with and without orjson.
+    """
+    import asyncio
+    import json
+    import sys
+    from datetime import datetime, timedelta
+
+    from bson import ObjectId
+
+    sys.path.insert(0, str(Path(__file__).parent / "backend"))
+    import listing
+    from fastapi.encoders import jsonable_encoder
+    from models import FileResponse
+
+    base = datetime(2024, 1, 1)
+    docs = [
+        {"_id": ObjectId(), "filename": uuid.uuid4().hex, "original_name": f"IMG_{i:06d}.jpg",
+         "size": 1000 + i, "mime_type": "image/jpeg", "is_shared": False, "has_thumbnail": True,
+         "parent_id": None, "uploaded_at": base + timedelta(seconds=i, microseconds=i)}
+        for i in range(rows)
+    ]
+    fields = list(listing.LIST_FIELDS)
+
+    def models():
+        page = [FileResponse(id=str(doc["_id"]), **{k: v for k, v in doc.items() if k != "_id"}) for doc in docs]
+        return json.dumps(jsonable_encoder(page), separators=(",", ":")).encode()
+
+    async def cursor():
+        for doc in docs:
+            yield doc
+
+    async def collect():
+        return b"".join([piece async for piece in listing.stream_json_array(cursor(), fields)])
+
+    def streamed(use_orjson):
+        saved = listing.orjson
+        if not use_orjson:
+            listing.orjson = None
+        try:
+            return asyncio.run(collect())
+        finally:
+            listing.orjson = saved
+
+    paths = [("pydantic models + json", models), ("stream, json", lambda: streamed(False))]
+    if listing.orjson is not None:
+        paths.append(("stream, orjson", lambda: streamed(True)))
+    else:
+        print("orjson is not installed; only the json encoder is measured")
+    expected = json.loads(models())
+    for name, encode in paths:
+        assert json.loads(encode()) == expected, name
+        best = float("inf")
+        for _ in range(rounds):
+            started = time.perf_counter()
+            body = encode()
+            best = min(best, time.perf_counter() - started)
+        print(f"{name:<28} {best * 1000:8.2f} ms per {rows} rows ({len(body) / 1024:.0f} KiB)")
+
+
+def bench_metrics_overhead(requests_count, rounds=5):
+    """Per-request cost of the metrics middleware, measured in-process.
+
+    The middleware wraps a bare ASGI app so the difference isn't lost in
+    the noise of routing and serialisation; rounds alternate and the best
+    of each is kept.
+    """
+    import asyncio
+    import sys
+
+    sys.path.insert(0, str(Path(__file__).parent / "backend"))
+    import metrics
+
+    if not metrics.METRICS_ENABLED:
+        print("Metrics are disabled (METRICS_ENABLED=false or prometheus_client missing)")
+        return
+
+    class App:
+        async def endpoint(self):
+            pass
+
+        def __init__(self):
+            self.routes = [self]
+            self.path = "/api/ping/{item}"
+
+        async def __call__(self, scope, receive, send):
+            scope["endpoint"] = self.endpoint
+            await receive()
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-length", b"2")]})
+            await send({"type": "http.response.body", "body": b"{}"})
+
+    app = App()
+    scope = {"type": "http", "method": "GET", "path": "/api/ping/1", "app": app}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    async def run(asgi, tracing):
+        metrics.METRICS_TRACING = tracing
+        started = time.perf_counter()
+        for _ in range(requests_count):
+            await asgi(dict(scope), receive, send)
+        return (time.perf_counter() - started) / requests_count * 1e6
+
+    async def compare():
+        instrumented = metrics.MetricsMiddleware(app, metrics.HttpStats())
+        best = {"plain": float("inf"), "metrics": float("inf"), "tracing": float("inf")}
+        for _ in range(rounds):
+            best["plain"] = min(best["plain"], await run(app, False))
+            best["metrics"] = min(best["metrics"], await run(instrumented, False))
+            best["tracing"] = min(best["tracing"], await run(instrumented, True))
+        return best
+
+    best = asyncio.run(compare())
+    print(f"{'bare ASGI app':<28} {best['plain']:8.2f} us/request")
+    print(f"{'with metrics':<28} {best['metrics']:8.2f} us/request (+{best['metrics'] - best['plain']:.2f} us)")
+    print(f"{'with metrics and tracing':<28} {best['tracing']:8.2f} us/request (+{best['tracing'] - best['plain']:.2f} us)")
+
+
+def _rss_kib(pid):
+    """Resident set size of a process, from /proc"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _worker_pids(master):
+    """Worker processes of a uvicorn supervisor, or the supervisor itself"""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == master and b"resource_tracker" not in cmdline:
+            pids.append(int(entry))
+    return pids or [master]
+
+
+def _load_process(port, path, headers, connections, duration):
+    """Keep-alive GETs of ``path`` from one process; (responses, latency samples in ms)"""
+    import asyncio
+
+    request = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n{headers}\r\n".encode()
+
+    async def connection(deadline, samples):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        count = 0
+        while time.perf_counter() < deadline:
+            began = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            assert head.startswith(b"HTTP/1.1 200"), head.split(b"\r\n", 1)[0]
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            await reader.readexactly(length)
+            count += 1
+            if count % 10 == 0:
+                samples.append((time.perf_counter() - began) * 1000)
+        writer.close()
+        return count
+
+    async def run():
+        samples = []
+        deadline = time.perf_counter() + duration
+        counts = await asyncio.gather(*(connection(deadline, samples) for _ in range(connections)))
+        return sum(counts), samples
+
+    return asyncio.run(run())
+
+
+def bench_workers(mongo_url, worker_counts, duration, connections, load_procs, port=8765):
+    """Throughput, startup time and memory of ``uvicorn --workers N``.
+
+    Starts the app factory with each worker count in turn against
+    MONGO_URL and drives /api/auth/me, which the principal cache keeps off
+    the database, from ``load_procs`` client processes. The clients need
+    cores of their own, or they compete with the workers and flatten the
+    curve.
+    """
+    import re
+    import signal
+    import subprocess
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+
+    cores = os.cpu_count() or 1
+    if max(worker_counts) + load_procs > cores:
+        print(f"Warning: {max(worker_counts)} workers + {load_procs} load processes on {cores} cores; "
+              f"scaling will be limited by the machine, not the server")
+    db_name = f"terabox_bench_workers_{uuid.uuid4().hex[:8]}"
+    env = dict(os.environ, MONGO_URL=mongo_url, DB_NAME=db_name, RECONCILE_INTERVAL_HOURS="0")
+    base_url = f"http://127.0.0.1:{port}"
+    baseline = None
+    try:
+        for workers in worker_counts:
+            started = time.perf_counter()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "--factory", "server:create_app",
+                 "--port", str(port), "--workers", str(workers), "--log-level", "info"],
+                cwd=Path(__file__).parent / "backend", env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+            )
+            startup_ms = []
+            try:
+                # Each worker logs its own startup time once its pool is warm
+                while len(startup_ms) < workers:
+                    line = server.stderr.readline()
+                    if not line:
+                        raise RuntimeError(f"server exited with {server.wait()}")
+                    match = re.search(r"Worker \d+ started in (\d+) ms", line)
+                    if match:
+                        startup_ms.append(int(match.group(1)))
+                ready = time.perf_counter() - started
+                threading.Thread(target=server.stderr.read, daemon=True).start()
+
+                user = {"name": "Bench User", "email": f"bench.{uuid.uuid4().hex[:12]}@example.com",
+                        "password": "BenchPass123!"}
+                for _ in range(50):
+                    try:
+                        requests.post(f"{base_url}/api/auth/register", json=user).raise_for_status()
+                        break
+                    except requests.ConnectionError:
+                        time.sleep(0.1)
+                token = requests.post(f"{base_url}/api/auth/login", json={
+                    "email": user["email"], "password": user["password"]}).json()["access_token"]
+                headers = f"Authorization: Bearer {token}\r\n"
+
+                with ProcessPoolExecutor(max_workers=load_procs) as pool:
+                    # A short warmup fills each worker's principal cache
+                    list(pool.map(_load_process, *zip(*[(port, "/api/auth/me", headers, 4, 1.0)] * load_procs)))
+                    results = list(pool.map(_load_process, *zip(*[
+                        (port, "/api/auth/me", headers, connections, duration)] * load_procs)))
+                total = sum(count for count, _ in results)
+                samples = [s for _, result in results for s in result]
+                rss = [_rss_kib(pid) / 1024 for pid in _worker_pids(server.pid)]
+            finally:
+                server.send_signal(signal.SIGINT)
+                server.wait(timeout=30)
+
+            rate = total / duration
+            baseline = baseline or rate / workers
+            print(
+                f"workers={workers:<3} rate={rate:9.1f}req/s "
+                f"scaling={rate / baseline:5.2f}x ({rate / baseline / workers * 100:3.0f}% of linear) "
+                f"p50={percentile(samples, 50):7.2f}ms p99={percentile(samples, 99):7.2f}ms"
+            )
+            print(
+                f"{'':<11} ready={ready * 1000:7.0f}ms worker startup={min(startup_ms)}-{max(startup_ms)}ms "
+                f"rss/worker={sum(rss) / len(rss):6.1f}MiB"
+            )
+    finally:
+        from pymongo import MongoClient
+
+        client = MongoClient(mongo_url)
+        client.drop_database(db_name)
+        client.close()
+
+
+def main():
+    """Main function to run a benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    upload = sub.add_parser("upload-latency", help="auth/me latency during large uploads")
+    upload.add_argument("--uploads", type=int, default=4)
+    upload.add_argument("--size-mb", type=int, default=256)
+    upload.add_argument("--duration", type=float, default=5.0)
+
+    ranges = sub.add_parser("range-throughput", help="concurrent byte-range reads of one file")
+    ranges.add_argument("--size-mb", type=int, default=1024)
+    ranges.add_argument("--clients", type=int, default=32)
+    ranges.add_argument("--requests", type=int, default=200)
+    ranges.add_argument("--range-kb", type=int, default=256)
+
+    storm = sub.add_parser("login-storm", help="concurrent logins against one account")
+    storm.add_argument("--clients", type=int, default=64)
+    storm.add_argument("--logins", type=int, default=20)
+
+    small = sub.add_parser("small-files", help="small-file upload throughput, single vs batch")
+    small.add_argument("--files", type=int, default=2000)
+    small.add_argument("--size-kb", type=int, default=200)
+    small.add_argument("--batch", type=int, default=100)
+    small.add_argument("--clients", type=int, default=8)
+
+    photos = sub.add_parser("photo-burst", help="auth/me latency while photos are uploaded and thumbnailed")
+    photos.add_argument("--files", type=int, default=10000)
+    photos.add_argument("--batch", type=int, default=100)
+    photos.add_argument("--clients", type=int, default=8)
+    photos.add_argument("--megapixels", type=float, default=2.0)
+
+    overhead = sub.add_parser("metrics-overhead", help="per-request cost of the metrics middleware (no server)")
+    overhead.add_argument("--requests", type=int, default=100000)
+
+    compress = sub.add_parser("compression", help="space saved and CPU cost of at-rest compression (no server)")
+    compress.add_argument("--corpus", help="directory of sample files; synthetic logs/CSV/JSON if omitted")
+    compress.add_argument("--size-mb", type=int, default=64, help="size of each synthetic sample")
+
+    serialization = sub.add_parser("listing-serialization", help="CPU cost of encoding a file listing (no server)")
+    serialization.add_argument("--rows", type=int, default=10000)
+
+    searching = sub.add_parser("search", help="filename search latency on a large synthetic account (needs MONGO_URL)")
+    searching.add_argument("--files", type=int, default=1000000)
+    searching.add_argument("--queries", type=int, default=100, help="queries per kind")
+    searching.add_argument("--db", help="keep the seeded data in this database for later runs")
+
+    scaling = sub.add_parser("workers", help="throughput, startup time and memory per uvicorn worker count (needs MONGO_URL)")
+    scaling.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4, 8, 16) if n <= (os.cpu_count() or 1)),
+                         help="comma-separated worker counts")
+    scaling.add_argument("--duration", type=float, default=10.0)
+    scaling.add_argument("--connections", type=int, default=32, help="keep-alive connections per load process")
+    scaling.add_argument("--load-procs", type=int, default=max(1, (os.cpu_count() or 1) // 2))
+    scaling.add_argument("--port", type=int, default=8765)
+
+    args = parser.parse_args()
+    if args.bench == "workers":
+        bench_workers(os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+                      [int(n) for n in args.workers.split(",")], args.duration, args.connections,
+                      args.load_procs, args.port)
+        return
+    if args.bench == "listing-serialization":
+        bench_listing_serialization(args.rows)
+        return
+    if args.bench == "search":
+        bench_search(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), args.files, args.queries, args.db)
+        return
+    if args.bench == "compression":
+        bench_compression(args.corpus, args.size_mb)
+        return
+    if args.bench == "metrics-overhead":
+        bench_metrics_overhead(args.requests)
+        return
+    print(f"Backend URL: {BASE_URL}")
+    bench = TeraBoxBenchmark()
+    bench.login()
+
+    if args.bench == "upload-latency":
+        bench.bench_upload_latency(args.uploads, args.size_mb, args.duration)
+    elif args.bench == "range-throughput":
+        bench.bench_range_throughput(args.size_mb, args.clients, args.requests, args.range_kb)
+    elif args.bench == "login-storm":
+        bench.bench_login_storm(args.clients, args.logins)
+    elif args.bench == "small-files":
+        bench.bench_small_files(args.files, args.size_kb, args.batch, args.clients)
+    elif args.bench == "photo-burst":
+        bench.bench_photo_burst(args.files, args.batch, args.clients, args.megapixels)
+
+if __name__ == "__main__":
+    main()
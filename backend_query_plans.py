@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+TeraBox Query Plan Checks
+Runs every query the API issues through explain() against a local mongod and
+fails if any of them falls back to a collection scan.
+
+    MONGO_URL=mongodb://localhost:27017 python backend_query_plans.py
+"""
+
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from indexes import ensure_indexes  # noqa: E402
+from listing import SORT_FIELDS, encode_cursor, mime_type_filter, page_query  # noqa: E402
+from search import exact_query, search_query  # noqa: E402
+
+USER_ID = ObjectId()
+FILE_ID = ObjectId()
+FOLDER_ID = ObjectId()
+
+
+def endpoint_queries():
+    """(description, explain command) for each query an endpoint runs"""
+    queries = [
+        ("register/login: users by email",
+         {"find": "users", "filter": {"email": "someone@example.com"}, "limit": 1}),
+        ("get_current_user: users by _id",
+         {"find": "users", "filter": {"_id": USER_ID}, "limit": 1}),
+        ("quota: expired reservations",
+         {"find": "users", "filter": {"reservations.expires_at": {"$lt": datetime.utcnow()}}}),
+        ("dashboard: count files by user",
+         {"count": "files", "query": {"user_id": USER_ID}}),
+        ("delete/download: file by _id and user",
+         {"find": "files", "filter": {"_id": FILE_ID, "user_id": USER_ID}, "limit": 1}),
+        ("blobs: acquire by digest",
+         {"findAndModify": "blobs",
+          "query": {"_id": "0" * 64, "size": 1, "state": "live"},
+          "update": {"$inc": {"refcount": 1}}}),
+        ("reclaimer: lease due entries",
+         {"find": "reclaim_queue", "filter": {"lease_until": {"$lte": datetime.utcnow()}}, "limit": 500}),
+        ("reclaimer: read back leased batch",
+         {"find": "reclaim_queue", "filter": {"owner": "0" * 32}}),
+        ("thumbnails: lease pending jobs",
+         {"find": "thumbnails", "filter": {"state": "pending", "lease_until": {"$lte": datetime.utcnow()}}, "limit": 100}),
+        ("thumbnails: read back leased batch",
+         {"find": "thumbnails", "filter": {"owner": "0" * 32, "state": "pending"}}),
+        ("upload sessions: by _id and user",
+         {"find": "upload_sessions", "filter": {"_id": ObjectId(), "user_id": USER_ID}, "limit": 1}),
+        ("upload sessions: expired cleanup",
+         {"find": "upload_sessions", "filter": {"status": "open", "expires_at": {"$lt": datetime.utcnow()}}}),
+    ]
+
+    sample = {
+        "_id": FILE_ID,
+        "uploaded_at": datetime.utcnow(),
+        "original_name": "report.pdf",
+        "size": 1024,
+    }
+    for sort in SORT_FIELDS:
+        for order in ("asc", "desc"):
+            for cursor in (None, encode_cursor(sort, order, sample)):
+                query, sort_spec = page_query(USER_ID, sort, order, cursor)
+                label = f"list files: sort={sort} order={order}{' +cursor' if cursor else ''}"
+                queries.append((label, {
+                    "find": "files",
+                    "filter": query,
+                    "sort": dict(sort_spec),
+                    "limit": 100,
+                }))
+    for sort in SORT_FIELDS:
+        query, sort_spec = page_query(USER_ID, sort, "asc", None)
+        queries.append((f"list folder: sort={sort}", {
+            "find": "files",
+            "filter": {**query, "parent_id": FOLDER_ID},
+            "sort": dict(sort_spec),
+            "limit": 100,
+        }))
+    queries += [
+        ("folders: subfolders by name",
+         {"find": "folders", "filter": {"user_id": USER_ID, "parent_id": FOLDER_ID}, "sort": {"name_key": 1}}),
+        ("folders: next page of subfolders",
+         {"find": "folders", "filter": {"user_id": USER_ID, "parent_id": FOLDER_ID, "name_key": {"$gt": "m"}},
+          "sort": {"name_key": 1}, "limit": 101}),
+        ("folders: whole subtree",
+         {"find": "folders", "filter": {"user_id": USER_ID, "ancestors": FOLDER_ID}}),
+        ("folders: delete subtree files",
+         {"find": "files", "filter": {"user_id": USER_ID, "parent_id": {"$in": [FOLDER_ID, ObjectId()]},
+                                      "deleting": {"$exists": False}}, "limit": 1000}),
+        ("folders: detach files uploaded into a deleted folder",
+         {"update": "files", "updates": [{"q": {"user_id": {"$in": [USER_ID]}, "parent_id": {"$in": [FOLDER_ID]}},
+                                          "u": {"$set": {"parent_id": None}}, "multi": True}]}),
+    ]
+    claimed_batch = {"_id": {"$in": [FILE_ID, ObjectId()]}, "deleting": ObjectId()}
+    queries += [
+        ("delete: claim batch",
+         {"update": "files", "updates": [{"q": {"_id": {"$in": [FILE_ID, ObjectId()]}, "deleting": {"$exists": False}},
+                                          "u": {"$set": {"deleting": ObjectId()}}, "multi": True}]}),
+        ("delete: read back claimed batch", {"find": "files", "filter": claimed_batch}),
+        ("delete: remove claimed batch", {"delete": "files", "deletes": [{"q": claimed_batch, "limit": 0}]}),
+    ]
+    queries += [
+        ("reconcile: files naming stored objects",
+         {"find": "files", "filter": {"filename": {"$in": ["a" * 64, "legacy.txt"]}}, "projection": {"path": 1}}),
+        ("reconcile: queued for reclaim",
+         {"find": "reclaim_queue", "filter": {"path": {"$in": ["/uploads/ab/cd/abcd"]}}, "projection": {"path": 1}}),
+        ("reconcile: files batch",
+         {"find": "files", "filter": {"deleting": {"$exists": False}, "_id": {"$gt": ObjectId()}},
+          "sort": {"_id": 1}, "limit": 500}),
+    ]
+    for terms, mime_type in ((["report"], None), (["img", "2024"], None), (["holiday"], "image")):
+        label = f"{' '.join(terms)}{f' type={mime_type}' if mime_type else ''}"
+        mime_filter = mime_type_filter(mime_type) if mime_type else None
+        prefix = search_query(USER_ID, terms, mime_filter)
+        prefix["$and"].append({"name_tokens": {"$not": {"$all": terms}}})
+        queries += [
+            (f"search files, whole words: {label}",
+             {"find": "files", "filter": exact_query(USER_ID, terms, mime_filter), "limit": 2001}),
+            (f"search files, prefixes: {label}",
+             {"find": "files", "filter": prefix, "limit": 2001}),
+        ]
+    return queries
+
+
+def collscans(plan):
+    """Yield every COLLSCAN stage in an explain plan tree"""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            yield plan
+        for value in plan.values():
+            yield from collscans(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from collscans(value)
+
+
+async def run():
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db_name = f"query_plans_{uuid.uuid4().hex[:8]}"
+    db = client[db_name]
+    failures = 0
+    try:
+        await ensure_indexes(db)
+        for label, command in endpoint_queries():
+            result = await db.command({"explain": command, "verbosity": "queryPlanner"})
+            winning = result["queryPlanner"]["winningPlan"]
+            if any(collscans(winning)):
+                failures += 1
+                print(f"❌ {label}: COLLSCAN")
+            else:
+                print(f"✅ {label}")
+    finally:
+        await client.drop_database(db_name)
+        client.close()
+
+    print(f"\n{failures} queries without a usable index")
+    return failures
+
+
+if __name__ == "__main__":
+    sys.exit(1 if asyncio.run(run()) else 0)
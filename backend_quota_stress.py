@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+TeraBox Quota Stress Test
+Hammers quota reservations from many concurrent uploads and checks that a
+user's storage_limit is never exceeded.
+
+The first phase drives backend/quota.py directly against a local mongod,
+with several clients standing in for several API workers. The second phase
+(--api) races real uploads against a running backend; it needs the backend's
+database to lower the test user's limit.
+
+    MONGO_URL=mongodb://localhost:27017 python backend_quota_stress.py
+    MONGO_URL=... DB_NAME=... python backend_quota_stress.py --api
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
+import requests
+from bson import ObjectId
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+
+from quota import (  # noqa: E402
+    reserve_quota, commit_reservation, release_reservation, sweep_expired_reservations
+)
+from backend_bench import API_BASE  # noqa: E402
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+LIMIT = 10 * 1024 * 1024
+
+
+class QuotaStress:
+    def __init__(self, workers: int, uploads: int):
+        self.workers = workers
+        self.uploads = uploads
+        self.violations = []
+        self.committed = 0
+        self.outcomes = {"committed": 0, "released": 0, "abandoned": 0, "rejected": 0}
+
+    async def upload(self, db, user_id):
+        size = random.randint(1, LIMIT // 8)
+        abandon = random.random() < 0.05
+        try:
+            # Abandoned reservations get a short lifetime so the sweep sees them
+            reservation = await reserve_quota(
+                db, user_id, size, ttl=timedelta(seconds=1) if abandon else timedelta(minutes=5)
+            )
+        except HTTPException as e:
+            assert e.status_code == 413
+            self.outcomes["rejected"] += 1
+            return
+        await asyncio.sleep(random.uniform(0, 0.01))
+        if abandon:
+            self.outcomes["abandoned"] += 1
+        elif random.random() < 0.2:
+            await release_reservation(db, reservation)
+            self.outcomes["released"] += 1
+        else:
+            # Uploads often turn out smaller than the bytes reserved for them
+            used = random.randint(0, size)
+            await commit_reservation(db, reservation, used)
+            self.committed += used
+            self.outcomes["committed"] += 1
+
+    async def monitor(self, db, user_id, done: asyncio.Event):
+        while not done.is_set():
+            user = await db.users.find_one({"_id": user_id})
+            total = user["storage_used"] + user["storage_reserved"]
+            if total > user["storage_limit"] or user["storage_reserved"] < 0:
+                self.violations.append(
+                    f"used={user['storage_used']} reserved={user['storage_reserved']} limit={user['storage_limit']}"
+                )
+            await asyncio.sleep(0)
+
+    async def run(self) -> bool:
+        db_name = f"quota_stress_{uuid.uuid4().hex[:8]}"
+        clients = [AsyncIOMotorClient(MONGO_URL) for _ in range(self.workers)]
+        dbs = [client[db_name] for client in clients]
+        user_id = ObjectId()
+        try:
+            await dbs[0].users.insert_one({
+                "_id": user_id, "storage_used": 0, "storage_reserved": 0, "storage_limit": LIMIT
+            })
+            done = asyncio.Event()
+            monitor = asyncio.create_task(self.monitor(dbs[0], user_id, done))
+            await asyncio.gather(*(
+                self.upload(dbs[i % self.workers], user_id) for i in range(self.uploads)
+            ))
+            done.set()
+            await monitor
+
+            # Let the abandoned reservations expire, then sweep them
+            await asyncio.sleep(1.1)
+            await sweep_expired_reservations(dbs[0])
+            user = await dbs[0].users.find_one({"_id": user_id})
+        finally:
+            await clients[0].drop_database(db_name)
+            for client in clients:
+                client.close()
+
+        print(f"Outcomes: {self.outcomes}")
+        print(f"Final: used={user['storage_used']} reserved={user['storage_reserved']} limit={LIMIT}")
+        ok = True
+        if self.violations:
+            ok = False
+            print(f"❌ Quota exceeded {len(self.violations)} times, e.g. {self.violations[0]}")
+        if user["storage_used"] != self.committed:
+            ok = False
+            print(f"❌ storage_used {user['storage_used']} != committed {self.committed}")
+        if user["storage_reserved"] != 0 or user.get("reservations"):
+            ok = False
+            print(f"❌ {len(user.get('reservations', []))} reservations left after the sweep")
+        if ok:
+            print("✅ Quota never exceeded and every reservation was accounted for")
+        return ok
+
+
+def api_stress(uploads: int, size: int) -> bool:
+    """Race uploads through the API against a nearly full account"""
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / "backend" / ".env")
+    email = f"quota_{uuid.uuid4().hex[:8]}@example.com"
+    requests.post(f"{API_BASE}/auth/register", json={"name": "Quota", "email": email, "password": "quota-stress"})
+    login = requests.post(f"{API_BASE}/auth/login", json={"email": email, "password": "quota-stress"})
+    token = login.json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    async def set_limit():
+        client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+        try:
+            await client[os.environ["DB_NAME"]].users.update_one(
+                {"email": email}, {"$set": {"storage_limit": LIMIT}}
+            )
+        finally:
+            client.close()
+    asyncio.run(set_limit())
+
+    payload = os.urandom(size)
+
+    def upload(i):
+        return requests.post(
+            f"{API_BASE}/files/upload",
+            files={"file": (f"quota_{i}.bin", payload, "application/octet-stream")},
+            headers=headers
+        ).status_code
+
+    with ThreadPoolExecutor(max_workers=uploads) as pool:
+        codes = list(pool.map(upload, range(uploads)))
+    user = requests.get(f"{API_BASE}/auth/me", headers=headers).json()
+    stored = sum(f["size"] for f in requests.get(f"{API_BASE}/files", headers=headers).json())
+
+    accepted = codes.count(200)
+    print(f"API: {accepted} accepted, {codes.count(413)} rejected, used={user['storage_used']} limit={LIMIT}")
+    ok = user["storage_used"] <= LIMIT and stored == user["storage_used"] and accepted <= LIMIT // size
+    print("✅ API uploads stayed within quota" if ok else "❌ API uploads exceeded the quota")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="database clients standing in for API workers")
+    parser.add_argument("--uploads", type=int, default=2000, help="concurrent reservations to race")
+    parser.add_argument("--api", action="store_true", help="also race uploads through a running backend")
+    parser.add_argument("--api-uploads", type=int, default=32)
+    parser.add_argument("--api-size-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    ok = asyncio.run(QuotaStress(args.workers, args.uploads).run())
+    if args.api:
+        ok = api_stress(args.api_uploads, args.api_size_kb * 1024) and ok
+    sys.exit(0 if ok else 1)
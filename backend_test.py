@@ -1,333 +1,512 @@
 #!/usr/bin/env python3
 """
-TeraBox Backend API Testing Suite
-Tests all authentication and file management endpoints
+TeraBox Backend Load Test
+Drives a weighted mix of API operations at a fixed concurrency and reports
+throughput and latency percentiles per operation.
+
+The API is reached over HTTP or run in-process (against a scratch mongod
+or an in-memory mock), so the same mix runs on a laptop and in CI:
+
+    python backend_test.py smoke --in-process --mongo mock
+    python backend_test.py run --url http://localhost:8001 --mix login=1,small-upload=4,listing=2
+    python backend_test.py run --in-process --mongo mongodb://localhost:27017 \\
+        --duration 60 --concurrency 64 --save-baseline baselines/main.json
+    python backend_test.py run --in-process --mongo mock --compare baselines/main.json --tolerance 0.25
+
+Operations: login, me, small-upload, large-upload, listing, range,
+download, stats. With --compare the run fails (exit 1) when an
+operation's p95 latency or throughput is worse than the baseline by more
+than the tolerance.
 """
 
-import requests
+import argparse
+import asyncio
+import hashlib
 import json
+import math
 import os
+import platform
+import random
+import shutil
+import sys
 import tempfile
-from pathlib import Path
 import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
 
-# Get backend URL from frontend .env file
-def get_backend_url():
-    frontend_env_path = Path("/app/frontend/.env")
-    if frontend_env_path.exists():
-        with open(frontend_env_path, 'r') as f:
-            for line in f:
-                if line.startswith('REACT_APP_BACKEND_URL='):
-                    return line.split('=', 1)[1].strip()
-    return "http://localhost:8001"
-
-BASE_URL = get_backend_url()
-API_BASE = f"{BASE_URL}/api"
-
-class TeraBoxAPITester:
-    def __init__(self):
-        self.session = requests.Session()
-        self.access_token = None
-        self.user_data = None
-        self.uploaded_files = []
-        
-    def test_auth_register(self):
-        """Test user registration endpoint"""
-        print("🔐 Testing user registration...")
-        
-        # Use realistic test data
-        test_user = {
-            "name": "Sarah Johnson",
-            "email": f"sarah.johnson.{int(time.time())}@example.com",
-            "password": "SecurePass123!"
-        }
-        
-        try:
-            response = self.session.post(f"{API_BASE}/auth/register", json=test_user)
-            print(f"Registration response status: {response.status_code}")
-            print(f"Registration response: {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print("✅ User registration successful")
-                print(f"User ID: {data.get('user_id')}")
-                self.test_user = test_user  # Store for login
-                return True
-            else:
-                print(f"❌ Registration failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Registration error: {str(e)}")
-            return False
-    
-    def test_auth_login(self):
-        """Test user login endpoint"""
-        print("\n🔐 Testing user login...")
-        
-        if not hasattr(self, 'test_user'):
-            print("❌ No test user available for login")
-            return False
-            
-        login_data = {
-            "email": self.test_user["email"],
-            "password": self.test_user["password"]
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+CHUNK = 1024 * 1024
+DEFAULT_MIX = "login=1,me=4,small-upload=4,listing=3,range=4,stats=1"
+# Operations with fewer samples than this are too noisy to compare
+MIN_COMPARE_SAMPLES = 20
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    # Nearest-rank
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+@dataclass
+class OpStats:
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: int = 0
+    nbytes: int = 0
+    last_error: Optional[str] = None
+
+    def summary(self, elapsed: float) -> dict:
+        return {
+            "count": len(self.latencies_ms),
+            "errors": self.errors,
+            "throughput": len(self.latencies_ms) / elapsed if elapsed else 0.0,
+            "mib_per_s": self.nbytes / CHUNK / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(self.latencies_ms, 50),
+            "p95_ms": percentile(self.latencies_ms, 95),
+            "p99_ms": percentile(self.latencies_ms, 99),
+            "max_ms": max(self.latencies_ms, default=0.0),
         }
-        
-        try:
-            response = self.session.post(f"{API_BASE}/auth/login", json=login_data)
-            print(f"Login response status: {response.status_code}")
-            print(f"Login response: {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                self.access_token = data.get("access_token")
-                self.user_data = data.get("user")
-                
-                # Set authorization header for future requests
-                self.session.headers.update({
-                    "Authorization": f"Bearer {self.access_token}"
-                })
-                
-                print("✅ User login successful")
-                print(f"Access token received: {self.access_token[:20]}...")
-                print(f"User info: {self.user_data}")
-                return True
-            else:
-                print(f"❌ Login failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Login error: {str(e)}")
-            return False
-    
-    def test_auth_me(self):
-        """Test get current user info endpoint"""
-        print("\n🔐 Testing get current user info...")
-        
-        if not self.access_token:
-            print("❌ No access token available")
-            return False
-            
-        try:
-            response = self.session.get(f"{API_BASE}/auth/me")
-            print(f"Get user info response status: {response.status_code}")
-            print(f"Get user info response: {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print("✅ Get current user info successful")
-                print(f"User details: {data}")
-                return True
-            else:
-                print(f"❌ Get user info failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Get user info error: {str(e)}")
-            return False
-    
-    def test_file_upload(self):
-        """Test file upload endpoint"""
-        print("\n📁 Testing file upload...")
-        
-        if not self.access_token:
-            print("❌ No access token available")
-            return False
-            
-        # Create a test file
-        test_content = "This is a test file for TeraBox upload functionality.\nCreated for API testing purposes."
-        
-        try:
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False) as temp_file:
-                temp_file.write(test_content)
-                temp_file_path = temp_file.name
-            
-            with open(temp_file_path, 'rb') as f:
-                files = {
-                    'file': ('test_document.txt', f, 'text/plain')
-                }
-                
-                response = self.session.post(f"{API_BASE}/files/upload", files=files)
-                print(f"File upload response status: {response.status_code}")
-                print(f"File upload response: {response.text}")
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    file_id = data.get("file_id")
-                    self.uploaded_files.append(file_id)
-                    print("✅ File upload successful")
-                    print(f"File ID: {file_id}")
-                    print(f"Filename: {data.get('filename')}")
-                    return True
-                else:
-                    print(f"❌ File upload failed: {response.text}")
-                    return False
-                    
-        except Exception as e:
-            print(f"❌ File upload error: {str(e)}")
-            return False
-        finally:
-            # Clean up temp file
+
+
+@dataclass
+class User:
+    email: str
+    password: str
+    token: str = ""
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def multipart_body(boundary: str, filename: str, size: int):
+    """A multipart/form-data body of ``size`` random bytes, generated as it is
+    sent, and its total length"""
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        block = os.urandom(CHUNK)
+        sent = 0
+        while sent < size:
+            n = min(CHUNK, size - sent)
+            # Vary each block so the blob store can't deduplicate the file
+            yield sent.to_bytes(8, "big") + block[8:n] if n > 8 else block[:n]
+            sent += n
+        yield tail
+
+    return body(), len(head) + size + len(tail)
+
+
+class LoadTest:
+    """Sets up accounts and data for a mix, runs it and cleans up"""
+
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.users: List[User] = []
+        self.listing_user: Optional[User] = None
+        self.range_file: Optional[str] = None
+        self.range_size = 0
+        self.stats: Dict[str, OpStats] = {}
+
+    async def check(self, response: httpx.Response, *expected: int) -> httpx.Response:
+        if response.status_code not in (expected or (200,)):
+            raise RuntimeError(f"{response.request.method} {response.request.url.path}: "
+                               f"{response.status_code} {response.text[:200]}")
+        return response
+
+    async def register(self) -> User:
+        user = User(f"load.{uuid.uuid4().hex[:16]}@example.com", "LoadTest123!")
+        await self.check(await self.client.post(
+            "/api/auth/register", json={"name": "Load Test", "email": user.email, "password": user.password}
+        ))
+        response = await self.check(await self.client.post(
+            "/api/auth/login", json={"email": user.email, "password": user.password}
+        ))
+        user.token = response.json()["access_token"]
+        return user
+
+    async def upload(self, user: User, name: str, data: bytes, mime_type="application/octet-stream") -> str:
+        response = await self.check(await self.client.post(
+            "/api/files/upload", files={"file": (name, data, mime_type)}, headers=user.headers
+        ))
+        return response.json()["file_id"]
+
+    async def setup(self, mix: Dict[str, float]):
+        args = self.args
+        print(f"Registering {args.users} users")
+        self.users = list(await asyncio.gather(*(self.register() for _ in range(args.users))))
+
+        if "range" in mix or "download" in mix:
+            self.range_size = args.range_file_mb * CHUNK
+            print(f"Uploading a {args.range_file_mb} MiB file for range reads")
+            self.range_file = await self.upload(self.users[0], "range.bin", os.urandom(self.range_size))
+
+        if "listing" in mix:
+            self.listing_user = await self.register()
+            await self.seed_files(self.listing_user, args.listing_files)
+
+    async def seed_files(self, user: User, count: int):
+        """Give ``user`` ``count`` files cheaply: one upload, then instant copies"""
+        print(f"Seeding {count} files for the listing account")
+        content = os.urandom(1024)
+        await self.upload(user, "seed.bin", content)
+        digest = hashlib.sha256(content).hexdigest()
+        queue = iter(range(1, count))
+        started = time.perf_counter()
+
+        async def worker():
+            for i in queue:
+                await self.check(await self.client.post("/api/files/instant", json={
+                    "filename": f"file-{i:06d}.bin", "size": len(content), "sha256": digest,
+                    "mime_type": "application/octet-stream",
+                }, headers=user.headers))
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+    async def cleanup(self):
+        for user in self.users + ([self.listing_user] if self.listing_user else []):
             try:
-                os.unlink(temp_file_path)
-            except:
+                await self.client.post(
+                    "/api/files/bulk-delete", json={"uploaded_before": "2100-01-01T00:00:00"}, headers=user.headers
+                )
+            except httpx.HTTPError:
                 pass
-    
-    def test_get_files(self):
-        """Test get user files endpoint"""
-        print("\n📁 Testing get user files...")
-        
-        if not self.access_token:
-            print("❌ No access token available")
-            return False
-            
-        try:
-            response = self.session.get(f"{API_BASE}/files")
-            print(f"Get files response status: {response.status_code}")
-            print(f"Get files response: {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print("✅ Get user files successful")
-                print(f"Number of files: {len(data)}")
-                if data:
-                    print(f"First file: {data[0]}")
-                return True
-            else:
-                print(f"❌ Get files failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Get files error: {str(e)}")
-            return False
-    
-    def test_file_download(self):
-        """Test file download endpoint"""
-        print("\n📁 Testing file download...")
-        
-        if not self.access_token or not self.uploaded_files:
-            print("❌ No access token or uploaded files available")
-            return False
-            
-        file_id = self.uploaded_files[0]
-        
-        try:
-            response = self.session.get(f"{API_BASE}/files/{file_id}/download")
-            print(f"File download response status: {response.status_code}")
-            
-            if response.status_code == 200:
-                print("✅ File download successful")
-                print(f"Content type: {response.headers.get('content-type')}")
-                print(f"Content length: {len(response.content)} bytes")
-                return True
-            else:
-                print(f"❌ File download failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ File download error: {str(e)}")
-            return False
-    
-    def test_dashboard_stats(self):
-        """Test dashboard stats endpoint"""
-        print("\n📊 Testing dashboard stats...")
-        
-        if not self.access_token:
-            print("❌ No access token available")
-            return False
-            
-        try:
-            response = self.session.get(f"{API_BASE}/dashboard/stats")
-            print(f"Dashboard stats response status: {response.status_code}")
-            print(f"Dashboard stats response: {response.text}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print("✅ Dashboard stats successful")
-                print(f"Stats: {data}")
-                return True
-            else:
-                print(f"❌ Dashboard stats failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Dashboard stats error: {str(e)}")
-            return False
-    
-    def test_file_delete(self):
-        """Test file delete endpoint"""
-        print("\n📁 Testing file delete...")
-        
-        if not self.access_token or not self.uploaded_files:
-            print("❌ No access token or uploaded files available")
-            return False
-            
-        file_id = self.uploaded_files[0]
-        
+
+    # Operations; each returns the number of payload bytes moved
+
+    async def op_login(self, state) -> int:
+        user = random.choice(self.users)
+        await self.check(await self.client.post(
+            "/api/auth/login", json={"email": user.email, "password": user.password}
+        ), 200, 503)
+        return 0
+
+    async def op_me(self, state) -> int:
+        await self.check(await self.client.get("/api/auth/me", headers=random.choice(self.users).headers))
+        return 0
+
+    async def op_small_upload(self, state) -> int:
+        size = self.args.small_kb * 1024
+        await self.upload(random.choice(self.users), f"small-{uuid.uuid4().hex[:8]}.bin",
+                          uuid.uuid4().bytes + os.urandom(size - 16))
+        return size
+
+    async def op_large_upload(self, state) -> int:
+        size = self.args.large_mb * CHUNK
+        boundary = uuid.uuid4().hex
+        body, length = multipart_body(boundary, "large.bin", size)
+        # With a length the server reserves it up front instead of growing
+        # the reservation step by step as the body arrives
+        await self.check(await self.client.post(
+            "/api/files/upload",
+            content=body,
+            headers={**random.choice(self.users).headers,
+                     "Content-Type": f"multipart/form-data; boundary={boundary}",
+                     "Content-Length": str(length)},
+        ))
+        return size
+
+    async def op_listing(self, state) -> int:
+        # Each worker pages through the account and starts over at the end
+        params = {"limit": self.args.page_size}
+        if state.get("cursor"):
+            params["cursor"] = state["cursor"]
+        response = await self.check(await self.client.get(
+            "/api/files", params=params, headers=self.listing_user.headers
+        ))
+        state["cursor"] = response.headers.get("x-next-cursor")
+        return len(response.content)
+
+    async def op_range(self, state) -> int:
+        length = self.args.range_kb * 1024
+        start = random.randrange(0, max(1, self.range_size - length))
+        response = await self.check(await self.client.get(
+            f"/api/files/{self.range_file}/download",
+            headers={**self.users[0].headers, "Range": f"bytes={start}-{start + length - 1}"}
+        ), 206)
+        return len(response.content)
+
+    async def op_download(self, state) -> int:
+        response = await self.check(await self.client.get(
+            f"/api/files/{self.range_file}/download", headers=self.users[0].headers
+        ))
+        return len(response.content)
+
+    async def op_stats(self, state) -> int:
+        await self.check(await self.client.get("/api/dashboard/stats", headers=random.choice(self.users).headers))
+        return 0
+
+    async def run_mix(self, mix: Dict[str, float], concurrency: int, duration: float, warmup: float) -> float:
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        self.stats = {name: OpStats() for name in names}
+        measuring_from = time.perf_counter() + warmup
+        deadline = measuring_from + duration
+
+        async def worker():
+            state = {}
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    return
+                name = random.choices(names, weights)[0]
+                began = time.perf_counter()
+                try:
+                    nbytes = await OPERATIONS[name](self, state)
+                except (RuntimeError, httpx.HTTPError) as e:
+                    if began >= measuring_from:
+                        self.stats[name].errors += 1
+                        self.stats[name].last_error = str(e)
+                    continue
+                if began >= measuring_from:
+                    stats = self.stats[name]
+                    stats.latencies_ms.append((time.perf_counter() - began) * 1000)
+                    stats.nbytes += nbytes
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - measuring_from
+
+
+OPERATIONS = {
+    "login": LoadTest.op_login,
+    "me": LoadTest.op_me,
+    "small-upload": LoadTest.op_small_upload,
+    "large-upload": LoadTest.op_large_upload,
+    "listing": LoadTest.op_listing,
+    "range": LoadTest.op_range,
+    "download": LoadTest.op_download,
+    "stats": LoadTest.op_stats,
+}
+
+
+def print_report(results: Dict[str, dict], elapsed: float, concurrency: int):
+    print(f"\n{concurrency} concurrent clients for {elapsed:.1f}s")
+    print(f"{'operation':<14} {'count':>7} {'errors':>6} {'ops/s':>8} {'MiB/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, r in results.items():
+        print(f"{name:<14} {r['count']:>7} {r['errors']:>6} {r['throughput']:>8.1f} {r['mib_per_s']:>8.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['max_ms']:>8.1f}")
+
+
+def compare(results: Dict[str, dict], baseline: dict, tolerance: float) -> List[str]:
+    """Operations that got slower or less productive than the baseline"""
+    regressions = []
+    print(f"\nAgainst baseline from {baseline.get('recorded_at', '?')} (tolerance {tolerance:.0%})")
+    for name, r in results.items():
+        base = baseline["operations"].get(name)
+        if not base:
+            continue
+        if min(r["count"], base["count"]) < MIN_COMPARE_SAMPLES:
+            print(f"➖ {name:<14} too few samples to compare")
+            continue
+        p95 = r["p95_ms"] / base["p95_ms"] if base["p95_ms"] else 1.0
+        throughput = r["throughput"] / base["throughput"] if base["throughput"] else 1.0
+        worse = p95 > 1 + tolerance or throughput < 1 - tolerance
+        print(f"{'❌' if worse else '✅'} {name:<14} p95 x{p95:.2f}  throughput x{throughput:.2f}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+@asynccontextmanager
+async def api_client(args):
+    """An HTTP client for the API under test"""
+    if not args.in_process:
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+            yield client
+        return
+
+    # A fresh app on a scratch database, built the way workers build theirs
+    sys.path.insert(0, str(BACKEND_DIR))
+    from server import create_app
+    from settings import Settings
+
+    settings = Settings(
+        mongo_url="mongodb://localhost:27017" if args.mongo == "mock" else args.mongo,
+        db_name=f"terabox_load_{uuid.uuid4().hex[:8]}",
+        upload_dir=Path(tempfile.mkdtemp(prefix="terabox_load_")),
+    )
+    mongo = None
+    if args.mongo == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+        mongo = AsyncMongoMockClient()
+    app = create_app(settings, client=mongo)
+    try:
+        async with app.router.lifespan_context(app):
+            try:
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://in-process", timeout=args.timeout) as client:
+                    yield client
+            finally:
+                if args.mongo != "mock":
+                    await app.state.client.drop_database(settings.db_name)
+    finally:
+        # Removed once the background workers have stopped writing to it
+        shutil.rmtree(settings.upload_dir, ignore_errors=True)
+
+
+async def smoke(args) -> bool:
+    """One request per endpoint, checking the responses"""
+    failures = []
+    async with api_client(args) as client:
+        test = LoadTest(client, args)
+
+        async def step(label, coro):
+            try:
+                detail = await coro
+                print(f"✅ {label}{f' ({detail})' if detail else ''}")
+            except Exception as e:
+                print(f"❌ {label}: {e}")
+                failures.append(label)
+
+        async def flow():
+            user = await test.register()
+            test.users = [user]
+            me = (await test.check(await client.get("/api/auth/me", headers=user.headers))).json()
+            assert me["email"] == user.email
+            content = os.urandom(100_000)
+            file_id = await test.upload(user, "smoke.bin", content)
+            listed = (await test.check(await client.get("/api/files", headers=user.headers))).json()
+            assert [f["id"] for f in listed] == [file_id], listed
+            body = (await test.check(await client.get(f"/api/files/{file_id}/download", headers=user.headers))).content
+            assert body == content
+            part = await test.check(await client.get(
+                f"/api/files/{file_id}/download", headers={**user.headers, "Range": "bytes=10-19"}
+            ), 206)
+            assert part.content == content[10:20]
+            stats = (await test.check(await client.get("/api/dashboard/stats", headers=user.headers))).json()
+            assert stats["total_files"] == 1 and stats["storage_used"] == len(content), stats
+            await test.check(await client.delete(f"/api/files/{file_id}", headers=user.headers))
+            listed = (await test.check(await client.get("/api/files", headers=user.headers))).json()
+            assert listed == [], listed
+            return "register, login, me, upload, list, download, range, stats, delete"
+
+        async def compressed():
+            import zstandard
+
+            user = await test.register()
+            test.users.append(user)
+            # Under COMPRESS_PROBE_SIZE, so compression is decided at the end of the upload
+            content = b"".join(b"%06d GET /api/files 200 12ms\n" % i for i in range(12_000))
+            file_id = await test.upload(user, "access.log", content, "text/plain")
+            url = f"/api/files/{file_id}/download"
+            body = (await test.check(await client.get(url, headers=user.headers))).content
+            assert body == content
+            headers = {**user.headers, "Accept-Encoding": "zstd"}
+            async with client.stream("GET", url, headers=headers) as response:
+                await test.check(response)
+                raw = b"".join([chunk async for chunk in response.aiter_raw()])
+            if response.headers.get("content-encoding") != "zstd":
+                return "stored uncompressed (zstandard missing on the server?)"
+            assert zstandard.ZstdDecompressor().decompress(raw, max_output_size=len(content)) == content
+            decoded = (await test.check(await client.get(url, headers=headers))).content
+            assert decoded == content
+            await test.check(await client.delete(f"/api/files/{file_id}", headers=user.headers))
+            return f"{len(content)} bytes stored as {len(raw)}, one-shot and passthrough"
+
+        await step("file lifecycle", flow())
+        await step("compressed round trip", compressed())
+    print(f"\n{len(failures)} checks failed")
+    return not failures
+
+
+async def run(args) -> bool:
+    mix = parse_mix(args.mix)
+    async with api_client(args) as client:
+        test = LoadTest(client, args)
+        await test.setup(mix)
         try:
-            response = self.session.delete(f"{API_BASE}/files/{file_id}")
-            print(f"File delete response status: {response.status_code}")
-            print(f"File delete response: {response.text}")
-            
-            if response.status_code == 200:
-                print("✅ File delete successful")
-                self.uploaded_files.remove(file_id)
-                return True
-            else:
-                print(f"❌ File delete failed: {response.text}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ File delete error: {str(e)}")
+            print(f"Running {args.mix} at concurrency {args.concurrency} for {args.duration}s")
+            elapsed = await test.run_mix(mix, args.concurrency, args.duration, args.warmup)
+        finally:
+            await test.cleanup()
+
+    results = {name: stats.summary(elapsed) for name, stats in test.stats.items()}
+    print_report(results, elapsed, args.concurrency)
+    for name, stats in test.stats.items():
+        if stats.last_error:
+            print(f"⚠️  {name}: {stats.errors} errors, last: {stats.last_error}")
+
+    if args.save_baseline:
+        path = Path(args.save_baseline)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({
+            "recorded_at": datetime.utcnow().isoformat(),
+            "host": platform.node(),
+            "target": "in-process" if args.in_process else args.url,
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "operations": results,
+        }, indent=2))
+        print(f"\nBaseline saved to {path}")
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if regressions:
+            print(f"\nRegressed: {', '.join(regressions)}")
             return False
-    
-    def run_complete_test_suite(self):
-        """Run the complete test suite in order"""
-        print(f"🚀 Starting TeraBox API Test Suite")
-        print(f"Backend URL: {BASE_URL}")
-        print(f"API Base URL: {API_BASE}")
-        print("=" * 60)
-        
-        results = {}
-        
-        # Test authentication flow
-        results['register'] = self.test_auth_register()
-        results['login'] = self.test_auth_login()
-        results['me'] = self.test_auth_me()
-        
-        # Test file management flow
-        results['upload'] = self.test_file_upload()
-        results['get_files'] = self.test_get_files()
-        results['download'] = self.test_file_download()
-        results['dashboard'] = self.test_dashboard_stats()
-        results['delete'] = self.test_file_delete()
-        
-        # Summary
-        print("\n" + "=" * 60)
-        print("📋 TEST RESULTS SUMMARY")
-        print("=" * 60)
-        
-        passed = sum(1 for result in results.values() if result)
-        total = len(results)
-        
-        for test_name, result in results.items():
-            status = "✅ PASS" if result else "❌ FAIL"
-            print(f"{test_name.upper():<15} {status}")
-        
-        print(f"\nOverall: {passed}/{total} tests passed")
-        
-        if passed == total:
-            print("🎉 All tests passed! TeraBox API is working correctly.")
-        else:
-            print("⚠️  Some tests failed. Please check the detailed output above.")
-        
-        return results
+    return True
+
 
 def main():
-    """Main function to run the test suite"""
-    tester = TeraBoxAPITester()
-    return tester.run_complete_test_suite()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def target_args(p):
+        p.add_argument("--url", default=os.environ.get("BACKEND_URL", "http://localhost:8001"))
+        p.add_argument("--in-process", action="store_true", help="run the app inside this process")
+        p.add_argument("--mongo", default="mock",
+                       help="with --in-process: 'mock' or a mongod URL (a scratch database is used and dropped)")
+        p.add_argument("--timeout", type=float, default=120.0)
+        p.add_argument("--concurrency", type=int, default=32)
+
+    target_args(sub.add_parser("smoke", help="check every endpoint once"))
+
+    load = sub.add_parser("run", help="run a mix of operations and report latency percentiles")
+    target_args(load)
+    load.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight pairs")
+    load.add_argument("--duration", type=float, default=30.0)
+    load.add_argument("--warmup", type=float, default=2.0, help="seconds run before measuring")
+    load.add_argument("--users", type=int, default=16)
+    load.add_argument("--small-kb", type=int, default=200)
+    load.add_argument("--large-mb", type=int, default=256)
+    load.add_argument("--range-file-mb", type=int, default=64)
+    load.add_argument("--range-kb", type=int, default=256)
+    load.add_argument("--listing-files", type=int, default=100_000)
+    load.add_argument("--page-size", type=int, default=1000)
+    load.add_argument("--save-baseline", help="write the results to this JSON file")
+    load.add_argument("--compare", help="baseline JSON to check the results against")
+    load.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+
+    args = parser.parse_args()
+    ok = asyncio.run(smoke(args) if args.command == "smoke" else run(args))
+    sys.exit(0 if ok else 1)
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()